@@ -1,17 +1,16 @@
 # ==================== 統一新增作業流程管理器 ====================
 
-import os
 import datetime
 from firebase_utils import (
-    load_data, save_data, set_user_state, get_user_state,
+    set_user_state,
     clear_user_state, set_temp_task, get_temp_task, clear_temp_task,
-    get_task_history, update_task_history, add_task
+    get_task_history, update_task_history, add_task, WriteBatch, new_task_id,
+    TaskExistsError
 )
-from firebase_admin import db
-from linebot.v3.messaging import MessagingApi, ReplyMessageRequest, ApiClient, Configuration
 from linebot.v3.messaging.models import TextMessage, FlexMessage, FlexContainer
-
-configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+import line_gateway
+import flow_context
+from date_utils import parse_due_date
 
 class AddTaskFlowManager:
     """統一的新增作業流程管理器"""
@@ -35,13 +34,12 @@ class AddTaskFlowManager:
             )
         ]
 
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=messages
-                )
-            )
+        line_gateway.reply(reply_token, messages)
+
+    @staticmethod
+    def load_temp_task(user_id):
+        """取得目前的暫存作業：postback 帶有有效的流程內容時直接使用，否則讀取 temp_task"""
+        return flow_context.current_temp_task() or get_temp_task(user_id)
 
     @staticmethod
     def _create_task_name_bubble(name_history):
@@ -158,7 +156,8 @@ class AddTaskFlowManager:
     @staticmethod
     def handle_task_name_selection(user_id, task_name, reply_token, is_quick=False):
         """處理作業名稱選擇（統一處理快速選擇和歷史記錄）"""
-        temp_task = {"task": task_name}
+        # id 會成為新增後的作業 ID，重複點擊確認時只會寫入同一個作業
+        temp_task = {"id": new_task_id(), "task": task_name}
         set_temp_task(user_id, temp_task)
         set_user_state(user_id, "awaiting_task_time")
 
@@ -167,19 +166,17 @@ class AddTaskFlowManager:
         
         # 創建增強版時間選擇介面
         bubble = AddTaskFlowManager._create_enhanced_time_bubble(time_history, user_id)
-
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="選擇預估時間",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        flow_context.attach_to_bubble(bubble, user_id, temp_task, ["select_time_"])
+
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="選擇預估時間",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def handle_manual_task_name_input(user_id, text, reply_token):
@@ -370,7 +367,7 @@ class AddTaskFlowManager:
     @staticmethod
     def handle_time_selection(user_id, time_value, reply_token):
         """處理時間選擇"""
-        temp_task = get_temp_task(user_id)
+        temp_task = AddTaskFlowManager.load_temp_task(user_id)
         if not temp_task:
             AddTaskFlowManager._send_error_and_restart(user_id, reply_token)
             return
@@ -384,19 +381,17 @@ class AddTaskFlowManager:
         
         # 創建增強版類型選擇介面
         bubble = AddTaskFlowManager._create_enhanced_type_bubble(type_history)
-
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="選擇作業類型",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        flow_context.attach_to_bubble(bubble, user_id, temp_task, ["select_type_"])
+
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="選擇作業類型",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def handle_manual_time_input(user_id, text, reply_token):
@@ -405,15 +400,12 @@ class AddTaskFlowManager:
             hours = AddTaskFlowManager._parse_hours(text.strip())
             AddTaskFlowManager.handle_time_selection(user_id, str(hours), reply_token)
         except ValueError:
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[
-                            TextMessage(text="⚠️ 請輸入有效的時間格式\n例如：2、2.5、2小時、兩小時")
-                        ]
-                    )
-                )
+            line_gateway.reply(
+                reply_token,
+                [
+                    TextMessage(text="⚠️ 請輸入有效的時間格式\n例如：2、2.5、2小時、兩小時")
+                ]
+            )
 
     @staticmethod
     def _create_enhanced_type_bubble(type_history):
@@ -585,7 +577,7 @@ class AddTaskFlowManager:
     @staticmethod
     def handle_type_selection(user_id, type_value, reply_token):
         """處理類型選擇"""
-        temp_task = get_temp_task(user_id)
+        temp_task = AddTaskFlowManager.load_temp_task(user_id)
         if not temp_task:
             AddTaskFlowManager._send_error_and_restart(user_id, reply_token)
             return
@@ -596,19 +588,17 @@ class AddTaskFlowManager:
 
         # 創建增強版截止日期選擇介面
         bubble = AddTaskFlowManager._create_enhanced_due_bubble()
-
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="選擇截止日期",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        flow_context.attach_to_bubble(bubble, user_id, temp_task, ["quick_due_", "select_task_due", "no_due_date"])
+
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="選擇截止日期",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def handle_manual_type_input(user_id, text, reply_token):
@@ -785,7 +775,7 @@ class AddTaskFlowManager:
     @staticmethod
     def handle_due_date_selection(user_id, due_date, reply_token):
         """處理截止日期選擇"""
-        temp_task = get_temp_task(user_id)
+        temp_task = AddTaskFlowManager.load_temp_task(user_id)
         if not temp_task:
             AddTaskFlowManager._send_error_and_restart(user_id, reply_token)
             return
@@ -794,42 +784,52 @@ class AddTaskFlowManager:
         set_temp_task(user_id, temp_task)
         
         # 顯示確認畫面
-        AddTaskFlowManager._show_confirmation(user_id, reply_token)
+        AddTaskFlowManager._show_confirmation(user_id, reply_token, temp_task)
+
+    @staticmethod
+    def handle_manual_due_input(user_id, text, reply_token):
+        """處理手動輸入截止日期（如「明天」「下週五」「6/10」）"""
+        due_date, _ = parse_due_date(text)
+        if not due_date:
+            line_gateway.reply(reply_token, [TextMessage(text="❌ 無法辨識日期，請輸入如「明天」「下週五」「6月10日」，或點選上方的日期按鈕")])
+            return
+        AddTaskFlowManager.handle_due_date_selection(user_id, due_date, reply_token)
 
     @staticmethod
     def handle_no_due_date(user_id, reply_token):
         """處理不設定截止日期"""
-        temp_task = get_temp_task(user_id)
+        temp_task = AddTaskFlowManager.load_temp_task(user_id)
         if not temp_task:
             AddTaskFlowManager._send_error_and_restart(user_id, reply_token)
             return
         temp_task["due"] = "未設定"
         set_temp_task(user_id, temp_task)
-        AddTaskFlowManager._show_confirmation(user_id, reply_token)
+        AddTaskFlowManager._show_confirmation(user_id, reply_token, temp_task)
 
     @staticmethod
-    def _show_confirmation(user_id, reply_token):
+    def _show_confirmation(user_id, reply_token, temp_task=None):
         """顯示確認新增作業畫面"""
-        temp_task = get_temp_task(user_id)
+        temp_task = temp_task or AddTaskFlowManager.load_temp_task(user_id)
         if not temp_task:
             AddTaskFlowManager._send_error_and_restart(user_id, reply_token)
             return
 
+        # 欄位都已填好，之後只等按鈕確認；結束等待文字輸入的狀態，其他訊息回到一般指令處理
+        clear_user_state(user_id)
+
         # 創建確認卡片
         bubble = AddTaskFlowManager._create_confirmation_bubble(temp_task)
-
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="確認新增作業",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        flow_context.attach_to_bubble(bubble, user_id, temp_task, ["confirm_add_task"])
+
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="確認新增作業",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def _create_confirmation_bubble(temp_task):
@@ -1063,7 +1063,7 @@ class AddTaskFlowManager:
     @staticmethod
     def confirm_add_task(user_id, reply_token):
         """確認新增作業"""
-        temp_task = get_temp_task(user_id)
+        temp_task = AddTaskFlowManager.load_temp_task(user_id)
         if not temp_task:
             reply = "⚠️ 發生錯誤，請重新開始新增作業流程"
         else:
@@ -1076,45 +1076,49 @@ class AddTaskFlowManager:
                     if isinstance(temp_task["estimated_time"], str):
                         temp_task["estimated_time"] = float(temp_task["estimated_time"])
 
+                    #確保截止日不為空字串/None
+                    if "due" not in temp_task or not temp_task["due"] or temp_task["due"] == "None":
+                        temp_task["due"] = "未設定"
+
+                    # 先新增作業（只在作業 ID 不存在時寫入），重送的確認按鈕不會再次新增
+                    if not add_task(user_id, temp_task):
+                        raise Exception("新增作業失敗")
+
+                    # 其餘寫入收集後一次送出（歷史記錄、新增日期、清理暫存）
+                    batch = WriteBatch()
+
                     # 更新歷史記錄
                     update_task_history(
                         user_id, 
                         temp_task["task"], 
                         temp_task["category"], 
-                        temp_task["estimated_time"]
+                        temp_task["estimated_time"],
+                        batch=batch
                     )
-
-                    #確保截止日不為空字串/None
-                    if "due" not in temp_task or not temp_task["due"] or temp_task["due"] == "None":
-                        temp_task["due"] = "未設定"
-
-                    # 新增作業
-                    add_task(user_id, temp_task)
                     
                     # 記錄今天已新增作業（用於新增作業提醒）
                     today = datetime.datetime.now(
                         datetime.timezone(datetime.timedelta(hours=8))
                     ).strftime("%Y-%m-%d")
-                    db.reference(f"users/{user_id}/last_add_task_date").set(today)
+                    batch.set(f"users/{user_id}/last_add_task_date", today)
                     
                     # 清理暫存資料
-                    clear_temp_task(user_id)
-                    clear_user_state(user_id)
+                    clear_temp_task(user_id, batch=batch)
+                    clear_user_state(user_id, batch=batch)
+                    batch.commit()
                     
                     # 成功訊息
                     reply = f"✅ 作業已成功新增！\n\n📝 {temp_task['task']}\n⏰ {temp_task['estimated_time']} 小時\n📚 {temp_task['category']}"
-                    
+
+            except TaskExistsError:
+                clear_temp_task(user_id)
+                clear_user_state(user_id)
+                reply = "ℹ️ 這個作業已經新增過了"
             except Exception as e:
                 print(f"新增作業失敗：{e}")
                 reply = "❌ 發生錯誤，請稍後再試"
 
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token, 
-                    messages=[TextMessage(text=reply)]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text=reply)])
 
     @staticmethod
     def cancel_add_task(user_id, reply_token):
@@ -1122,13 +1126,7 @@ class AddTaskFlowManager:
         clear_temp_task(user_id)
         clear_user_state(user_id)
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token, 
-                    messages=[TextMessage(text="❌ 已取消新增作業")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 已取消新增作業")])
 
     @staticmethod
     def _send_error_and_restart(user_id, reply_token):
@@ -1136,13 +1134,7 @@ class AddTaskFlowManager:
         clear_temp_task(user_id)
         clear_user_state(user_id)
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 發生錯誤，請重新開始新增作業")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 發生錯誤，請重新開始新增作業")])
 
     @staticmethod
     def _parse_hours(raw: str) -> float:
@@ -1188,17 +1180,12 @@ class AddTaskFlowManager:
     def handle_natural_language_add_task(user_id, text, reply_token, task_info):
         """處理自然語言新增作業"""
         if not task_info or not task_info.get("task"):
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text="❌ 無法從您的訊息中解析出作業資訊，請重新輸入或使用「新增作業」功能")]
-                    )
-                )
+            line_gateway.reply(reply_token, [TextMessage(text="❌ 無法從您的訊息中解析出作業資訊，請重新輸入或使用「新增作業」功能")])
             return
         
         # 準備暫存資料
         temp_task = {
+            "id": new_task_id(),
             "task": task_info.get("task"),
             "estimated_time": task_info.get("estimated_time"),
             "category": task_info.get("category"),
@@ -1224,19 +1211,17 @@ class AddTaskFlowManager:
         
         # 直接顯示確認畫面
         bubble = AddTaskFlowManager._create_natural_confirmation_bubble(temp_task, ai_filled)
+        flow_context.attach_to_bubble(bubble, user_id, temp_task, ["confirm_add_task"])
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="確認新增作業",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="確認新增作業",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def _create_natural_confirmation_bubble(temp_task, ai_filled):
@@ -1587,13 +1572,7 @@ def handle_select_task_due(event, user_id):
     if date:
         AddTaskFlowManager.handle_due_date_selection(user_id, date, reply_token)
     else:
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 沒有取得日期，請重新選擇")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 沒有取得日期，請重新選擇")])
 
 def handle_no_due_date(user_id, reply_token):
     """處理不設定截止日期"""
@@ -1,27 +1,55 @@
 import os
+import hmac
+import time
+import uuid
 import datetime
-from flask import Flask, request, abort
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, abort, jsonify
 from dotenv import load_dotenv
 
 from firebase_utils import (
-    load_data, save_data,
-    get_add_task_remind_enabled,
-    get_add_task_remind_time,
-    get_task_remind_enabled,
-    save_add_task_remind_enabled,
-    save_add_task_remind_time,
-    get_remind_time
+    begin_request_cache,
+    end_request_cache,
+    REMIND_KINDS,
+    is_remind_index_ready,
+    is_settings_migrated,
+    migrate_settings,
+    get_all_users,
+    rebuild_remind_index,
+    get_due_remind_users,
+    get_remind_sweep_cursor,
+    remind_shard_of,
+    save_remind_sweep_cursor,
+    get_remind_retries,
+    save_remind_retries,
+    clear_stale_remind_retries,
+    trim_remind_changes,
+    acquire_sweep_lease,
+    release_sweep_lease,
+    get_cache_stats,
+    get_write_batch_stats,
+    get_transaction_stats
 )
 # LINE SDK
 from linebot.v3.webhook import WebhookHandler
-from linebot.v3.messaging import MessagingApi, Configuration, ApiClient
-from linebot.v3.messaging.models import PushMessageRequest, FlexMessage, FlexContainer, TextMessage
 from linebot.exceptions import InvalidSignatureError
 
 # 初始化 app
 from postback_handler import register_postback_handlers
 from line_message_handler import register_message_handlers
-from firebase_admin import db
+from webhook_dispatcher import WebhookDispatcher, WEBHOOK_MODE
+from remind_delivery import ReminderDelivery
+from remind_runner import (
+    REMIND_SWEEP_CONCURRENCY, RemindRetries, process_due_users
+)
+import line_gateway
+from profile_cache import get_profile_cache_stats
+from task_view import get_view_cache_stats
+from session_store import get_session_stats
+from flow_context import get_flow_context_stats
+from intent_utils import get_intent_stats
+from gemini_client import get_gemini_stats
+from gemini_cache import get_response_cache_stats
 
 app = Flask(__name__)
 
@@ -32,16 +60,10 @@ load_dotenv()
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
 
-configuration = Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
-line_bot_api = MessagingApi(ApiClient(configuration))
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 register_message_handlers(handler)
 register_postback_handlers(handler)
-
-def get_line_display_name(user_id):
-    with ApiClient(configuration) as api_client:
-        profile = MessagingApi(api_client).get_profile(user_id)
-        return profile.display_name
+dispatcher = WebhookDispatcher(handler.handle, LINE_CHANNEL_SECRET) if WEBHOOK_MODE == "async" else None
 
 @app.route("/")
 def home():
@@ -52,392 +74,219 @@ def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
 
+    # 非同步模式：驗證簽章後放入背景佇列，立即回覆 LINE；佇列滿時回 503 讓 LINE 重送
+    if dispatcher:
+        if not dispatcher.verify_signature(body, signature):
+            abort(400)
+        if not dispatcher.submit(body):
+            abort(503)
+        return 'OK'
+
+    begin_request_cache()
     try:
         handler.handle(body, signature)
     except InvalidSignatureError:
         abort(400)
+    finally:
+        cache_stats = end_request_cache()
+        if cache_stats.get("misses") or cache_stats.get("request_hits") or cache_stats.get("process_hits"):
+            print(f"[cache] webhook 作業快取：request_hits={cache_stats['request_hits']}, "
+                  f"process_hits={cache_stats['process_hits']}, misses={cache_stats['misses']}")
 
     return 'OK'
 
-def time_should_remind(remind_time, now):
-    """判斷提醒時間是否應該觸發（只要現在 >= 設定時間）"""
-    try:
-        # 解析提醒時間
-        remind_hour, remind_minute = map(int, remind_time.split(':'))
-        
-        # 獲取當前時間的小時和分鐘
-        current_hour = now.hour
-        current_minute = now.minute
-        
-        # 比較時間
-        if current_hour > remind_hour:
-            return True
-        elif current_hour == remind_hour and current_minute >= remind_minute:
-            return True
-        else:
-            return False
-            
-    except Exception as e:
-        print(f"【DEBUG】解析提醒時間錯誤：{remind_time}, {e}")
-        return False
-
-def send_view_tasks_push(user_id):
-    """推播作業列表 (Flex Message)"""
-    tasks = load_data(user_id)
-    if not tasks:
-        return
-
-    # 創建表格內容 (與 postback_handler.py 的 handle_view_tasks 相似)
-    table_contents = [
-        {"type": "text", "text": "📋 作業列表", "weight": "bold", "size": "xl", "color": "#1DB446"},
-        {"type": "separator", "margin": "md"}
-    ]
-
-    total_tasks = len(tasks)
-    completed_tasks = len([t for t in tasks if t.get("done", False)])
-    pending_tasks = total_tasks - completed_tasks
-
-    stats_box = {
-        "type": "box",
-        "layout": "horizontal",
-        "spacing": "md",
-        "margin": "md",
-        "contents": [
-            {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": str(total_tasks), "size": "xl", "weight": "bold", "align": "center"},
-                    {"type": "text", "text": "總計", "size": "sm", "color": "#666666", "align": "center"}
-                ], "flex": 1
-            },
-            {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": str(pending_tasks), "size": "xl", "weight": "bold", "align": "center", "color": "#FF5551"},
-                    {"type": "text", "text": "待完成", "size": "sm", "color": "#666666", "align": "center"}
-                ], "flex": 1
-            },
-            {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": str(completed_tasks), "size": "xl", "weight": "bold", "align": "center", "color": "#1DB446"},
-                    {"type": "text", "text": "已完成", "size": "sm", "color": "#666666", "align": "center"}
-                ], "flex": 1
-            }
-        ]
-    }
-    table_contents.append(stats_box)
-    table_contents.append({"type": "separator", "margin": "md"})
-
-    header_box = {
-        "type": "box",
-        "layout": "horizontal",
-        "spacing": "sm",
-        "margin": "md",
-        "contents": [
-            {"type": "text", "text": "作業名稱", "size": "sm", "weight": "bold", "flex": 2},
-            {"type": "text", "text": "類型", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
-            {"type": "text", "text": "時間", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
-            {"type": "text", "text": "截止日", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
-            {"type": "text", "text": "狀態", "size": "sm", "weight": "bold", "flex": 1, "align": "center"}
-        ]
-    }
-    table_contents.append(header_box)
-    table_contents.append({"type": "separator", "margin": "sm"})
-
-    now_date = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).date()
-
-    for i, task in enumerate(tasks):
-        is_done = task.get("done", False)
-        due_date = task.get("due", "未設定")
-        is_expired = False
-        if due_date != "未設定" and not is_done:
-            try:
-                due_datetime = datetime.datetime.strptime(due_date, "%Y-%m-%d").date()
-                is_expired = due_datetime < now_date
-            except:
-                pass
-
-        if is_done:
-            status_text = "✅"
-            status_color = "#1DB446"
-        elif is_expired:
-            status_text = "⏰"
-            status_color = "#FF5551"
-        else:
-            status_text = "⏳"
-            status_color = "#FFAA00"
-
-        due_display = due_date
-        if due_date != "未設定":
-            try:
-                due_datetime = datetime.datetime.strptime(due_date, "%Y-%m-%d")
-                due_display = due_datetime.strftime("%m/%d")
-            except:
-                due_display = "(未設定)"
-        else:
-            due_display = "(未設定)"
-
-        task_row = {
-            "type": "box",
-            "layout": "horizontal",
-            "spacing": "sm",
-            "margin": "sm",
-            "contents": [
-                {"type": "text", "text": task.get("task", "未命名"), "size": "sm", "flex": 2, "wrap": True, "color": "#666666" if is_done else "#333333"},
-                {"type": "text", "text": task.get("category", "-"), "size": "xs", "flex": 1, "align": "center", "color": "#888888"},
-                {"type": "text", "text": f"{task.get('estimated_time', 0)}h", "size": "xs", "flex": 1, "align": "center", "color": "#888888"},
-                {"type": "text", "text": due_display, "size": "xs", "flex": 1, "align": "center", "color": "#FF5551" if is_expired else "#888888"},
-                {"type": "text", "text": status_text, "size": "sm", "flex": 1, "align": "center", "color": status_color}
-            ]
-        }
-        table_contents.append(task_row)
-        if i < len(tasks) - 1:
-            table_contents.append({"type": "separator", "margin": "sm", "color": "#EEEEEE"})
-
-    bubble = {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "spacing": "none",
-            "contents": table_contents
-        },
-        "footer": {
-            "type": "box",
-            "layout": "horizontal",
-            "spacing": "sm",
-            "contents": [
-                {"type": "button", "action": {"type": "postback", "label": "✅ 完成作業", "data": "complete_task"}, "style": "primary", "flex": 1},
-                {"type": "button", "action": {"type": "postback", "label": "➕ 新增作業", "data": "add_task"}, "style": "secondary", "flex": 1}
-            ]
-        }
+# ==================== /remind 掃描 ====================
+# /remind?shard=i&of=n 只處理 crc32(user_id) % n == i 的用戶，多個 cron / 節點可以平行掃描。
+# 到期用戶依 user_id 排序分批處理：每批以執行緒池讀取與檢查，送出後寫入分片的檢查點；
+# 超過時間預算（或請求被中斷）時，下一次執行從檢查點繼續，不會重讀已處理的用戶。
+# 發送或處理失敗的提醒記入重試清單（見 firebase_utils），游標照常前進，之後的掃描會合併處理重試清單。
+REMIND_SWEEP_CHUNK_SIZE = int(os.getenv("REMIND_SWEEP_CHUNK_SIZE", "200"))
+REMIND_SWEEP_TIME_BUDGET = float(os.getenv("REMIND_SWEEP_TIME_BUDGET", "25"))  # 秒，0 表示不限
+
+def _collect_due_users(shard, shard_count, cursor, current_time_str):
+    """
+    讀取分片在 (cursor.time, 現在] 內到期的用戶
+    返回: {user_id: [kind, ...]}
+    """
+    after_time = cursor.get("time")
+    # 上次中途停止：同一時間窗內、排在 last_user 之前的用戶已經處理過
+    resume_user = cursor.get("last_user")
+    resume_until = cursor.get("until") or ""
+
+    due_users = {}
+    for kind in REMIND_KINDS:
+        for user_id, remind_time in get_due_remind_users(kind, after_time, current_time_str).items():
+            if remind_shard_of(user_id, shard_count) != shard:
+                continue
+            if resume_user is not None and user_id <= resume_user and remind_time <= resume_until:
+                continue
+            due_users.setdefault(user_id, []).append(kind)
+    return due_users
+
+def run_remind_sweep(now, shard=0, shard_count=1, full=False):
+    """
+    執行一個分片的提醒掃描
+    full=True 時讀取整個 users 樹（索引異常時的備援），不使用檢查點
+    同一個分片以租約保證同時只有一個掃描在執行，另一個重疊的呼叫直接返回
+    返回: 摘要 dict（掃描用戶數、送達數、錯誤數、耗時等）
+    """
+    started = time.monotonic()
+    sweep_id = uuid.uuid4().hex
+    lease_name = "sweep" if shard_count <= 1 else f"{shard_count}_{shard}"
+    summary = {
+        "shard": shard, "of": shard_count, "full": full, "window": None,
+        "users_scanned": 0, "users_processed": 0, "reminders_sent": 0,
+        "delivery_failures": 0, "errors": 0, "retried": 0, "retry_pending": 0,
+        "resumed": False, "complete": True, "elapsed": 0.0
     }
 
+    if not acquire_sweep_lease(lease_name, sweep_id):
+        print(f"[remind] 分片 {shard}/{shard_count} 已有其他掃描在執行，跳過")
+        summary.update(complete=False, skipped="lease_held")
+        return summary
     try:
-        line_bot_api.push_message(
-            PushMessageRequest(
-                to=user_id,
-                messages=[FlexMessage(
-                    alt_text="作業列表",
-                    contents=FlexContainer.from_dict(bubble)
-                )]
-            )
-        )
-        print(f"[remind][task] 推播作業列表給 {user_id}")
-    except Exception as e:
-        print(f"[remind][task] 推播作業列表失敗 {user_id}：{e}")
-
+        return _run_remind_sweep(now, shard, shard_count, full, summary, started, sweep_id, lease_name)
+    finally:
+        release_sweep_lease(lease_name, sweep_id)
+
+def _run_remind_sweep(now, shard, shard_count, full, summary, started, sweep_id, lease_name):
+    current_time_str = now.strftime("%H:%M")
+    today_str = now.strftime("%Y-%m-%d")
+
+    cursor = {}
+    if full:
+        users = get_all_users()
+        due_users = {
+            user_id: list(REMIND_KINDS) for user_id in users
+            if remind_shard_of(user_id, shard_count) == shard
+        }
+    else:
+        users = {}
+        # 遷移與重建索引只由分片 0 執行；其他分片先跳過，游標不前進，下一次執行會補上
+        if not is_settings_migrated() or not is_remind_index_ready():
+            if shard != 0:
+                summary.update(complete=False, skipped="index_not_ready")
+                return summary
+            if not is_settings_migrated():
+                migrate_settings()
+            if not is_remind_index_ready():
+                rebuild_remind_index()
+
+        cursor = get_remind_sweep_cursor(shard, shard_count)
+        if cursor.get("date") != today_str:
+            if shard == 0:
+                clear_stale_remind_retries(today_str)
+                trim_remind_changes()
+            cursor = {}
+        due_users = _collect_due_users(shard, shard_count, cursor, current_time_str)
+        summary["window"] = [cursor.get("time") or "00:00", current_time_str]
+        summary["resumed"] = cursor.get("last_user") is not None
+        print(f"[remind] 分片 {shard}/{shard_count} 時間窗 ({summary['window'][0]}, {current_time_str}] "
+              f"內有 {len(due_users)} 位用戶到期")
+
+    # 游標只記錄時間窗，之前發送失敗的提醒在重試清單，與這次到期的用戶一起處理
+    retry_users = {
+        user_id: kinds for user_id, kinds in get_remind_retries(today_str).items()
+        if kinds and remind_shard_of(user_id, shard_count) == shard
+    }
+    for user_id, kinds in retry_users.items():
+        due = due_users.setdefault(user_id, [])
+        due.extend(kind for kind in kinds if kind not in due)
+    summary["retried"] = len(retry_users)
+
+    user_ids = sorted(due_users)
+    summary["users_scanned"] = len(user_ids)
+    chunk_size = max(1, REMIND_SWEEP_CHUNK_SIZE)
+    delivery = ReminderDelivery()
+    retries = RemindRetries()
+
+    with ThreadPoolExecutor(max_workers=max(1, REMIND_SWEEP_CONCURRENCY)) as executor:
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            processed, errors = process_due_users(chunk, due_users, users, now, delivery, executor, sweep_id, retries)
+            summary["users_processed"] += processed
+            summary["errors"] += errors
+            # 先送出這一批（送達後才會記錄今天已提醒），再更新重試清單與檢查點
+            delivery.flush()
+            failed = retries.pop_all()
+            summary["retry_pending"] += len(failed)
+            save_remind_retries(today_str, [user_id for user_id in chunk if user_id in retry_users], failed)
+
+            if full or start + chunk_size >= len(user_ids):
+                continue
+            save_remind_sweep_cursor(today_str, cursor.get("time"), shard, shard_count,
+                                     until=current_time_str, last_user=chunk[-1])
+            if REMIND_SWEEP_TIME_BUDGET and time.monotonic() - started > REMIND_SWEEP_TIME_BUDGET:
+                print(f"[remind] 分片 {shard}/{shard_count} 超過時間預算，停在 {chunk[-1]}，下一次從這裡繼續")
+                summary["complete"] = False
+                break
+            # 沒有時間預算時掃描可能很長，每批延長一次租約
+            if not acquire_sweep_lease(lease_name, sweep_id):
+                print(f"[remind] 分片 {shard}/{shard_count} 的租約已被接手，停在 {chunk[-1]}")
+                summary["complete"] = False
+                break
+
+    if not full and summary["complete"]:
+        save_remind_sweep_cursor(today_str, current_time_str, shard, shard_count)
+
+    summary["reminders_sent"] = delivery.stats["recipients"]
+    summary["delivery_failures"] = delivery.stats["failures"]
+    summary["elapsed"] = round(time.monotonic() - started, 3)
+    print(f"[remind] 分片 {shard}/{shard_count} 完成處理 {summary['users_processed']} 個用戶，"
+          f"送達 {summary['reminders_sent']}，錯誤 {summary['errors']}，耗時 {summary['elapsed']}s")
+    return summary
 
 @app.route("/remind", methods=["GET"])
 def remind():
+    """執行提醒掃描，回傳 JSON 摘要；?shard=i&of=n 指定分片，?full=1 讀取整個 users 樹"""
     try:
-        now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
-        current_time_str = now.strftime("%H:%M")
-        today_str = now.strftime("%Y-%m-%d")
-
-        users = db.reference("users").get()
-        if not users:
-            print("[remind] 沒有用戶")
-            return "OK - No users"
-        
-        processed_count = 0
-        
-        for user_id, user_data in users.items():
-            try:
-                if not isinstance(user_data, dict):
-                    continue
-
-                # ========== 檢查新增作業提醒 ==========
-                add_task_remind_enabled = get_add_task_remind_enabled(user_id)
-                add_task_remind_time = get_add_task_remind_time(user_id)
-                last_add_task_remind_date = user_data.get("last_add_task_remind_date", "")
-                
-                print(f"[remind][add_task] user={user_id}, enabled={add_task_remind_enabled}, "
-                      f"remind_time={add_task_remind_time}, now={current_time_str}, "
-                      f"last_remind={last_add_task_remind_date}, today={today_str}")
-
-                # 檢查是否應該發送新增作業提醒
-                if add_task_remind_enabled and time_should_remind(add_task_remind_time, now):
-                    # 確保今天還沒提醒過
-                    if last_add_task_remind_date != today_str:
-                        # 發送提醒
-                        send_add_task_reminder(user_id)
-                        # 記錄今天已提醒
-                        db.reference(f"users/{user_id}/last_add_task_remind_date").set(today_str)
-                        print(f"[remind][add_task] 已發送新增作業提醒給 {user_id}")
-
-                # ========== 檢查未完成作業提醒 ==========
-                task_remind_enabled = get_task_remind_enabled(user_id)
-                remind_time = get_remind_time(user_id)
-                last_task_remind_date = user_data.get("last_task_remind_date", "")
-                tasks = user_data.get("tasks", [])
-                
-                print(f"[remind][task] user={user_id}, enabled={task_remind_enabled}, "
-                      f"remind_time={remind_time}, now={current_time_str}, "
-                      f"last_remind={last_task_remind_date}, today={today_str}")
-
-                # 檢查是否應該發送未完成作業提醒
-                if task_remind_enabled and time_should_remind(remind_time, now):
-                    # 確保今天還沒提醒過
-                    if last_task_remind_date != today_str:
-                        # 檢查是否有未完成作業
-                        has_incomplete_task = False
-                        for task in tasks:
-                            if not task.get("done", False):
-                                has_incomplete_task = True
-                                break
-
-                        if has_incomplete_task:
-                            display_name = get_line_display_name(user_id)
-
-                            # 發送文字提醒
-                            try:
-                                line_bot_api.push_message(
-                                    PushMessageRequest(
-                                        to=user_id,
-                                        messages=[TextMessage(
-                                            text=f"⏰ {display_name}，您還有尚未完成的作業喔！來看看吧 👇"
-                                        )]
-                                    )
-                                )
-                                print(f"[remind][task] 推播文字提醒給 {user_id}")
-                            except Exception as e:
-                                print(f"[remind][task] 推播文字提醒失敗 {user_id}：{e}")
-
-                            # 推播作業列表
-                            send_view_tasks_push(user_id)
-
-                            # 記錄今天已提醒
-                            db.reference(f"users/{user_id}/last_task_remind_date").set(today_str)
-                            print(f"[remind][task] 已更新 {user_id} 的提醒日期")
-                        else:
-                            print(f"[remind][task] {user_id} 沒有未完成的作業，跳過提醒")
-
-                processed_count += 1
-
-            except Exception as e:
-                print(f"[remind] 處理用戶 {user_id} 時發生錯誤：{e}")
-                continue
+        shard = int(request.args.get("shard", "0"))
+        shard_count = int(request.args.get("of", "1"))
+        if shard_count < 1 or not 0 <= shard < shard_count:
+            raise ValueError(f"shard={shard}, of={shard_count}")
+    except ValueError as e:
+        return jsonify({"status": "error", "error": f"分片參數錯誤：{e}"}), 400
 
-        print(f"[remind] 完成處理 {processed_count} 個用戶")
-        return f"OK - Processed {processed_count} users"
-
-    except Exception as e:
-        print(f"[remind] 整體錯誤：{e}")
-        return f"Error: {str(e)}"
-
-def send_add_task_reminder(user_id):
-    """發送新增作業提醒"""
     try:
-        display_name = get_line_display_name(user_id)
-        user_data = db.reference(f"users/{user_id}").get()
-        last_add_task_date = user_data.get("last_add_task_date", "")
-
-        today_str = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).strftime("%Y-%m-%d")
-        
-        # 根據今天是否已新增作業，顯示不同內容
-        if last_add_task_date == today_str:
-            # 今天已經有新增作業
-            main_text = "你今天已經有新增作業囉 🎉"
-            sub_text = "如果還有新的作業，記得馬上補上來，才不會漏掉！"
-            button_text = "➕ 繼續新增作業"
-        else:
-            # 今天尚未新增作業
-            main_text = "今天還沒有新增作業喔！"
-            sub_text = "記得把今天的作業記錄下來，這樣才不會忘記 😊"
-            button_text = "➕ 立即新增作業"
-
-        bubble = {
-            "type": "bubble",
-            "size": "kilo",
-            "header": {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {
-                        "type": "text",
-                        "text": "📝 作業提醒",
-                        "color": "#FFFFFF",
-                        "size": "lg",
-                        "weight": "bold"
-                    }
-                ],
-                "backgroundColor": "#4A90E2",
-                "paddingAll": "15px"
-            },
-            "body": {
-                "type": "box",
-                "layout": "vertical",
-                "spacing": "md",
-                "contents": [
-                    {
-                        "type": "text",
-                        "text": f"Hi {display_name}! 👋",
-                        "size": "md",
-                        "weight": "bold"
-                    },
-                    {
-                        "type": "text",
-                        "text": main_text,
-                        "size": "sm",
-                        "color": "#666666",
-                        "wrap": True
-                    },
-                    {
-                        "type": "text",
-                        "text": sub_text,
-                        "size": "sm",
-                        "color": "#666666",
-                        "wrap": True,
-                        "margin": "sm"
-                    }
-                ]
-            },
-            "footer": {
-                "type": "box",
-                "layout": "vertical",
-                "spacing": "sm",
-                "contents": [
-                    {
-                        "type": "button",
-                        "action": {
-                            "type": "postback",
-                            "label": button_text,
-                            "data": "add_task"
-                        },
-                        "style": "primary",
-                        "color": "#4A90E2"
-                    },
-                    {
-                        "type": "button",
-                        "action": {
-                            "type": "postback",
-                            "label": "⏰ 調整提醒設定",
-                            "data": "set_remind_time"
-                        },
-                        "style": "secondary"
-                    }
-                ]
-            }
-        }
-
-        line_bot_api.push_message(
-            PushMessageRequest(
-                to=user_id,
-                messages=[FlexMessage(
-                    alt_text=main_text,
-                    contents=FlexContainer.from_dict(bubble)
-                )]
-            )
-        )
-        print(f"[remind] 已發送新增作業提醒給 {user_id}")
+        now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
+        summary = run_remind_sweep(now, shard, shard_count, full=request.args.get("full") == "1")
+        return jsonify({"status": "ok", **summary})
 
     except Exception as e:
-        print(f"[remind] 發送新增作業提醒失敗：{e}")
+        print(f"[remind] 整體錯誤：{e}")
+        return jsonify({"status": "error", "error": str(e)}), 500
+
+# ==================== 執行統計 ====================
+# /stats 回傳這個程序內各模組累計的統計（快取命中、批次寫入、交易衝突、LINE API 耗時…）。
+# 多個 gunicorn worker 時各 worker 分別累計，回應中的 pid 標示是哪一個程序。
+# 設定 STATS_TOKEN 時需要帶 ?token=
+STATS_TOKEN = os.getenv("STATS_TOKEN", "")
+
+def collect_stats():
+    stats = {
+        "pid": os.getpid(),
+        "task_cache": get_cache_stats(),
+        "write_batch": get_write_batch_stats(),
+        "transactions": get_transaction_stats(),
+        "session": get_session_stats(),
+        "flow_context": get_flow_context_stats(),
+        "view_cache": get_view_cache_stats(),
+        "profile_cache": get_profile_cache_stats(),
+        "intent": get_intent_stats(),
+        "line_api": line_gateway.get_gateway_stats(),
+        "gemini": get_gemini_stats(),
+        "gemini_cache": get_response_cache_stats(),
+    }
+    if dispatcher:
+        stats["webhook_dispatcher"] = dispatcher.get_stats()
+    return stats
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """回傳本程序的執行統計 JSON"""
+    if STATS_TOKEN and not hmac.compare_digest(request.args.get("token", ""), STATS_TOKEN):
+        abort(403)
+    return jsonify(collect_stats())
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file
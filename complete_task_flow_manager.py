@@ -1,15 +1,13 @@
 # ==================== 統一完成作業流程管理器 ====================
 
-import os
 import datetime
 from firebase_utils import (
-    load_data, save_data, set_user_state, get_user_state,
-    clear_user_state
+    load_data, set_user_state,
+    clear_user_state, task_key, resolve_task_index, mutate_task
 )
-from linebot.v3.messaging import MessagingApi, ReplyMessageRequest, ApiClient, Configuration
 from linebot.v3.messaging.models import TextMessage, FlexMessage, FlexContainer
-
-configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+import line_gateway
+from task_matcher import match_task
 
 class CompleteTaskFlowManager:
     """統一的完成作業流程管理器"""
@@ -19,47 +17,37 @@ class CompleteTaskFlowManager:
         """開始完成作業流程 - 統一入口"""
         tasks = load_data(user_id)
         
-        # 過濾出未完成的作業
-        incomplete_tasks = [task for task in tasks if not task.get("done", False)]
+        # 過濾出未完成的作業（保留在完整列表中的位置）
+        incomplete_tasks = [(i, task) for i, task in enumerate(tasks) if not task.get("done", False)]
         
         if not incomplete_tasks:
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text="✅ 太棒了！目前沒有未完成的作業")]
-                    )
-                )
+            line_gateway.reply(reply_token, [TextMessage(text="✅ 太棒了！目前沒有未完成的作業")])
             return
         
         # 創建增強版完成作業選擇介面
         bubble = CompleteTaskFlowManager._create_task_selection_bubble(incomplete_tasks)
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="選擇要完成的作業",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="選擇要完成的作業",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def _create_task_selection_bubble(incomplete_tasks):
-        """創建作業選擇卡片"""
+        """創建作業選擇卡片，incomplete_tasks 為 (完整列表中的位置, 作業) 的列表"""
         # 計算統計資訊
-        total_count = len(incomplete_tasks)
         today_count = 0
         urgent_count = 0
         
         now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
         today = now.date()
         
-        for task in incomplete_tasks:
+        for _, task in incomplete_tasks:
             due = task.get("due", "未設定")
             if due != "未設定":
                 try:
@@ -143,7 +131,7 @@ class CompleteTaskFlowManager:
         upcoming_tasks = []
         no_due_tasks = []
         
-        for i, task in enumerate(incomplete_tasks):
+        for i, task in incomplete_tasks:
             task_with_index = {"index": i, "task": task}
             due = task.get("due", "未設定")
             
@@ -197,7 +185,7 @@ class CompleteTaskFlowManager:
                 "action": {
                     "type": "postback",
                     "label": f"{label_prefix}{task_name}",
-                    "data": f"confirm_complete_{index}"
+                    "data": f"confirm_complete_{task_key(task, index)}"
                 },
                 "style": "secondary",
                 "height": "sm"
@@ -275,11 +263,12 @@ class CompleteTaskFlowManager:
         return bubble
 
     @staticmethod
-    def handle_confirm_complete(user_id, task_index, reply_token):
-        """處理確認完成單一作業"""
+    def handle_confirm_complete(user_id, task_ref, reply_token):
+        """處理確認完成單一作業，task_ref 為作業 ID（或舊版的列表位置）"""
         tasks = load_data(user_id)
         
-        if task_index < 0 or task_index >= len(tasks):
+        task_index = resolve_task_index(tasks, task_ref)
+        if task_index is None:
             CompleteTaskFlowManager._send_error(reply_token)
             return
         
@@ -288,18 +277,15 @@ class CompleteTaskFlowManager:
         # 創建確認卡片
         bubble = CompleteTaskFlowManager._create_confirmation_bubble(task, task_index)
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="確認完成作業",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="確認完成作業",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def _create_confirmation_bubble(task, task_index):
@@ -450,7 +436,7 @@ class CompleteTaskFlowManager:
                         "action": {
                             "type": "postback",
                             "label": "✅ 確認完成",
-                            "data": f"execute_complete_{task_index}"
+                            "data": f"execute_complete_{task_key(task, task_index)}"
                         },
                         "style": "primary",
                         "color": "#10B981",
@@ -503,23 +489,25 @@ class CompleteTaskFlowManager:
         return bubble
 
     @staticmethod
-    def execute_complete_task(user_id, task_index, reply_token):
-        """執行完成作業"""
+    def execute_complete_task(user_id, task_ref, reply_token):
+        """執行完成作業，task_ref 為作業 ID（或舊版的列表位置）"""
         try:
-            tasks = load_data(user_id)
-            
-            if task_index < 0 or task_index >= len(tasks):
-                CompleteTaskFlowManager._send_error(reply_token)
-                return
-            
-            # 標記為完成
-            task = tasks[task_index]
-            task["done"] = True
-            task["completed_at"] = datetime.datetime.now(
+            completed_at = datetime.datetime.now(
                 datetime.timezone(datetime.timedelta(hours=8))
             ).strftime("%Y-%m-%d %H:%M:%S")
-            
-            save_data(user_id, tasks)
+
+            def complete(task):
+                if task is None:
+                    return None
+                # 標記為完成
+                task["done"] = True
+                task["completed_at"] = completed_at
+                return task
+
+            task = mutate_task(user_id, task_ref, complete)
+            if task is None:
+                CompleteTaskFlowManager._send_error(reply_token)
+                return
             
             # 創建成功訊息
             CompleteTaskFlowManager._send_success_message(user_id, task, reply_token)
@@ -604,18 +592,15 @@ class CompleteTaskFlowManager:
             "style": "secondary"
         })
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="作業完成",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="作業完成",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def handle_batch_complete(user_id, reply_token):
@@ -637,25 +622,22 @@ class CompleteTaskFlowManager:
         # 創建批次選擇介面
         bubble = CompleteTaskFlowManager._create_batch_selection_bubble(incomplete_tasks, user_id)
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="批次完成作業",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="批次完成作業",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def _create_batch_selection_bubble(incomplete_tasks, user_id):
         """創建批次選擇作業的卡片"""
         # 獲取當前選中的項目
         from firebase_utils import get_batch_selection
-        selected_indices = get_batch_selection(user_id)
+        selected_keys = {str(key) for key in get_batch_selection(user_id)}
         
         bubble = {
             "type": "bubble",
@@ -673,7 +655,7 @@ class CompleteTaskFlowManager:
                     },
                     {
                         "type": "text",
-                        "text": f"已選擇 {len(selected_indices)} 項",
+                        "text": f"已選擇 {len(selected_keys)} 項",
                         "color": "#FFFFFF",
                         "size": "sm",
                         "margin": "sm"
@@ -705,7 +687,8 @@ class CompleteTaskFlowManager:
                 task_name = task_name[:19] + "..."
             
             # 檢查是否已選中
-            is_selected = index in selected_indices
+            key = task_key(task, index)
+            is_selected = key in selected_keys
             checkbox_icon = "✅" if is_selected else "◻️"
             button_color = "#10B981" if is_selected else None
             
@@ -720,7 +703,7 @@ class CompleteTaskFlowManager:
                         "action": {
                             "type": "postback",
                             "label": f"{checkbox_icon} {task_name}",
-                            "data": f"toggle_batch_{index}"
+                            "data": f"toggle_batch_{key}"
                         },
                         "style": "secondary",
                         "height": "sm"
@@ -743,7 +726,7 @@ class CompleteTaskFlowManager:
                     "type": "button",
                     "action": {
                         "type": "postback",
-                        "label": f"✅ 完成選中項目 ({len(selected_indices)})",
+                        "label": f"✅ 完成選中項目 ({len(selected_keys)})",
                         "data": "execute_batch_complete"
                     },
                     "style": "primary",
@@ -764,19 +747,19 @@ class CompleteTaskFlowManager:
         }
         
         # 如果沒有選中任何項目，禁用完成按鈕
-        if len(selected_indices) == 0:
+        if len(selected_keys) == 0:
             bubble["footer"]["contents"][0]["style"] = "secondary"
             bubble["footer"]["contents"][0]["color"] = "#9CA3AF"
         
         return bubble
 
     @staticmethod
-    def handle_toggle_batch_selection(user_id, task_index, reply_token):
+    def handle_toggle_batch_selection(user_id, task_ref, reply_token):
         """處理批次選擇的切換"""
         from firebase_utils import toggle_batch_selection, load_data
         
         # 切換選擇狀態
-        success, action, total_selected = toggle_batch_selection(user_id, task_index)
+        success, action, total_selected = toggle_batch_selection(user_id, task_ref)
         
         if not success:
             CompleteTaskFlowManager._send_error(reply_token)
@@ -787,35 +770,26 @@ class CompleteTaskFlowManager:
         incomplete_tasks = [(i, t) for i, t in enumerate(tasks) if not t.get("done", False)]
         bubble = CompleteTaskFlowManager._create_batch_selection_bubble(incomplete_tasks, user_id)
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="批次完成作業",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="批次完成作業",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def execute_batch_complete(user_id, reply_token):
         """執行批次完成作業"""
-        from firebase_utils import get_batch_selection, batch_complete_tasks, get_batch_selected_tasks
+        from firebase_utils import batch_complete_tasks, get_batch_selected_tasks
         
         # 獲取選中的作業
         selected_tasks = get_batch_selected_tasks(user_id)
         
         if not selected_tasks:
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text="⚠️ 請先選擇要完成的作業")]
-                    )
-                )
+            line_gateway.reply(reply_token, [TextMessage(text="⚠️ 請先選擇要完成的作業")])
             return
         
         # 執行批次完成
@@ -905,55 +879,37 @@ class CompleteTaskFlowManager:
             "style": "secondary"
         })
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="批次完成成功",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="批次完成成功",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def _send_error(reply_token):
         """發送錯誤訊息"""
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 發生錯誤，請重新操作")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 發生錯誤，請重新操作")])
 
     @staticmethod
     def _send_no_tasks_message(reply_token):
         """發送沒有作業的訊息"""
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="✅ 太棒了！目前沒有未完成的作業")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="✅ 太棒了！目前沒有未完成的作業")])
 
     @staticmethod
     def cancel_complete_task(user_id, reply_token):
         """取消完成作業流程"""
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 已取消完成作業流程")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 已取消完成作業流程")])
 
     @staticmethod
-    def handle_natural_language_complete_task(user_id, text, reply_token):
-        """處理自然語言完成作業"""
+    def handle_natural_language_complete_task(user_id, text, reply_token, result=None):
+        """
+        處理自然語言完成作業
+        result：合併解析已取得的比對結果，沒有時才另外呼叫 Gemini
+        """
         from intent_utils import parse_complete_task_from_text
         
         tasks = load_data(user_id)
@@ -962,29 +918,24 @@ class CompleteTaskFlowManager:
         incomplete_tasks = [task for task in tasks if not task.get("done", False)]
         
         if not incomplete_tasks:
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text="✅ 太棒了！目前沒有未完成的作業")]
-                    )
-                )
+            line_gateway.reply(reply_token, [TextMessage(text="✅ 太棒了！目前沒有未完成的作業")])
             return
         
-        # 使用 AI 解析要完成的作業
-        result = parse_complete_task_from_text(text, tasks)
+        # 先在本地比對，只有前幾名分數太接近時才請 Gemini 在候選之間判斷
+        if result is None:
+            result = match_task(text, tasks, user_id)
+            if result and result["ambiguous"]:
+                print(f"[complete] 本地比對平手：{result['candidates']}，改由 Gemini 判斷")
+                result = parse_complete_task_from_text(text, tasks, result["candidates"])
         
         if not result or result.get("confidence", 0) < 0.5:
             # 信心度太低，顯示作業列表讓用戶選擇
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[
-                            TextMessage(text="🤔 無法確定您要完成哪個作業，請從列表中選擇：")
-                        ]
-                    )
-                )
+            line_gateway.reply(
+                reply_token,
+                [
+                    TextMessage(text="🤔 無法確定您要完成哪個作業，請從列表中選擇：")
+                ]
+            )
             
             # 顯示一般的完成作業選擇介面
             CompleteTaskFlowManager.start_complete_task_flow(user_id, reply_token)
@@ -1001,18 +952,15 @@ class CompleteTaskFlowManager:
         # 創建 AI 解析的確認卡片
         bubble = CompleteTaskFlowManager._create_ai_confirmation_bubble(task, task_index, result)
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[
-                        FlexMessage(
-                            alt_text="確認完成作業",
-                            contents=FlexContainer.from_dict(bubble)
-                        )
-                    ]
+        line_gateway.reply(
+            reply_token,
+            [
+                FlexMessage(
+                    alt_text="確認完成作業",
+                    contents=FlexContainer.from_dict(bubble)
                 )
-            )
+            ]
+        )
 
     @staticmethod
     def _create_ai_confirmation_bubble(task, task_index, ai_result):
@@ -1180,7 +1128,7 @@ class CompleteTaskFlowManager:
                         "action": {
                             "type": "postback",
                             "label": "✅ 確認完成",
-                            "data": f"execute_complete_{task_index}"
+                            "data": f"execute_complete_{task_key(task, task_index)}"
                         },
                         "style": "primary",
                         "color": "#10B981",
@@ -1271,16 +1219,16 @@ def handle_complete_task(user_id, reply_token):
 def handle_confirm_complete(data, user_id, reply_token):
     """處理確認完成單一作業"""
     try:
-        task_index = int(data.replace("confirm_complete_", ""))
-        CompleteTaskFlowManager.handle_confirm_complete(user_id, task_index, reply_token)
+        task_ref = data.replace("confirm_complete_", "")
+        CompleteTaskFlowManager.handle_confirm_complete(user_id, task_ref, reply_token)
     except ValueError:
         CompleteTaskFlowManager._send_error(reply_token)
 
 def handle_execute_complete(data, user_id, reply_token):
     """執行完成作業"""
     try:
-        task_index = int(data.replace("execute_complete_", ""))
-        CompleteTaskFlowManager.execute_complete_task(user_id, task_index, reply_token)
+        task_ref = data.replace("execute_complete_", "")
+        CompleteTaskFlowManager.execute_complete_task(user_id, task_ref, reply_token)
     except ValueError:
         CompleteTaskFlowManager._send_error(reply_token)
 
@@ -1291,8 +1239,8 @@ def handle_batch_complete_tasks(user_id, reply_token):
 def handle_toggle_batch(data, user_id, reply_token):
     """處理批次選擇切換"""
     try:
-        task_index = int(data.replace("toggle_batch_", ""))
-        CompleteTaskFlowManager.handle_toggle_batch_selection(user_id, task_index, reply_token)
+        task_ref = data.replace("toggle_batch_", "")
+        CompleteTaskFlowManager.handle_toggle_batch_selection(user_id, task_ref, reply_token)
     except ValueError:
         CompleteTaskFlowManager._send_error(reply_token)
 
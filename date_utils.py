@@ -0,0 +1,126 @@
+# ==================== 本地相對日期解析 ====================
+# 把「明天」「下週一」「這禮拜五」「3天後」「六月十日」這類說法換算成 YYYY-MM-DD，
+# 基準日為 UTC+8 的今天。能在本地解析的截止日就不需要交給 Gemini 推算。
+
+import re
+import datetime
+import unicodedata
+
+_ZH_DIGITS = {"零": 0, "〇": 0, "一": 1, "二": 2, "兩": 2, "两": 2, "三": 3, "四": 4,
+              "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_WEEKDAYS = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6, "天": 6,
+             "1": 0, "2": 1, "3": 2, "4": 3, "5": 4, "6": 5, "7": 6}
+
+_NUM = r"[0-9零〇一二兩两三四五六七八九十]+"
+_WEEK_WORD = r"(?:週|周|星期|禮拜|礼拜)"
+_WEEKDAY = r"([一二三四五六日天1-7])"
+
+_RELATIVE_DAYS = [
+    ("大後天", 3), ("大后天", 3), ("後天", 2), ("后天", 2),
+    ("明天", 1), ("明日", 1), ("今天", 0), ("今日", 0),
+]
+
+_FULL_DATE_PATTERN = re.compile(r"(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})\s*[日號号]?")
+_MONTH_DAY_PATTERN = re.compile(rf"(下個?月|({_NUM})\s*月)\s*({_NUM})\s*[日號号]")
+_SLASH_DATE_PATTERN = re.compile(r"(?<![\d/])(\d{1,2})/(\d{1,2})(?![\d/])")
+_DAYS_LATER_PATTERN = re.compile(rf"({_NUM})\s*(天|日|個?{_WEEK_WORD})\s*(?:後|后|之後|之后)")
+_WEEKDAY_PATTERN = re.compile(rf"(下下|下|這|这|本|今)?個?{_WEEK_WORD}{_WEEKDAY}")
+
+def _today():
+    return datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).date()
+
+def parse_chinese_number(text):
+    """解析 0-99 的阿拉伯或中文數字（如「十二」「二十」「兩」），失敗回傳 None"""
+    text = unicodedata.normalize("NFKC", text or "").strip()
+    if text.isdigit():
+        return int(text)
+    if not text or any(ch not in _ZH_DIGITS and ch != "十" for ch in text):
+        return None
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        if "十" in ones:
+            return None
+        tens_value = _ZH_DIGITS.get(tens, None) if tens else 1
+        ones_value = _ZH_DIGITS.get(ones, None) if ones else 0
+        if tens_value is None or ones_value is None:
+            return None
+        return tens_value * 10 + ones_value
+    if len(text) == 1:
+        return _ZH_DIGITS[text]
+    return None
+
+def _safe_date(year, month, day):
+    try:
+        return datetime.date(year, month, day)
+    except ValueError:
+        return None
+
+def _month_day(today, month, day):
+    """X月X日：今年的該日期，若已經過了則為明年"""
+    result = _safe_date(today.year, month, day)
+    if result and result < today:
+        result = _safe_date(today.year + 1, month, day)
+    return result
+
+def parse_due_date(text, today=None):
+    """
+    從句子中找出截止日期
+    返回: (YYYY-MM-DD, 對應到的原文片段)，找不到時回傳 (None, None)
+    """
+    today = today or _today()
+    text = unicodedata.normalize("NFKC", text or "")
+
+    match = _FULL_DATE_PATTERN.search(text)
+    if match:
+        result = _safe_date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        if result:
+            return result.strftime("%Y-%m-%d"), match.group(0)
+
+    match = _MONTH_DAY_PATTERN.search(text)
+    if match:
+        day = parse_chinese_number(match.group(3))
+        if match.group(2):
+            month = parse_chinese_number(match.group(2))
+            result = _month_day(today, month, day) if month and day else None
+        else:
+            # 下個月X號
+            year, month = (today.year + 1, 1) if today.month == 12 else (today.year, today.month + 1)
+            result = _safe_date(year, month, day) if day else None
+        if result:
+            return result.strftime("%Y-%m-%d"), match.group(0)
+
+    match = _SLASH_DATE_PATTERN.search(text)
+    if match:
+        result = _month_day(today, int(match.group(1)), int(match.group(2)))
+        if result:
+            return result.strftime("%Y-%m-%d"), match.group(0)
+
+    match = _DAYS_LATER_PATTERN.search(text)
+    if match:
+        count = parse_chinese_number(match.group(1))
+        if count is not None:
+            days = count if match.group(2) in ("天", "日") else count * 7
+            return (today + datetime.timedelta(days=days)).strftime("%Y-%m-%d"), match.group(0)
+
+    match = _WEEKDAY_PATTERN.search(text)
+    if match:
+        prefix = match.group(1)
+        weekday = _WEEKDAYS[match.group(2)]
+        week_start = today - datetime.timedelta(days=today.weekday())
+        if prefix == "下下":
+            result = week_start + datetime.timedelta(days=14 + weekday)
+        elif prefix == "下":
+            result = week_start + datetime.timedelta(days=7 + weekday)
+        elif prefix:
+            # 這週 / 本週：本週的那一天（週一為一週的開始）
+            result = week_start + datetime.timedelta(days=weekday)
+        else:
+            # 只說「週五」：最近的下一個週五（含今天）
+            result = today + datetime.timedelta(days=(weekday - today.weekday()) % 7)
+        return result.strftime("%Y-%m-%d"), match.group(0)
+
+    for word, days in _RELATIVE_DAYS:
+        if word in text:
+            return (today + datetime.timedelta(days=days)).strftime("%Y-%m-%d"), word
+
+    return None, None
@@ -1,80 +1,450 @@
-import os, json, tempfile
-import firebase_admin
-from firebase_admin import credentials, db
+import os
 import datetime
-import atexit
+import copy
+import threading
+import time
+import random
+import secrets
+import zlib
+from collections import OrderedDict
 
-# Firebase 初始化
-cred_json = os.getenv("GOOGLE_CREDENTIALS")
-if not cred_json:
-    raise Exception("GOOGLE_CREDENTIALS 環境變數未設定")
+from storage import get_storage
+import session_store
 
-cred_dict = json.loads(cred_json)
-cred_dict["private_key"] = cred_dict["private_key"].replace("\\n", "\n")
+# 儲存後端（Firebase RTDB 或本機 SQLite，見 storage.py）
+storage = get_storage()
 
-temp_file_path = None
+# ==================== 作業列表快取 ====================
+# 兩層快取：
+# 1. 請求層（thread-local）：同一次 webhook 內多次 load_data 只讀一次 RTDB
+# 2. 程序層（LRU + TTL）：跨請求共用，數量與存活時間皆有上限
+# 所有寫入都經過 save_data，並同步更新兩層快取（write-through）
+TASK_CACHE_TTL = float(os.getenv("TASK_CACHE_TTL", "10"))
+TASK_CACHE_MAX_USERS = int(os.getenv("TASK_CACHE_MAX_USERS", "500"))
 
-with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".json") as temp:
-    temp_file_path = temp.name
-    json.dump(cred_dict, temp)
-    temp.flush()
-    cred = credentials.Certificate(temp.name)
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': os.getenv("FIREBASE_DB_URL")
-    })
+_task_cache = OrderedDict()  # user_id -> (expires_at, tasks)
+_task_cache_lock = threading.Lock()
+_request_cache = threading.local()
+_cache_stats = {"request_hits": 0, "process_hits": 0, "misses": 0}
+
+def _count_cache(kind):
+    with _task_cache_lock:
+        _cache_stats[kind] += 1
+    stats = getattr(_request_cache, "stats", None)
+    if stats is not None:
+        stats[kind] += 1
+
+def begin_request_cache():
+    """開始一個請求範圍的快取（通常在處理 webhook 事件前呼叫）"""
+    _request_cache.tasks = {}
+    _request_cache.stats = {"request_hits": 0, "process_hits": 0, "misses": 0}
+    session_store.begin_request()
+
+def end_request_cache():
+    """結束請求範圍的快取（並寫回本次請求修改過的 session），回傳本次請求的命中統計"""
+    session_store.end_request()
+    stats = getattr(_request_cache, "stats", None) or {}
+    _request_cache.tasks = None
+    _request_cache.stats = None
+    return stats
+
+def _cache_get(user_id):
+    request_tasks = getattr(_request_cache, "tasks", None)
+    if request_tasks is not None and user_id in request_tasks:
+        _count_cache("request_hits")
+        return copy.deepcopy(request_tasks[user_id])
+
+    if TASK_CACHE_TTL > 0:
+        with _task_cache_lock:
+            entry = _task_cache.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                _task_cache.move_to_end(user_id)
+                tasks = entry[1]
+            else:
+                if entry:
+                    del _task_cache[user_id]
+                tasks = None
+        if tasks is not None:
+            _count_cache("process_hits")
+            if request_tasks is not None:
+                request_tasks[user_id] = tasks
+            return copy.deepcopy(tasks)
+
+    _count_cache("misses")
+    return None
+
+def _cache_put(user_id, tasks):
+    tasks = copy.deepcopy(tasks)
+    request_tasks = getattr(_request_cache, "tasks", None)
+    if request_tasks is not None:
+        request_tasks[user_id] = tasks
+
+    if TASK_CACHE_TTL > 0:
+        with _task_cache_lock:
+            _task_cache[user_id] = (time.monotonic() + TASK_CACHE_TTL, tasks)
+            _task_cache.move_to_end(user_id)
+            while len(_task_cache) > TASK_CACHE_MAX_USERS:
+                _task_cache.popitem(last=False)
+
+def invalidate_task_cache(user_id):
+    """讓指定用戶的作業快取失效"""
+    request_tasks = getattr(_request_cache, "tasks", None)
+    if request_tasks is not None:
+        request_tasks.pop(user_id, None)
+    with _task_cache_lock:
+        _task_cache.pop(user_id, None)
+
+def _patch_cached_tasks(tasks, task_id, body):
+    """回傳套用單一作業變動後的列表（body 為 None 表示刪除）；新的作業 ID 較大，加在最後"""
+    patched = [task for task in tasks if task.get("id") != task_id]
+    if body is not None:
+        index = next((i for i, task in enumerate(tasks) if task.get("id") == task_id), len(patched))
+        patched.insert(index, dict(copy.deepcopy(body), id=task_id))
+    return patched
+
+def _cache_patch_task(user_id, task_id, body):
+    """單一作業寫入後只更新快取中的該作業；沒有快取時不需要處理"""
+    request_tasks = getattr(_request_cache, "tasks", None)
+    if request_tasks is not None and user_id in request_tasks:
+        request_tasks[user_id] = _patch_cached_tasks(request_tasks[user_id], task_id, body)
+    with _task_cache_lock:
+        entry = _task_cache.get(user_id)
+        if entry:
+            _task_cache[user_id] = (entry[0], _patch_cached_tasks(entry[1], task_id, body))
+
+def get_cache_stats():
+    """獲取程序層累計的快取命中統計"""
+    with _task_cache_lock:
+        stats = dict(_cache_stats)
+        stats["cached_users"] = len(_task_cache)
+    return stats
+
+# ==================== 作業儲存格式 ====================
+# id 模式（預設）：每個作業存在 users/{id}/tasks/{task_id}，
+# 新增、完成、刪除單一作業只會寫入該作業的節點，不再整包覆寫列表。
+# task_id 以時間開頭，依 key 排序即為新增順序；load_data 仍回傳列表，每個作業帶有 "id" 欄位。
+# 舊的列表格式會在第一次讀取時自動轉換。設為 list 則維持原本的整包列表寫入。
+TASK_STORAGE_MODE = os.getenv("TASK_STORAGE_MODE", "id")  # id / list
+
+_task_id_lock = threading.Lock()
+_last_task_id_ms = 0
+
+def new_task_id():
+    """產生可依字串排序的作業 ID（毫秒時間 + 亂數），同一程序內保證遞增"""
+    global _last_task_id_ms
+    with _task_id_lock:
+        _last_task_id_ms = max(int(time.time() * 1000), _last_task_id_ms + 1)
+        timestamp = _last_task_id_ms
+    return f"t{timestamp:013d}{secrets.token_hex(3)}"
+
+def _task_body(task):
+    return {key: value for key, value in task.items() if key != "id"}
+
+def _tasks_from_snapshot(data):
+    """將 RTDB 讀到的 tasks 節點轉為列表（id 模式為 dict，舊格式為 list）"""
+    if not data:
+        return []
+    if isinstance(data, dict):
+        return [dict(data[task_id], id=task_id) for task_id in sorted(data) if isinstance(data[task_id], dict)]
+    return [task for task in data if isinstance(task, dict)]
+
+def tasks_from_user_data(user_data):
+    """從整包讀取的 users/{id} 資料中取出作業列表（兩種儲存格式皆可）"""
+    return _tasks_from_snapshot((user_data or {}).get("tasks"))
+
+def _migrate_task_list(user_id, path, data):
+    """把舊的列表格式轉為 tasks/{task_id}，回傳轉換後的列表"""
+    tasks = []
+    for task in data:
+        if not isinstance(task, dict):
+            continue
+        tasks.append(dict(task, id=new_task_id()))
+    if tasks:
+        storage.set(path, {task["id"]: _task_body(task) for task in tasks})
+    else:
+        storage.delete(path)
+    print(f"[tasks] 已將用戶 {user_id} 的 {len(tasks)} 個作業轉換為 ID 格式")
+    return tasks
+
+def task_key(task, index):
+    """postback 用的作業識別：有 ID 用 ID，否則用列表位置（舊格式）"""
+    return task.get("id") or str(index)
 
-# 註冊清理函數
-def cleanup_temp_file():
-    global temp_file_path
-    if temp_file_path and os.path.exists(temp_file_path):
-        try:
-            os.unlink(temp_file_path)
-            print(f"已清理暫存檔案：{temp_file_path}")
-        except Exception as e:
-            print(f"清理暫存檔案失敗：{e}")
+def resolve_task_index(tasks, key):
+    """
+    將 postback 中的作業識別換回目前列表中的位置
+    接受作業 ID，也接受舊版訊息中的數字索引；找不到時回傳 None
+    """
+    key = str(key)
+    for i, task in enumerate(tasks):
+        if task.get("id") == key:
+            return i
+    if key.isdigit() and int(key) < len(tasks):
+        return int(key)
+    return None
+
+# ==================== 多路徑批次寫入 ====================
+# 一個操作需要寫入多個節點時（新增作業後的歷史記錄、新增日期與清除 session…），先收集在 WriteBatch，
+# commit 時以一次根節點 update() 送出：只要一次往返，且 RTDB 保證全部成功或全部失敗。
+# 注意同一批次內的路徑不可互為上下層（RTDB 會拒絕整個 update）。
+# 多路徑 update 無法附帶 ETag 條件，因此作業列表本身的變動不經過 WriteBatch：
+# 新增作業以條件寫入（add_task），完成 / 批次完成 / 批次清除 / 一鍵清除都以交易寫入
+# （mutate_task / mutate_tasks），讀取之後被其他請求改過就重試，不會覆蓋或刪錯作業。
+_batch_stats = {"commits": 0, "paths": 0, "failures": 0}
+_batch_stats_lock = threading.Lock()
+
+class WriteBatch:
+    """收集多個路徑的寫入 / 刪除，commit() 時一次送出"""
+
+    def __init__(self):
+        self.updates = {}  # 完整路徑 -> 值（None 表示刪除）
+        self._after_commit = []
+        self._on_failure = []
+
+    def set(self, path, value):
+        self.updates[path.strip("/")] = value
 
-atexit.register(cleanup_temp_file)
+    def delete(self, path):
+        self.updates[path.strip("/")] = None
+
+    def after_commit(self, callback, on_failure=None):
+        """登記寫入成功後要執行的動作（例如更新快取）；失敗時改執行 on_failure"""
+        if callback:
+            self._after_commit.append(callback)
+        if on_failure:
+            self._on_failure.append(on_failure)
+
+    def commit(self):
+        if self.updates:
+            try:
+                storage.update("", self.updates)
+            except Exception:
+                with _batch_stats_lock:
+                    _batch_stats["failures"] += 1
+                for callback in self._on_failure:
+                    callback()
+                raise
+            with _batch_stats_lock:
+                _batch_stats["commits"] += 1
+                _batch_stats["paths"] += len(self.updates)
+        for callback in self._after_commit:
+            callback()
+        self.updates = {}
+        self._after_commit = []
+        self._on_failure = []
+
+def get_write_batch_stats():
+    """批次寫入次數、合併的路徑數與失敗次數"""
+    with _batch_stats_lock:
+        stats = dict(_batch_stats)
+    stats["avg_paths"] = round(stats["paths"] / stats["commits"], 2) if stats["commits"] else 0.0
+    return stats
 
 # 作業資料 CRUD
 def load_data(user_id):
-    ref = db.reference(f"users/{user_id}/tasks")
-    data = ref.get()
-    return data if data else []
+    cached = _cache_get(user_id)
+    if cached is not None:
+        return cached
+
+    path = f"users/{user_id}/tasks"
+    data = storage.get(path)
+    if TASK_STORAGE_MODE == "id" and isinstance(data, list) and data:
+        data = _migrate_task_list(user_id, path, data)
+    else:
+        data = _tasks_from_snapshot(data)
+    _cache_put(user_id, data)
+    return copy.deepcopy(data)
 
 def save_data(user_id, data):
-    ref = db.reference(f"users/{user_id}/tasks")
-    ref.set(data)
+    """
+    儲存作業列表（不檢查讀取後是否被其他請求修改，需要讀取 → 修改 → 寫回時請用 mutate_tasks）
+    id 模式只寫入有變動的作業（新增 / 修改 / 刪除），沒有變動就不寫入
+    """
+    data = data if data else []
+    path = f"users/{user_id}/tasks"
+    if TASK_STORAGE_MODE == "id":
+        for task in data:
+            if not task.get("id"):
+                task["id"] = new_task_id()
+        previous = {task["id"]: _task_body(task) for task in load_data(user_id) if task.get("id")}
+        updates = {}
+        for task in data:
+            body = _task_body(task)
+            if previous.pop(task["id"], None) != body:
+                updates[task["id"]] = body
+        for removed_id in previous:
+            updates[removed_id] = None
+    else:
+        updates = None
+
+    try:
+        if updates is None:
+            storage.set(path, data)
+        elif updates:
+            storage.update(path, updates)
+    except Exception:
+        # 寫入失敗時無法確定遠端狀態，直接讓快取失效
+        invalidate_task_cache(user_id)
+        raise
+    _cache_put(user_id, data)
+
+# ==================== 作業列表交易 ====================
+# 需要「讀取 → 修改 → 寫回」的操作以 RTDB ETag 做樂觀並行控制：
+# 寫入時確認節點從讀取後沒被其他 worker 改過，被改過就用最新資料重新執行 mutator，
+# 避免同一用戶的兩個 webhook 同時處理時互相覆蓋。
+# 只改一個作業（完成作業）用 mutate_task，交易範圍只有 tasks/{task_id}，不讀寫其他作業；
+# 一次改多個作業（批次完成、批次清除）才用 mutate_tasks 對整個 tasks 節點做交易。
+TASK_TXN_MAX_RETRIES = int(os.getenv("TASK_TXN_MAX_RETRIES", "5"))
+
+_txn_stats = {"transactions": 0, "attempts": 0, "conflicts": 0, "exhausted": 0, "max_attempts": 0}
+_txn_stats_lock = threading.Lock()
+
+class TaskConflictError(Exception):
+    """作業列表持續被同時修改，重試次數用盡"""
+
+def _tasks_write_value(tasks):
+    """將作業列表轉為要寫回 tasks 節點的值（set_if_unchanged 不接受 None，空列表以空容器表示）"""
+    if TASK_STORAGE_MODE == "id":
+        for task in tasks:
+            if not task.get("id"):
+                task["id"] = new_task_id()
+        return {task["id"]: _task_body(task) for task in tasks}
+    return tasks
+
+def _record_txn(attempts, outcome):
+    with _txn_stats_lock:
+        _txn_stats["attempts"] += attempts
+        _txn_stats["conflicts"] += attempts - 1
+        _txn_stats["max_attempts"] = max(_txn_stats["max_attempts"], attempts)
+        _txn_stats[outcome] += 1
+
+def mutate_tasks(user_id, mutator, max_retries=None):
+    """
+    以交易方式修改作業列表
+    mutator(tasks) 直接修改傳入的列表並回傳結果；發生衝突時會以最新資料再次呼叫，
+    因此 mutator 不可有其他副作用。拋出例外則放棄寫入。
+    返回: mutator 的回傳值；重試用盡時拋出 TaskConflictError
+    """
+    max_retries = TASK_TXN_MAX_RETRIES if max_retries is None else max_retries
+    path = f"users/{user_id}/tasks"
+    snapshot, etag = storage.get_with_etag(path)
+    attempts = 0
+    while True:
+        attempts += 1
+        tasks = _tasks_from_snapshot(snapshot)
+        result = mutator(tasks)
+        value = _tasks_write_value(tasks)
+        if value == (snapshot or type(value)()):
+            # 沒有變動，不需要寫入
+            _cache_put(user_id, tasks)
+            _record_txn(attempts, "transactions")
+            return result
+
+        success, snapshot, etag = storage.set_if_unchanged(path, etag, value)
+        if success:
+            _cache_put(user_id, tasks)
+            _record_txn(attempts, "transactions")
+            return result
+
+        if attempts > max_retries:
+            invalidate_task_cache(user_id)
+            _record_txn(attempts, "exhausted")
+            raise TaskConflictError(f"用戶 {user_id} 的作業列表同時修改過於頻繁，已重試 {max_retries} 次")
+        # 隨機退避，避免同時重試的請求再次撞在一起
+        time.sleep(random.uniform(0, 0.02 * attempts))
+
+def mutate_task(user_id, task_ref, mutator, max_retries=None):
+    """
+    以交易方式修改單一作業，task_ref 為作業 ID（或舊版的列表位置）
+    mutator(task) 直接修改傳入的作業並回傳結果；作業不存在時傳入 None（不會寫入）。
+    id 模式只讀寫 tasks/{task_id}；list 模式或舊版的列表位置改用 mutate_tasks
+    返回: mutator 的回傳值；重試用盡時拋出 TaskConflictError
+    """
+    task_ref = str(task_ref)
+    if TASK_STORAGE_MODE != "id" or task_ref.isdigit():
+        def mutate_one(tasks):
+            index = resolve_task_index(tasks, task_ref)
+            return mutator(tasks[index] if index is not None else None)
+        return mutate_tasks(user_id, mutate_one, max_retries)
+
+    max_retries = TASK_TXN_MAX_RETRIES if max_retries is None else max_retries
+    path = f"users/{user_id}/tasks/{task_ref}"
+    snapshot, etag = storage.get_with_etag(path)
+    attempts = 0
+    while True:
+        attempts += 1
+        if not isinstance(snapshot, dict):
+            result = mutator(None)
+            _record_txn(attempts, "transactions")
+            return result
+
+        task = dict(copy.deepcopy(snapshot), id=task_ref)
+        result = mutator(task)
+        value = _task_body(task)
+        if value == snapshot:
+            _record_txn(attempts, "transactions")
+            return result
+
+        success, snapshot, etag = storage.set_if_unchanged(path, etag, value)
+        if success:
+            _cache_patch_task(user_id, task_ref, value)
+            _record_txn(attempts, "transactions")
+            return result
+
+        if attempts > max_retries:
+            invalidate_task_cache(user_id)
+            _record_txn(attempts, "exhausted")
+            raise TaskConflictError(f"用戶 {user_id} 的作業 {task_ref} 同時修改過於頻繁，已重試 {max_retries} 次")
+        time.sleep(random.uniform(0, 0.02 * attempts))
+
+def get_transaction_stats():
+    """作業交易次數、衝突重試次數、重試用盡次數與衝突率"""
+    with _txn_stats_lock:
+        stats = dict(_txn_stats)
+    stats["conflict_rate"] = round(stats["conflicts"] / stats["attempts"], 3) if stats["attempts"] else 0.0
+    return stats
+
+# 使用者狀態與暫存任務（存在 session，見 session_store.py）
+# 等待文字輸入的流程狀態記錄設定時間，超過 FLOW_STATE_TTL 秒視為已放棄，
+# 之後的訊息回到一般指令處理，不會被好幾天前忘記的流程攔下
+FLOW_STATE_TTL = float(os.getenv("FLOW_STATE_TTL", str(30 * 60)))
 
-# 使用者狀態與暫存任務
 def set_user_state(user_id, state):
-    db.reference(f"users/{user_id}/state").set(state)
+    session_store.set_session_values(user_id, state=state, state_at=int(time.time()))
 
 def get_user_state(user_id):
-    return db.reference(f"users/{user_id}/state").get()
+    state, state_at = session_store.get_session_values(user_id, "state", "state_at")
+    if state and FLOW_STATE_TTL > 0 and time.time() - (state_at or 0) > FLOW_STATE_TTL:
+        return None
+    return state
 
-def clear_user_state(user_id):
-    db.reference(f"users/{user_id}/state").delete()
+def clear_user_state(user_id, batch=None):
+    session_store.set_session_values(user_id, batch=batch, state=None, state_at=None)
 
 def set_temp_task(user_id, task):
-    db.reference(f"users/{user_id}/temp_task").set(task)
+    session_store.set_session_values(user_id, temp_task=task)
 
 def get_temp_task(user_id):
-    return db.reference(f"users/{user_id}/temp_task").get() or {}
+    return session_store.get_session_value(user_id, "temp_task", {})
 
-def clear_temp_task(user_id):
-    db.reference(f"users/{user_id}/temp_task").delete()
+def clear_temp_task(user_id, batch=None):
+    session_store.set_session_values(user_id, batch=batch, temp_task=None)
 
 def update_task_status(user_id, task_name, status):
     """
     更新任務狀態
     """
+    def mutator(task):
+        if task is None or task["task"] != task_name:
+            return False
+        task["done"] = (status == "completed")
+        return True
+
     try:
         tasks = load_data(user_id)
-        for task in tasks:
+        for index, task in enumerate(tasks):
             if task["task"] == task_name:
-                task["done"] = (status == "completed")
-                save_data(user_id, tasks)
-                return True
+                return mutate_task(user_id, task_key(task, index), mutator)
         return False
     except Exception as e:
         print(f"更新任務狀態時發生錯誤：{str(e)}")
@@ -84,16 +454,16 @@ def get_task_history(user_id):
     """
     獲取作業名稱歷史記錄
     """
-    ref = db.reference(f"users/{user_id}/task_history")
-    history = ref.get() or {"names": [], "types": [], "times": []}
+    history = storage.get(f"users/{user_id}/task_history") or {"names": [], "types": [], "times": []}
     return history.get("names", []), history.get("types", []), history.get("times", [])
 
-def update_task_history(user_id, task_name, task_type, estimated_time):
+def update_task_history(user_id, task_name, task_type, estimated_time, batch=None):
     """
     更新作業歷史記錄
+    傳入 batch 時寫入會併入批次
     """
-    ref = db.reference(f"users/{user_id}/task_history")
-    history = ref.get() or {"names": [], "types": [], "times": []}
+    path = f"users/{user_id}/task_history"
+    history = storage.get(path) or {"names": [], "types": [], "times": []}
     
     # 確保所有必要的鍵都存在
     if "names" not in history:
@@ -122,107 +492,145 @@ def update_task_history(user_id, task_name, task_type, estimated_time):
         if len(history["times"]) > 10:  # 保留最近10筆
             history["times"].pop(0)
     
-    ref.set(history)
+    if batch is not None:
+        batch.set(path, history)
+    else:
+        storage.set(path, history)
+
+class TaskExistsError(Exception):
+    """要新增的作業 ID 已經存在（重複點擊或重送舊的確認按鈕）"""
+
+def _create_task(user_id, task):
+    """
+    只在 tasks/{task_id} 不存在時寫入（ETag 條件寫入），已存在時拋出 TaskExistsError，
+    不會覆蓋已完成或已修改過的作業
+    """
+    path = f"users/{user_id}/tasks/{task['id']}"
+    current, etag = storage.get_with_etag(path)
+    if current is not None:
+        raise TaskExistsError(f"作業 {task['id']} 已經存在")
+    body = _task_body(task)
+    success, _, _ = storage.set_if_unchanged(path, etag, body)
+    if not success:
+        raise TaskExistsError(f"作業 {task['id']} 已經存在")
+    _cache_patch_task(user_id, task["id"], body)
 
 def add_task(user_id, task):
     """
     新增任務到用戶的任務列表中
+    作業 ID 已存在時（例如重複點擊確認）拋出 TaskExistsError，不會覆蓋原本的作業。
+    id 模式以條件寫入只建立 tasks/{task_id}；這筆寫入需要確認節點不存在，無法併入 WriteBatch，
+    呼叫端應先新增作業，成功後再 commit 其他寫入。list 模式需要整包寫回，改以交易寫入
     """
+    def append(tasks):
+        if task.get("id") and any(existing.get("id") == task["id"] for existing in tasks):
+            raise TaskExistsError(f"作業 {task['id']} 已經存在")
+        tasks.append(copy.deepcopy(task))
+
     try:
-        tasks = load_data(user_id)
         task["done"] = False  # 確保新任務的狀態為未完成
-        tasks.append(task)
-        save_data(user_id, tasks)
+        if TASK_STORAGE_MODE == "id":
+            if not task.get("id"):
+                task["id"] = new_task_id()
+            _create_task(user_id, task)
+        else:
+            mutate_tasks(user_id, append)
         return True
+    except TaskExistsError:
+        raise
     except Exception as e:
         print(f"新增任務時發生錯誤：{str(e)}")
         return False
 
-def get_remind_time(user_id):
-    """獲取未完成作業提醒時間"""
+# ==================== 用戶設定 ====================
+# 提醒相關設定集中在 users/{id}/settings，一次讀取整份設定，未設定的欄位在記憶體中套用預設值，
+# 只有使用者主動變更時才寫入（不再於第一次讀取時寫入預設值）。
+# 舊版散落在 users/{id}/remind_time 等位置的設定由 migrate_settings() 一次搬移。
+SETTINGS_DEFAULTS = {
+    "remind_time": "08:00",            # 未完成作業提醒時間
+    "add_task_remind_time": "17:00",   # 新增作業提醒時間
+    "task_remind_enabled": True,       # 是否啟用未完成作業提醒
+    "add_task_remind_enabled": True,   # 是否啟用新增作業提醒
+}
+SETTINGS_VERSION = 1
+
+def settings_from_user_data(user_data):
+    """從整包讀取的 users/{id} 資料取出設定（已套用預設值）"""
+    settings = dict(SETTINGS_DEFAULTS)
+    settings.update((user_data or {}).get("settings") or {})
+    return settings
+
+def get_settings(user_id):
+    """讀取用戶設定（一次讀取，已套用預設值）"""
     try:
-        # 檢查是否已設定過
-        ref = db.reference(f"users/{user_id}/remind_time")
-        remind_time = ref.get()
-        
-        # 如果從未設定過，使用預設值並儲存
-        if remind_time is None:
-            remind_time = "08:00"
-            ref.set(remind_time)
-            print(f"[提醒] 為用戶 {user_id} 設定預設未完成作業提醒時間：{remind_time}")
-        
-        return remind_time
+        return settings_from_user_data({"settings": storage.get(f"users/{user_id}/settings")})
     except Exception as e:
-        print(f"獲取提醒時間失敗：{e}")
-        return "08:00"
+        print(f"讀取用戶設定失敗：{e}")
+        return dict(SETTINGS_DEFAULTS)
+
+def save_settings(user_id, **values):
+    """只寫入有變更的欄位"""
+    storage.update(f"users/{user_id}/settings", values)
+
+def migrate_settings():
+    """把舊版散落的四個設定併入 users/{id}/settings 並刪除舊的 key（部署後執行一次）"""
+    user_ids = storage.get("users", shallow=True) or {}
+    migrated = 0
+    for user_id in user_ids:
+        # shallow 讀取時純值的子節點會直接回傳值
+        children = storage.get(f"users/{user_id}", shallow=True) or {}
+        legacy = {key: children[key] for key in SETTINGS_DEFAULTS if key in children}
+        if not legacy:
+            continue
+        existing = {}
+        if "settings" in children:
+            existing = storage.get(f"users/{user_id}/settings") or {}
+        updates = {}
+        for key, value in legacy.items():
+            if key not in existing:
+                updates[f"users/{user_id}/settings/{key}"] = value
+            updates[f"users/{user_id}/{key}"] = None
+        storage.update("", updates)
+        migrated += 1
+    storage.set("remind_meta/settings_version", SETTINGS_VERSION)
+    print(f"[設定] 已搬移 {migrated} 位用戶的舊版設定（共 {len(user_ids)} 位用戶）")
+    return migrated
+
+def is_settings_migrated():
+    return storage.get("remind_meta/settings_version") == SETTINGS_VERSION
+
+def get_remind_time(user_id):
+    """獲取未完成作業提醒時間"""
+    return get_settings(user_id)["remind_time"]
 
 def get_add_task_remind_time(user_id):
     """獲取新增作業提醒時間"""
-    try:
-        # 檢查是否已設定過
-        ref = db.reference(f"users/{user_id}/add_task_remind_time")
-        remind_time = ref.get()
-        
-        # 如果從未設定過，使用預設值並儲存
-        if remind_time is None:
-            remind_time = "17:00"
-            ref.set(remind_time)
-            print(f"[提醒] 為用戶 {user_id} 設定預設新增作業提醒時間：{remind_time}")
-        
-        return remind_time
-    except Exception as e:
-        print(f"獲取新增作業提醒時間失敗：{e}")
-        return "17:00"
+    return get_settings(user_id)["add_task_remind_time"]
 
 def get_task_remind_enabled(user_id):
     """獲取是否啟用未完成作業提醒"""
-    try:
-        ref = db.reference(f"users/{user_id}/task_remind_enabled")
-        enabled = ref.get()
-        
-        # 如果從未設定過，預設為啟用
-        if enabled is None:
-            enabled = True
-            ref.set(enabled)
-            print(f"[提醒] 為用戶 {user_id} 設定預設未完成作業提醒狀態：啟用")
-        
-        return enabled
-    except Exception as e:
-        print(f"獲取未完成作業提醒狀態失敗：{e}")
-        return True
+    return get_settings(user_id)["task_remind_enabled"]
 
 def get_add_task_remind_enabled(user_id):
     """獲取是否啟用新增作業提醒"""
-    try:
-        ref = db.reference(f"users/{user_id}/add_task_remind_enabled")
-        enabled = ref.get()
-        
-        # 如果從未設定過，預設為啟用
-        if enabled is None:
-            enabled = True
-            ref.set(enabled)
-            print(f"[提醒] 為用戶 {user_id} 設定預設新增作業提醒狀態：啟用")
-        
-        return enabled
-    except Exception as e:
-        print(f"獲取新增作業提醒狀態失敗：{e}")
+    return get_settings(user_id)["add_task_remind_enabled"]
+
+def _reset_today_remind(user_id, kind, date_key, time_str):
+    """變更時間後，如果今天已經提醒過且新時間還沒到，清除今天的提醒記錄（含發送帳本），讓新時間生效"""
+    now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
+    if storage.get(f"users/{user_id}/{date_key}") == now.strftime("%Y-%m-%d") and time_str > now.strftime("%H:%M"):
+        storage.update(f"users/{user_id}", {date_key: None, f"remind_ledger/{kind}": None})
         return True
+    return False
 
 def save_remind_time(user_id, time_str):
     """儲存未完成作業提醒時間"""
     try:
-        db.reference(f"users/{user_id}/remind_time").set(time_str)
-        # 變更時間後，重設今天的提醒狀態，允許新時間生效
-        today = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).strftime("%Y-%m-%d")
-        last_remind_date = db.reference(f"users/{user_id}/last_task_remind_date").get()
-        
-        # 如果今天已經提醒過，且新時間還沒到，則清除今天的提醒記錄
-        if last_remind_date == today:
-            current_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).strftime("%H:%M")
-            if time_str > current_time:
-                db.reference(f"users/{user_id}/last_task_remind_date").delete()
-                print(f"[提醒] 清除用戶 {user_id} 今天的未完成作業提醒記錄，新時間 {time_str} 將生效")
-        
+        save_settings(user_id, remind_time=time_str)
+        if _reset_today_remind(user_id, "task", "last_task_remind_date", time_str):
+            print(f"[提醒] 清除用戶 {user_id} 今天的未完成作業提醒記錄，新時間 {time_str} 將生效")
+
+        update_remind_index(user_id, "task")
         return True
     except Exception as e:
         print(f"儲存未完成作業提醒時間失敗：{e}")
@@ -231,18 +639,11 @@ def save_remind_time(user_id, time_str):
 def save_add_task_remind_time(user_id, time_str):
     """儲存新增作業提醒時間"""
     try:
-        db.reference(f"users/{user_id}/add_task_remind_time").set(time_str)
-        # 變更時間後，重設今天的提醒狀態，允許新時間生效
-        today = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).strftime("%Y-%m-%d")
-        last_remind_date = db.reference(f"users/{user_id}/last_add_task_remind_date").get()
-        
-        # 如果今天已經提醒過，且新時間還沒到，則清除今天的提醒記錄
-        if last_remind_date == today:
-            current_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).strftime("%H:%M")
-            if time_str > current_time:
-                db.reference(f"users/{user_id}/last_add_task_remind_date").delete()
-                print(f"[提醒] 清除用戶 {user_id} 今天的新增作業提醒記錄，新時間 {time_str} 將生效")
-        
+        save_settings(user_id, add_task_remind_time=time_str)
+        if _reset_today_remind(user_id, "add_task", "last_add_task_remind_date", time_str):
+            print(f"[提醒] 清除用戶 {user_id} 今天的新增作業提醒記錄，新時間 {time_str} 將生效")
+
+        update_remind_index(user_id, "add_task")
         return True
     except Exception as e:
         print(f"儲存新增作業提醒時間失敗：{e}")
@@ -251,7 +652,8 @@ def save_add_task_remind_time(user_id, time_str):
 def save_task_remind_enabled(user_id, enabled):
     """儲存是否啟用未完成作業提醒"""
     try:
-        db.reference(f"users/{user_id}/task_remind_enabled").set(enabled)
+        save_settings(user_id, task_remind_enabled=enabled)
+        update_remind_index(user_id, "task")
         return True
     except Exception as e:
         print(f"儲存未完成作業提醒狀態失敗：{e}")
@@ -260,65 +662,347 @@ def save_task_remind_enabled(user_id, enabled):
 def save_add_task_remind_enabled(user_id, enabled):
     """儲存是否啟用新增作業提醒"""
     try:
-        db.reference(f"users/{user_id}/add_task_remind_enabled").set(enabled)
+        save_settings(user_id, add_task_remind_enabled=enabled)
+        update_remind_index(user_id, "add_task")
         return True
     except Exception as e:
         print(f"儲存新增作業提醒狀態失敗：{e}")
         return False
 
+# ==================== 提醒索引 ====================
+# remind_index/{kind}/{HH:MM}/{user_id} = True
+# users/{user_id}/remind_index/{kind} = "HH:MM"（反向指標，用來移除舊的索引）
+# 只有啟用提醒的用戶會出現在索引中，/remind 只需讀取目前時間窗內到期的用戶
+
+REMIND_KINDS = {
+    "task": {"time_key": "remind_time", "enabled_key": "task_remind_enabled"},
+    "add_task": {"time_key": "add_task_remind_time", "enabled_key": "add_task_remind_enabled"},
+}
+REMIND_INDEX_VERSION = 1
+# 索引的每次變動同時寫入 remind_changes/{時間}（與索引同一次多路徑寫入，不多一次往返），
+# 提醒排程器（remind_scheduler.py）讀取後刪除，不需要重新掃描索引就能即時更新；
+# 沒有執行排程器時由每天第一次 /remind 掃描刪除超過 REMIND_CHANGES_MAX_AGE 的紀錄。
+REMIND_CHANGES_MAX_AGE = int(os.getenv("REMIND_CHANGES_MAX_AGE", str(24 * 60 * 60)))  # 秒
+
+_indexed_users = set()
+_indexed_users_lock = threading.Lock()
+
+def update_remind_index(user_id, kind):
+    """依用戶目前的提醒設定更新索引（一次多路徑寫入）"""
+    try:
+        config = REMIND_KINDS[kind]
+        settings = get_settings(user_id)
+        remind_time = settings[config["time_key"]]
+        enabled = settings[config["enabled_key"]]
+        old_time = storage.get(f"users/{user_id}/remind_index/{kind}")
+
+        updates = {}
+        if old_time and (old_time != remind_time or not enabled):
+            updates[f"remind_index/{kind}/{old_time}/{user_id}"] = None
+        if enabled:
+            updates[f"remind_index/{kind}/{remind_time}/{user_id}"] = True
+            updates[f"users/{user_id}/remind_index/{kind}"] = remind_time
+        else:
+            updates[f"users/{user_id}/remind_index/{kind}"] = None
+        changed_at = time.time_ns()
+        updates[f"remind_changes/{changed_at:020d}_{user_id}_{kind}"] = {
+            "user_id": user_id, "kind": kind, "time": remind_time if enabled else None,
+            "at": changed_at // 1_000_000_000
+        }
+
+        storage.update("", updates)
+        return True
+    except Exception as e:
+        print(f"更新提醒索引失敗：{e}")
+        return False
+
+def ensure_remind_index(user_id):
+    """
+    確保用戶已加入提醒索引（新用戶第一次互動時建立）
+    每個程序對每位用戶只檢查一次
+    """
+    with _indexed_users_lock:
+        if user_id in _indexed_users:
+            return
+    try:
+        pointers = storage.get(f"users/{user_id}/remind_index") or {}
+        for kind in REMIND_KINDS:
+            if kind not in pointers:
+                update_remind_index(user_id, kind)
+        with _indexed_users_lock:
+            _indexed_users.add(user_id)
+    except Exception as e:
+        print(f"檢查提醒索引失敗：{e}")
+
+def rebuild_remind_index():
+    """重建所有用戶的提醒索引（首次部署或資料修復時使用）"""
+    user_ids = storage.get("users", shallow=True) or {}
+    storage.delete("remind_index")
+    for user_id in user_ids:
+        for kind in REMIND_KINDS:
+            storage.delete(f"users/{user_id}/remind_index/{kind}")
+            update_remind_index(user_id, kind)
+    storage.set("remind_meta/index_version", REMIND_INDEX_VERSION)
+    print(f"[提醒] 已重建 {len(user_ids)} 位用戶的提醒索引")
+    return len(user_ids)
+
+def is_remind_index_ready():
+    return storage.get("remind_meta/index_version") == REMIND_INDEX_VERSION
+
+def get_due_remind_users(kind, after_time, until_time):
+    """
+    讀取提醒時間落在 (after_time, until_time] 之間的用戶
+    after_time 為 None 時從 00:00 開始
+    返回: {user_id: remind_time}
+    """
+    entries = storage.get_key_range(f"remind_index/{kind}", start_at=after_time, end_at=until_time)
+
+    due_users = {}
+    for remind_time, users in entries.items():
+        if after_time and remind_time <= after_time:
+            continue
+        for user_id in (users or {}):
+            due_users[user_id] = remind_time
+    return due_users
+
+def remind_shard_of(user_id, shard_count):
+    """用戶所屬的分片（crc32，跨程序、跨機器都穩定）"""
+    if shard_count <= 1:
+        return 0
+    return zlib.crc32(user_id.encode("utf-8")) % shard_count
+
+def _sweep_cursor_path(shard, shard_count):
+    # 不分片時沿用原本的路徑；不同的分片數各自有一組游標
+    if shard_count <= 1:
+        return "remind_meta/sweep_cursor"
+    return f"remind_meta/sweep_cursors/{shard_count}/{shard}"
+
+def get_remind_index(kind):
+    """讀取整個提醒索引，返回: {HH:MM: {user_id: True}}（排程器啟動時使用）"""
+    return storage.get_key_range(f"remind_index/{kind}")
+
+def pop_remind_changes():
+    """
+    讀取並刪除提醒索引的變動紀錄（依發生順序）
+    返回: [{"user_id", "kind", "time"}]，time 為 None 表示已停用
+    """
+    changes = storage.get_key_range("remind_changes")
+    if not changes:
+        return []
+    storage.update("remind_changes", {key: None for key in changes})
+    return [changes[key] for key in sorted(changes) if isinstance(changes[key], dict)]
+
+def watch_remind_changes(callback):
+    """
+    有新的變動紀錄寫入時呼叫 callback()（刪除不通知），讓排程器立即處理
+    返回: 監聽物件（close() 停止）；儲存後端不支援監聽時返回 None
+    """
+    def on_event(path, data):
+        if data is not None:
+            callback()
+    return storage.listen("remind_changes", on_event)
+
+def trim_remind_changes(max_age=None):
+    """刪除超過 max_age 秒（預設 REMIND_CHANGES_MAX_AGE）的變動紀錄，紀錄的 key 以寫入時間開頭"""
+    max_age = REMIND_CHANGES_MAX_AGE if max_age is None else max_age
+    cutoff = f"{time.time_ns() - max_age * 1_000_000_000:020d}"
+    stale = storage.get_key_range("remind_changes", end_at=cutoff)
+    if stale:
+        storage.update("remind_changes", {key: None for key in stale})
+    return len(stale or {})
+
+def get_remind_scheduler_cursor():
+    """排程器上一次觸發到的時間點 {"date": ..., "time": ...}"""
+    return storage.get("remind_meta/scheduler_cursor") or {}
+
+def save_remind_scheduler_cursor(date_str, time_str):
+    storage.set("remind_meta/scheduler_cursor", {"date": date_str, "time": time_str})
+
+def get_remind_sweep_cursor(shard=0, shard_count=1):
+    """
+    獲取分片上一次 /remind 掃描到的時間點 {"date": ..., "time": ...}
+    掃描中途停止時另有 {"until": 該次時間窗終點, "last_user": 已處理到的用戶}
+    """
+    return storage.get(_sweep_cursor_path(shard, shard_count)) or {}
+
+def save_remind_sweep_cursor(date_str, time_str, shard=0, shard_count=1, until=None, last_user=None):
+    cursor = {"date": date_str, "time": time_str}
+    if last_user is not None:
+        cursor.update({"until": until, "last_user": last_user})
+    storage.set(_sweep_cursor_path(shard, shard_count), cursor)
+
+def get_user_data(user_id):
+    return storage.get(f"users/{user_id}") or {}
+
+# ==================== 提醒發送帳本與掃描租約 ====================
+# users/{id}/remind_ledger/{kind} = {"date", "status": claimed / sent, "owner", "claimed_at"}
+# 發送前以條件寫入（ETag）登記，同一天同一種提醒只有一個掃描能取得；
+# 取得後程序中斷的登記超過 REMIND_CLAIM_TTL 秒可被其他掃描接手。
+# remind_meta/leases/{分片} = {"owner", "expires_at"}：同一個分片同時只有一個掃描在執行。
+
+REMIND_CLAIM_TTL = int(os.getenv("REMIND_CLAIM_TTL", "600"))
+REMIND_LEASE_TTL = int(os.getenv("REMIND_LEASE_TTL", "120"))
+REMIND_CLAIM_MAX_RETRIES = 3
+
+def claim_reminder(user_id, kind, date_str, owner):
+    """
+    在當日帳本登記即將發送的提醒
+    返回: True 取得登記；False 今天已送出；None 其他掃描正在發送（之後仍需確認是否送達）
+    """
+    path = f"users/{user_id}/remind_ledger/{kind}"
+    for _ in range(REMIND_CLAIM_MAX_RETRIES):
+        entry, etag = storage.get_with_etag(path)
+        if isinstance(entry, dict) and entry.get("date") == date_str:
+            if entry.get("status") == "sent":
+                return False
+            if entry.get("owner") != owner and time.time() - entry.get("claimed_at", 0) < REMIND_CLAIM_TTL:
+                return None
+        claim = {"date": date_str, "status": "claimed", "owner": owner, "claimed_at": int(time.time())}
+        success, _, _ = storage.set_if_unchanged(path, etag, claim)
+        if success:
+            return True
+    return None
+
+def release_reminder(user_id, kind, date_str, owner):
+    """發送失敗時撤回登記，讓下一次掃描可以重新發送"""
+    path = f"users/{user_id}/remind_ledger/{kind}"
+    try:
+        entry, etag = storage.get_with_etag(path)
+        if isinstance(entry, dict) and entry.get("owner") == owner and entry.get("status") == "claimed":
+            storage.set_if_unchanged(path, etag, {"date": date_str, "status": "released", "owner": owner})
+    except Exception as e:
+        print(f"撤回提醒登記失敗：{e}")
+
+def mark_reminded(user_id, kind, date_str):
+    """記錄今天已發送提醒（帳本與 last_*_remind_date 一次寫入）"""
+    key = "last_task_remind_date" if kind == "task" else "last_add_task_remind_date"
+    storage.update(f"users/{user_id}", {
+        key: date_str,
+        f"remind_ledger/{kind}": {"date": date_str, "status": "sent"}
+    })
+
+# ==================== 提醒重試清單 ====================
+# remind_meta/remind_retry/{date}/{user_id}/{kind} = True
+# 掃描的時間窗游標處理完就會前進，發送失敗（撤回登記）、讀取或處理失敗、
+# 以及登記被另一個尚未完成的掃描持有的提醒記在重試清單，之後的掃描（與排程器）會先合併處理，
+# 處理完成就移除；仍然失敗的會再次記入。每天第一次掃描時清掉前幾天的清單。
+
+def get_remind_retries(date_str):
+    """返回: {user_id: [kind, ...]}"""
+    entries = storage.get(f"remind_meta/remind_retry/{date_str}") or {}
+    return {
+        user_id: [kind for kind in kinds if kind in REMIND_KINDS]
+        for user_id, kinds in entries.items() if isinstance(kinds, dict)
+    }
+
+def save_remind_retries(date_str, done_users, retries):
+    """
+    一次寫入重試清單的變動：done_users 的舊項目移除，retries（{user_id: [kind]}）記入
+    只寫入葉節點，同一位用戶可以同時移除與記入
+    """
+    path = f"remind_meta/remind_retry/{date_str}"
+    updates = {}
+    for user_id in done_users:
+        for kind in REMIND_KINDS:
+            updates[f"{user_id}/{kind}"] = None
+    for user_id, kinds in retries.items():
+        for kind in kinds:
+            updates[f"{user_id}/{kind}"] = True
+    if updates:
+        storage.update(path, updates)
+
+def clear_stale_remind_retries(date_str):
+    """刪除 date_str 以前的重試清單"""
+    dates = storage.get("remind_meta/remind_retry", shallow=True) or {}
+    stale = {date_key: None for date_key in dates if date_key < date_str}
+    if stale:
+        storage.update("remind_meta/remind_retry", stale)
+
+def acquire_sweep_lease(name, owner, ttl=None):
+    """
+    取得（或延長自己持有的）掃描租約
+    返回: 是否取得；其他掃描持有且尚未過期時為 False
+    """
+    path = f"remind_meta/leases/{name}"
+    lease, etag = storage.get_with_etag(path)
+    now = time.time()
+    if isinstance(lease, dict) and lease.get("owner") != owner and lease.get("expires_at", 0) > now:
+        return False
+    success, _, _ = storage.set_if_unchanged(
+        path, etag, {"owner": owner, "expires_at": now + (ttl or REMIND_LEASE_TTL)}
+    )
+    return success
+
+def release_sweep_lease(name, owner):
+    path = f"remind_meta/leases/{name}"
+    try:
+        lease, etag = storage.get_with_etag(path)
+        if isinstance(lease, dict) and lease.get("owner") == owner:
+            storage.set_if_unchanged(path, etag, {"owner": owner, "expires_at": 0})
+    except Exception as e:
+        print(f"釋放掃描租約失敗：{e}")
+
+def get_user_profile(user_id):
+    """讀取持久化的 LINE 個人資料快取"""
+    return storage.get(f"users/{user_id}/profile")
+
+def save_user_profile(user_id, profile):
+    storage.set(f"users/{user_id}/profile", profile)
+
+def delete_user_profile(user_id):
+    storage.delete(f"users/{user_id}/profile")
+
 def load_metadata(user_id):
-    ref = db.reference(f"users/{user_id}/meta")
-    return ref.get()
+    return storage.get(f"users/{user_id}/meta")
 
 def save_metadata(user_id, data):
-    ref = db.reference(f"users/{user_id}/meta")
-    ref.set(data)
+    storage.set(f"users/{user_id}/meta", data)
     
 def get_batch_selection(user_id):
     """
-    獲取用戶批次選擇的作業索引列表
-    返回: list of int - 被選中的作業索引
+    獲取用戶批次選擇的作業列表
+    返回: list - 被選中作業的識別（作業 ID；舊資料可能是數字索引）
     """
     try:
-        ref = db.reference(f"users/{user_id}/batch_selection")
-        selection = ref.get()
+        selection = session_store.get_session_value(user_id, "batch_selection")
         return selection if selection else []
     except Exception as e:
         print(f"獲取批次選擇失敗：{e}")
         return []
 
-def toggle_batch_selection(user_id, task_index):
+def toggle_batch_selection(user_id, task_key):
     """
     切換某個作業的選擇狀態
     如果已選中則取消，如果未選中則選中
     """
     try:
-        selection = get_batch_selection(user_id)
+        selection = [str(key) for key in get_batch_selection(user_id)]
+        task_key = str(task_key)
         
-        if task_index in selection:
+        if task_key in selection:
             # 已選中，移除
-            selection.remove(task_index)
+            selection.remove(task_key)
             action = "取消選擇"
         else:
             # 未選中，添加
-            selection.append(task_index)
+            selection.append(task_key)
             action = "選擇"
         
         # 儲存更新後的選擇
-        db.reference(f"users/{user_id}/batch_selection").set(selection)
+        session_store.set_session_values(user_id, batch_selection=selection or None)
         return True, action, len(selection)
         
     except Exception as e:
         print(f"切換批次選擇失敗：{e}")
         return False, "", 0
 
-def clear_batch_selection(user_id):
+def clear_batch_selection(user_id, batch=None):
     """
     清除所有批次選擇
     通常在完成批次操作或取消時調用
     """
     try:
-        db.reference(f"users/{user_id}/batch_selection").delete()
+        session_store.set_session_values(user_id, batch=batch, batch_selection=None)
         return True
     except Exception as e:
         print(f"清除批次選擇失敗：{e}")
@@ -337,8 +1021,9 @@ def get_batch_selected_tasks(user_id):
         tasks = load_data(user_id)
         selected_tasks = []
         
-        for index in selection:
-            if 0 <= index < len(tasks):
+        for key in selection:
+            index = resolve_task_index(tasks, key)
+            if index is not None:
                 selected_tasks.append({
                     "index": index,
                     "task": tasks[index]
@@ -355,20 +1040,25 @@ def batch_complete_tasks(user_id, task_indices):
     批次完成多個作業
     """
     try:
+        # 先換成作業 ID，交易重試時列表位置可能已經改變
         tasks = load_data(user_id)
-        completed_count = 0
-        
-        # 標記所有選中的作業為完成
-        for index in task_indices:
-            if 0 <= index < len(tasks) and not tasks[index].get("done", False):
-                tasks[index]["done"] = True
-                tasks[index]["completed_at"] = datetime.datetime.now(
-                    datetime.timezone(datetime.timedelta(hours=8))
-                ).strftime("%Y-%m-%d %H:%M:%S")
-                completed_count += 1
-        
-        # 儲存更新後的作業列表
-        save_data(user_id, tasks)
+        keys = [task_key(tasks[index], index) for index in task_indices if 0 <= index < len(tasks)]
+        completed_at = datetime.datetime.now(
+            datetime.timezone(datetime.timedelta(hours=8))
+        ).strftime("%Y-%m-%d %H:%M:%S")
+
+        def mutator(tasks):
+            completed_count = 0
+            # 標記所有選中的作業為完成
+            for key in keys:
+                index = resolve_task_index(tasks, key)
+                if index is not None and not tasks[index].get("done", False):
+                    tasks[index]["done"] = True
+                    tasks[index]["completed_at"] = completed_at
+                    completed_count += 1
+            return completed_count
+
+        completed_count = mutate_tasks(user_id, mutator)
         
         # 清除批次選擇
         clear_batch_selection(user_id)
@@ -379,7 +1069,27 @@ def batch_complete_tasks(user_id, task_indices):
         print(f"批次完成作業失敗：{e}")
         return False, 0
     
+def get_batch_clear_selection(user_id):
+    """讀取批次清除的選擇狀態：{作業 ID（或舊版的列表位置）: 是否選中}"""
+    selection = session_store.get_session_value(user_id, "batch_clear_selection", {})
+    if isinstance(selection, list):
+        # 舊版以數字索引為 key，RTDB 可能回傳成列表
+        selection = {str(i): value for i, value in enumerate(selection) if value is not None}
+    return selection
+
+def toggle_batch_clear_selection(user_id, task_ref):
+    """切換某個作業在批次清除中的選擇狀態"""
+    selection = get_batch_clear_selection(user_id)
+    selection[str(task_ref)] = not selection.get(str(task_ref), False)
+    session_store.set_session_values(user_id, batch_clear_selection=selection)
+
+def clear_batch_clear_selection(user_id):
+    session_store.set_session_values(user_id, batch_clear_selection=None)
+
+def get_all_users():
+    """讀取整個 users 樹（只供 /remind 的完整掃描備援使用）"""
+    return storage.get("users") or {}
+
 def get_all_user_ids():
-    ref = db.reference("users")
-    users = ref.get()
+    users = storage.get("users", shallow=True)
     return list(users.keys()) if users else []
\ No newline at end of file
@@ -526,9 +526,8 @@ def make_optimized_schedule_card(blocks, total_hours, available_hours, pending_t
     if not blocks:
         return None
     
-    # 計算完成率
+    # 已安排的任務數
     scheduled_task_count = len([b for b in blocks if b['task'] not in ['短暫休息', '午餐', '晚餐']])
-    completion_rate = min(100, int((scheduled_task_count / len(pending_tasks)) * 100))
     
     # 時間利用率
     utilization_rate = min(100, int((total_hours / available_hours) * 100))
@@ -0,0 +1,125 @@
+# ==================== Postback 流程內容 ====================
+# 新增作業流程的每個按鈕都可以帶著目前已填好的欄位，格式為：
+#   原本的 data|ctx|{時間}.{簽章}.{JSON}
+# 簽章為 HMAC-SHA256（綁定 user_id），處理 postback 時驗證通過就直接用按鈕上的內容重建暫存作業，
+# 不需要先讀取 temp_task；驗證失敗、過期或超過 LINE 的 300 字元上限時退回原本的 temp_task。
+# 簽章過的按鈕在有效期限內可以重複點擊，確認新增時只在作業 ID 不存在時寫入（見 firebase_utils.add_task），
+# 重送的確認按鈕不會覆蓋或重新啟用已存在的作業。
+# 以 POSTBACK_FLOW_CONTEXT=1 啟用。
+
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import threading
+from contextlib import contextmanager
+
+POSTBACK_FLOW_CONTEXT = os.getenv("POSTBACK_FLOW_CONTEXT", "0") == "1"
+FLOW_CONTEXT_SECRET = os.getenv("FLOW_CONTEXT_SECRET") or os.getenv("LINE_CHANNEL_SECRET", "")
+FLOW_CONTEXT_MAX_AGE = int(os.getenv("FLOW_CONTEXT_MAX_AGE", str(30 * 60)))  # 秒，一次新增作業流程的長度即可
+
+POSTBACK_DATA_LIMIT = 300
+_MARKER = "|ctx|"
+_SIGNATURE_LENGTH = 16
+
+# temp_task 欄位 <-> 簡寫
+_FIELDS = {"id": "i", "task": "t", "estimated_time": "h", "category": "c", "due": "d"}
+_SHORT_FIELDS = {short: field for field, short in _FIELDS.items()}
+
+_current = threading.local()
+_stats = {"attached": 0, "too_long": 0, "used": 0, "rejected": 0}
+_stats_lock = threading.Lock()
+
+def _count(kind):
+    with _stats_lock:
+        _stats[kind] += 1
+
+def is_enabled():
+    return POSTBACK_FLOW_CONTEXT and bool(FLOW_CONTEXT_SECRET)
+
+def _sign(user_id, data, issued, payload):
+    message = "\x1f".join([user_id, data, issued, payload]).encode("utf-8")
+    digest = hmac.new(FLOW_CONTEXT_SECRET.encode("utf-8"), message, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii")[:_SIGNATURE_LENGTH]
+
+def pack(data, user_id, temp_task):
+    """在 postback data 後面附上簽章過的流程內容；未啟用或超過長度上限時回傳原本的 data"""
+    if not is_enabled() or not temp_task:
+        return data
+    compact = {_FIELDS[field]: temp_task[field] for field in _FIELDS if temp_task.get(field) is not None}
+    payload = json.dumps(compact, ensure_ascii=False, separators=(",", ":"))
+    issued = format(int(time.time()) // 60, "x")  # 分鐘，十六進位
+    packed = f"{data}{_MARKER}{issued}.{_sign(user_id, data, issued, payload)}.{payload}"
+    if len(packed) > POSTBACK_DATA_LIMIT:
+        _count("too_long")
+        return data
+    _count("attached")
+    return packed
+
+def unpack(data, user_id):
+    """
+    拆出 postback data 中的流程內容
+    返回: (原本的 data, 暫存作業 dict 或 None)
+    """
+    base, marker, rest = data.partition(_MARKER)
+    if not marker:
+        return data, None
+    try:
+        issued, signature, payload = rest.split(".", 2)
+        if not hmac.compare_digest(signature, _sign(user_id, base, issued, payload)):
+            raise ValueError("簽章不符")
+        if time.time() - int(issued, 16) * 60 > FLOW_CONTEXT_MAX_AGE:
+            raise ValueError("已過期")
+        compact = json.loads(payload)
+        temp_task = {_SHORT_FIELDS[short]: value for short, value in compact.items() if short in _SHORT_FIELDS}
+    except Exception as e:
+        print(f"[flow_context] 忽略無效的流程內容：{e}")
+        _count("rejected")
+        return base, None
+    _count("used")
+    return base, temp_task
+
+def attach_to_bubble(bubble, user_id, temp_task, targets):
+    """
+    將流程內容附加到 bubble 中的按鈕
+    targets 為要附加的 data（結尾為 "_" 者視為前綴），其餘按鈕（如取消）不變
+    """
+    if not is_enabled() or not temp_task:
+        return bubble
+
+    def matches(data):
+        return any(data.startswith(t) if t.endswith("_") else data == t for t in targets)
+
+    def walk(node):
+        if isinstance(node, dict):
+            action = node.get("action")
+            if isinstance(action, dict) and isinstance(action.get("data"), str) and matches(action["data"]):
+                action["data"] = pack(action["data"], user_id, temp_task)
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+
+    walk(bubble)
+    return bubble
+
+@contextmanager
+def scope(temp_task):
+    """處理一個 postback 期間，讓流程中的函式可以取得按鈕帶來的暫存作業"""
+    previous = getattr(_current, "temp_task", None)
+    _current.temp_task = temp_task
+    try:
+        yield
+    finally:
+        _current.temp_task = previous
+
+def current_temp_task():
+    temp_task = getattr(_current, "temp_task", None)
+    return dict(temp_task) if temp_task else None
+
+def get_flow_context_stats():
+    with _stats_lock:
+        return dict(_stats)
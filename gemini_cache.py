@@ -0,0 +1,140 @@
+# ==================== Gemini 回應快取 ====================
+# 以「正規化後的 prompt + 模型名稱 + 日期」的雜湊為鍵，相同的問法不再重複呼叫 API。
+# 第一層是程序內 LRU；設定 GEMINI_CACHE_DB 時會再加上一層 SQLite，重新部署後仍可命中。
+# 每種呼叫位置有各自的存活時間，排程這類與當下時間相關的結果不快取。
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import datetime
+import threading
+import unicodedata
+from collections import OrderedDict
+
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "2000"))
+GEMINI_CACHE_DB = os.getenv("GEMINI_CACHE_DB", "")  # SQLite 檔案路徑，留空則只用記憶體
+
+# call_site -> (存活秒數, 鍵是否包含今天日期)
+GEMINI_CACHE_POLICIES = {
+    "parse_task": (float(os.getenv("GEMINI_CACHE_TTL_PARSE", str(24 * 60 * 60))), True),
+    "parse_complete": (float(os.getenv("GEMINI_CACHE_TTL_PARSE", str(24 * 60 * 60))), False),
+    "extract": (float(os.getenv("GEMINI_CACHE_TTL_PARSE", str(24 * 60 * 60))), True),
+}
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+_memory = OrderedDict()  # key -> (expires_at, text)
+_lock = threading.Lock()
+_stats = {}  # call_site -> {"memory_hits", "db_hits", "misses"}
+_db = None
+_db_lock = threading.Lock()
+
+def _count(call_site, kind):
+    with _lock:
+        stats = _stats.setdefault(call_site, {"memory_hits": 0, "db_hits": 0, "misses": 0})
+        stats[kind] += 1
+
+def _get_db():
+    global _db
+    if not GEMINI_CACHE_DB:
+        return None
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                conn = sqlite3.connect(GEMINI_CACHE_DB, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS gemini_cache "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+                conn.execute("DELETE FROM gemini_cache WHERE expires_at <= ?", (time.time(),))
+                conn.commit()
+                _db = conn
+    return _db
+
+def normalize_prompt(prompt):
+    """統一全形 / 半形與空白，讓只差在排版的 prompt 得到相同的鍵"""
+    text = unicodedata.normalize("NFKC", prompt)
+    return _WHITESPACE_PATTERN.sub(" ", text).strip()
+
+def make_cache_key(call_site, prompt, model_name, system_instruction=""):
+    """回傳快取鍵；此呼叫位置不快取時回傳 None"""
+    policy = GEMINI_CACHE_POLICIES.get(call_site)
+    if not policy or policy[0] <= 0:
+        return None
+    date_context = ""
+    if policy[1]:
+        now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
+        date_context = now.strftime("%Y-%m-%d")
+    raw = "\x1f".join([call_site, model_name, normalize_prompt(system_instruction or ""),
+                       date_context, normalize_prompt(prompt)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def get_cached_response(call_site, key):
+    now = time.time()
+    with _lock:
+        entry = _memory.get(key)
+        if entry and entry[0] > now:
+            _memory.move_to_end(key)
+            text = entry[1]
+        else:
+            if entry:
+                del _memory[key]
+            text = None
+    if text is not None:
+        _count(call_site, "memory_hits")
+        return text
+
+    db = _get_db()
+    if db is not None:
+        try:
+            with _db_lock:
+                row = db.execute(
+                    "SELECT value, expires_at FROM gemini_cache WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+            if row:
+                _remember(key, row[0], row[1])
+                _count(call_site, "db_hits")
+                return row[0]
+        except sqlite3.Error as e:
+            print(f"[Gemini][cache] 讀取 SQLite 快取失敗：{e}")
+
+    _count(call_site, "misses")
+    return None
+
+def _remember(key, text, expires_at):
+    with _lock:
+        _memory[key] = (expires_at, text)
+        _memory.move_to_end(key)
+        while len(_memory) > GEMINI_CACHE_MAX_ENTRIES:
+            _memory.popitem(last=False)
+
+def store_response(call_site, key, text):
+    expires_at = time.time() + GEMINI_CACHE_POLICIES[call_site][0]
+    _remember(key, text, expires_at)
+
+    db = _get_db()
+    if db is not None:
+        try:
+            with _db_lock:
+                db.execute(
+                    "INSERT OR REPLACE INTO gemini_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, text, expires_at)
+                )
+                db.commit()
+        except sqlite3.Error as e:
+            print(f"[Gemini][cache] 寫入 SQLite 快取失敗：{e}")
+
+def get_response_cache_stats():
+    """各呼叫位置的命中次數與命中率"""
+    with _lock:
+        result = {}
+        for call_site, stats in _stats.items():
+            result[call_site] = dict(stats)
+            total = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+            hits = stats["memory_hits"] + stats["db_hits"]
+            result[call_site]["hit_rate"] = round(hits / total, 3) if total else 0.0
+        result["entries"] = len(_memory)
+    return result
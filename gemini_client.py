@@ -1,7 +1,11 @@
 import os
+import time
+import threading
 from dotenv import load_dotenv
 import google.generativeai as genai
 
+from gemini_cache import make_cache_key, get_cached_response, store_response
+
 load_dotenv()
 
 # 檢查 API KEY 是否存在
@@ -11,10 +15,22 @@ if not api_key:
 
 genai.configure(api_key=api_key)
 
-def call_gemini_schedule(prompt):
-    try:
-        # 使用更嚴格的系統指令
-        system_instruction = """
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "models/gemini-1.5-flash-latest")
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "5"))  # 等待並行名額的上限（秒）
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))  # 連續失敗幾次後斷路
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))  # 斷路後多久再試（秒）
+
+# 各呼叫位置的逾時秒數：解析要快，排程可以等久一點
+GEMINI_TIMEOUTS = {
+    "parse_task": float(os.getenv("GEMINI_TIMEOUT_PARSE", "12")),
+    "parse_complete": float(os.getenv("GEMINI_TIMEOUT_PARSE", "12")),
+    "extract": float(os.getenv("GEMINI_TIMEOUT_PARSE", "12")),
+    "schedule": float(os.getenv("GEMINI_TIMEOUT_SCHEDULE", "30")),
+}
+GEMINI_DEFAULT_TIMEOUT = 20.0
+
+SCHEDULE_SYSTEM_INSTRUCTION = """
 你是一個專業的時間管理助手。在生成排程時，你必須：
 1. 嚴格遵守使用者設定的可用時間限制
 2. 所有活動（包括作業、休息、用餐）的總時間必須完全等於可用時間，不可超過
@@ -22,20 +38,155 @@ def call_gemini_schedule(prompt):
 4. 每個時段都要標註持續時間（分鐘）
 5. 如果任務太多無法在時限內完成，要明確說明哪些任務無法安排
 """
-        
-        model = genai.GenerativeModel(
-            model_name="models/gemini-1.5-flash-latest",
-            system_instruction=system_instruction
-        )
-        
-        response = model.generate_content(prompt)
-        
+
+
+class GeminiUnavailableError(Exception):
+    """Gemini 暫時不可用（斷路中或並行名額已滿），呼叫端應改走備援流程"""
+
+
+class _CircuitBreaker:
+    """連續失敗達門檻後斷路，冷卻期間直接失敗；冷卻結束後只放一個試探請求"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                if self._opened_at is None or self._probing:
+                    print(f"[Gemini] 連續失敗 {self._failures} 次，暫停呼叫 {self.cooldown:.0f} 秒")
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    def cancel_probe(self):
+        """試探請求沒有真正送出（例如等不到並行名額），讓下一個請求再試"""
+        with self._lock:
+            self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if self._probing else "open"
+
+
+_models = {}
+_models_lock = threading.Lock()
+_semaphore = threading.BoundedSemaphore(max(1, GEMINI_MAX_CONCURRENCY))
+_breaker = _CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN)
+_metrics = {}  # call_site -> 統計
+_metrics_lock = threading.Lock()
+
+def _get_model(model_name, system_instruction):
+    """依 (模型名稱, 系統指令) 快取 GenerativeModel，避免每次呼叫都重建"""
+    key = (model_name, system_instruction)
+    model = _models.get(key)
+    if model is None:
+        with _models_lock:
+            model = _models.get(key)
+            if model is None:
+                model = genai.GenerativeModel(model_name=model_name, system_instruction=system_instruction)
+                _models[key] = model
+    return model
+
+def _record(call_site, outcome, elapsed_ms=0.0, response=None):
+    with _metrics_lock:
+        stats = _metrics.setdefault(call_site, {
+            "calls": 0, "failures": 0, "rejected": 0,
+            "total_ms": 0.0, "max_ms": 0.0,
+            "prompt_tokens": 0, "output_tokens": 0
+        })
+        if outcome == "rejected":
+            stats["rejected"] += 1
+            return
+        stats["calls"] += 1
+        stats["failures"] += 1 if outcome == "failure" else 0
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            stats["prompt_tokens"] += getattr(usage, "prompt_token_count", 0) or 0
+            stats["output_tokens"] += getattr(usage, "candidates_token_count", 0) or 0
+
+def call_gemini(prompt, call_site="schedule", system_instruction=SCHEDULE_SYSTEM_INSTRUCTION,
+                model_name=GEMINI_MODEL_NAME, timeout=None):
+    """
+    呼叫 Gemini 並回傳文字
+    call_site：呼叫位置（parse_task / parse_complete / extract / schedule），用於逾時設定與統計
+    斷路中或等不到並行名額時拋出 GeminiUnavailableError
+    相同的 prompt 會直接回傳快取結果（見 gemini_cache）
+    """
+    cache_key = make_cache_key(call_site, prompt, model_name, system_instruction)
+    if cache_key:
+        cached = get_cached_response(call_site, cache_key)
+        if cached is not None:
+            return cached
+
+    if not _breaker.allow():
+        _record(call_site, "rejected")
+        raise GeminiUnavailableError("Gemini 暫時不可用（斷路中）")
+
+    if not _semaphore.acquire(timeout=GEMINI_QUEUE_TIMEOUT):
+        _record(call_site, "rejected")
+        _breaker.cancel_probe()
+        raise GeminiUnavailableError("Gemini 呼叫過多，請稍後再試")
+
+    timeout = timeout or GEMINI_TIMEOUTS.get(call_site, GEMINI_DEFAULT_TIMEOUT)
+    started = time.perf_counter()
+    response = None
+    try:
+        model = _get_model(model_name, system_instruction)
+        response = model.generate_content(prompt, request_options={"timeout": timeout})
+
         # 檢查回應是否有效
         if not response or not response.text:
             raise Exception("Gemini API 回傳空白回應")
-            
-        return response.text.strip()
+
+        _breaker.record_success()
+        _record(call_site, "success", (time.perf_counter() - started) * 1000, response)
+        text = response.text.strip()
+        if cache_key:
+            store_response(call_site, cache_key, text)
+        return text
     except Exception as e:
-        print(f"[Gemini] API 呼叫失敗：{e}")
-        # 返回預設值或拋出異常
-        raise Exception(f"Gemini API 錯誤：{str(e)}")
\ No newline at end of file
+        _breaker.record_failure()
+        _record(call_site, "failure", (time.perf_counter() - started) * 1000, response)
+        print(f"[Gemini] {call_site} API 呼叫失敗：{e}")
+        raise Exception(f"Gemini API 錯誤：{str(e)}")
+    finally:
+        _semaphore.release()
+
+def call_gemini_schedule(prompt, call_site="schedule"):
+    return call_gemini(prompt, call_site=call_site)
+
+def get_gemini_stats():
+    """各呼叫位置的次數、失敗 / 拒絕數、平均與最大延遲（毫秒）及 token 用量"""
+    with _metrics_lock:
+        result = {}
+        for call_site, stats in _metrics.items():
+            result[call_site] = dict(stats)
+            result[call_site]["avg_ms"] = round(stats["total_ms"] / stats["calls"], 1) if stats["calls"] else 0.0
+    result["breaker_state"] = _breaker.state
+    return result
@@ -1,46 +1,202 @@
 from gemini_client import call_gemini_schedule
+from date_utils import parse_due_date
+import os
 import json
 import re
 import datetime
+import threading
 
-def classify_intent_by_gemini(text: str) -> str:
+# ==================== 本地意圖判斷（規則 + 字典樹） ====================
+# 常見指令在本地直接判斷，信心度不足時才交給 Gemini
+
+LOCAL_INTENT_THRESHOLD = float(os.getenv("LOCAL_INTENT_THRESHOLD", "0.8"))
+
+# 指令片語 -> 意圖
+INTENT_PHRASES = {
+    "add_task": [
+        "新增作業", "新增", "加作業", "增加作業", "新增任務", "記錄作業", "登記作業", "我要新增作業",
+    ],
+    "view_tasks": [
+        "查看作業", "查看", "我的作業", "作業列表", "看作業", "查作業", "列出作業", "所有作業",
+        "查看任務", "作業清單",
+    ],
+    "complete_task": [
+        "完成作業", "完成", "完成任務", "我要完成作業", "標記完成", "批次完成",
+    ],
+    "set_reminder": [
+        "提醒時間", "設定提醒", "提醒設定", "設定提醒時間", "修改提醒", "提醒",
+    ],
+    "clear_completed": [
+        "清除已完成", "清除已完成作業", "刪除已完成作業",
+    ],
+    "clear_expired": [
+        "清除已截止", "清除已截止作業", "清除過期作業", "清除已過期作業",
+    ],
+    "clear_tasks": [
+        "清除作業", "清除", "刪除作業", "清理作業",
+    ],
+    "show_schedule": [
+        "排程", "今日排程", "今天排程", "安排時間", "幫我排程", "排行程",
+    ],
+}
+
+# 句首/句尾常見的無意義語氣詞
+_FILLER_PATTERN = re.compile(r"^(請|幫我|我想要|我要|我想|麻煩)+|(吧|啦|喔|哦|一下|了)+$")
+_PUNCT_PATTERN = re.compile(r"[\s，。！？!?,.~～、]+")
+
+# 自然語言完成作業：「我完成作業系統了」「作業系統寫完了」
+_COMPLETE_NATURAL_PATTERNS = [
+    re.compile(r"^(我)?(已經|剛剛|剛)?(完成|做完|寫完|交了|交完|弄完)(了)?(.{2,})$"),
+    re.compile(r"^(.{2,}?)(已經|剛剛)?(完成|做完|寫完|交了|交完|弄完)(了)?$"),
+]
+
+# 自然語言新增作業：包含截止時間描述 + 作業相關動詞
+_DUE_HINT_PATTERN = re.compile(
+    r"(今天|明天|後天|大後天|下[週周禮拜星期]|[這本][週周禮拜星期]|[週周]|禮拜|星期|\d+天後|[一二三四五六七八九十兩\d]+天後|\d+月\d+[日號])"
+)
+# 必須有明確的新增動詞，只提到「作業」「考試」的句子（如「今天的作業」）不算
+_ADD_HINT_PATTERN = re.compile(r"(新增|加入|記錄|登記|要交|截止|繳交|交作業|要寫|要做|要讀|要準備)")
+# 詢問 / 查看類的句子（「這週作業有哪些」「明天有考試嗎」）不會是新增
+_QUESTION_PATTERN = re.compile(r"(查看|查詢|看看|列出|有哪些|哪些|什麼|甚麼|幾個|多少|嗎|呢|？|\?)")
+# 否定語氣的提醒指令（「取消提醒」）交給 Gemini，不直接進入提醒設定
+_NEGATION_PATTERN = re.compile(r"(取消|關閉|關掉|停止|不要)")
+
+
+class _PhraseTrie:
+    """中文指令片語字典樹，從任意位置找出最長的片語"""
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, phrase, intent):
+        node = self.root
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node["$"] = intent
+
+    def longest_match(self, text):
+        """回傳 (片語, 意圖)，找不到則回傳 (None, None)"""
+        best_phrase, best_intent = None, None
+        for start in range(len(text)):
+            node = self.root
+            for end in range(start, len(text)):
+                node = node.get(text[end])
+                if node is None:
+                    break
+                if "$" in node and (best_phrase is None or end - start + 1 > len(best_phrase)):
+                    best_phrase, best_intent = text[start:end + 1], node["$"]
+        return best_phrase, best_intent
+
+
+_PHRASE_TRIE = _PhraseTrie()
+_EXACT_PHRASES = {}
+for _intent, _phrases in INTENT_PHRASES.items():
+    for _phrase in _phrases:
+        _PHRASE_TRIE.insert(_phrase, _intent)
+        _EXACT_PHRASES[_phrase] = _intent
+
+VALID_INTENTS = {
+    "add_task_natural", "complete_task_natural", "add_task", "view_tasks",
+    "complete_task", "set_reminder", "clear_completed", "clear_expired",
+    "clear_tasks", "show_schedule", "unknown"
+}
+
+_intent_stats = {"local": 0, "gemini": 0, "fallback": 0}
+_intent_stats_lock = threading.Lock()
+
+
+def _normalize_command(text: str) -> str:
+    text = _PUNCT_PATTERN.sub("", text or "")
+    return _FILLER_PATTERN.sub("", text) or text
+
+
+def classify_intent_locally(text: str):
     """
-    使用 Gemini 判斷使用者意圖
+    以規則判斷意圖
+    返回: (intent, confidence)，無法判斷時 intent 為 None
     """
-    prompt = f"""
-你是一個 LINE Bot 的語意理解助手，請閱讀使用者輸入的一句話，判斷它想要執行哪一個功能。
+    raw = _PUNCT_PATTERN.sub("", text or "")
+    if not raw:
+        return None, 0.0
 
-判斷規則：
-1. 如果句子中包含新增作業的內容（例如：提到作業名稱、截止日期、時間等），回傳 add_task_natural
-2. 如果句子中明確提到要完成某個作業，回傳 complete_task_natural
-3. 其他情況按照原有規則判斷
+    normalized = _normalize_command(raw)
 
-請只回傳以下其中之一（只回傳 intent 代號，不要加句子）：
-- add_task_natural：自然語言新增作業（句子包含作業資訊）
-- complete_task_natural：自然語言完成作業（明確提到要完成某作業）
-- add_task：新增作業（一般指令）
-- view_tasks：查看作業
-- complete_task：完成作業（一般指令）
-- set_reminder：設定提醒時間
-- clear_completed：清除已完成作業
-- clear_expired：清除已截止作業
-- clear_tasks：清除作業（包含已完成或已過期）
-- show_schedule：查看今日排程
-- unknown：無法辨識的指令
+    # 1. 完全符合指令片語
+    if raw in _EXACT_PHRASES:
+        return _EXACT_PHRASES[raw], 1.0
+    if normalized in _EXACT_PHRASES:
+        return _EXACT_PHRASES[normalized], 0.95
 
-使用者輸入的句子是：
-「{text}」
+    # 2. 自然語言完成作業
+    for pattern in _COMPLETE_NATURAL_PATTERNS:
+        if pattern.match(normalized):
+            phrase, _ = _PHRASE_TRIE.longest_match(normalized)
+            # 「完成作業」這類一般指令已在上面處理，其餘視為指定作業
+            if phrase != normalized:
+                return "complete_task_natural", 0.85
 
-請回覆：
-"""
+    # 3. 自然語言新增作業（有截止時間描述）
+    is_question = bool(_QUESTION_PATTERN.search(text))
+    if _DUE_HINT_PATTERN.search(raw) and _ADD_HINT_PATTERN.search(raw) and not is_question:
+        return "add_task_natural", 0.85
 
-    result = call_gemini_schedule(prompt).lower().strip()
-    valid_intents = {
-        "add_task_natural", "complete_task_natural", "add_task", "view_tasks", 
-        "complete_task", "set_reminder", "clear_completed", "clear_expired", 
-        "clear_tasks", "show_schedule", "unknown"
-    }
-    return result if result in valid_intents else "unknown"
+    # 4. 句子中包含指令片語，且多餘的字很少
+    phrase, intent = _PHRASE_TRIE.longest_match(normalized)
+    if intent == "set_reminder" and _NEGATION_PATTERN.search(raw):
+        return None, 0.0
+    if phrase:
+        extra = len(normalized) - len(phrase)
+        if extra <= 2:
+            return intent, 0.85
+        if extra <= 4:
+            return intent, 0.6
+        return intent, 0.3
+
+    return None, 0.0
+
+
+def classify_and_extract(text: str, tasks: list):
+    """
+    判斷意圖並一併取出所需欄位：本地規則優先，信心度不足時只呼叫一次 Gemini
+    返回: (intent, path, extraction)
+    extraction 只有走 Gemini 時才有值，格式見 extract_intent_and_entities
+    """
+    intent, confidence = classify_intent_locally(text)
+    extraction = None
+    if intent and confidence >= LOCAL_INTENT_THRESHOLD:
+        path = "local"
+    else:
+        try:
+            extraction = extract_intent_and_entities(text, tasks)
+            intent = extraction["intent"]
+            path = "gemini"
+        except Exception as e:
+            print(f"[intent] Gemini 無法使用，改用本地判斷：{e}")
+            intent = intent or "unknown"
+            path = "fallback"
+
+    with _intent_stats_lock:
+        _intent_stats[path] += 1
+    return intent, path, extraction
+
+
+def get_intent_stats():
+    """獲取意圖判斷走本地或 Gemini 的次數"""
+    with _intent_stats_lock:
+        stats = dict(_intent_stats)
+    total = stats["local"] + stats["gemini"] + stats["fallback"]
+    stats["local_ratio"] = round(stats["local"] / total, 3) if total else 0.0
+    return stats
+
+def _mark_ai_filled(data: dict, local_due: str = None) -> dict:
+    """
+    標記哪些欄位需要由 AI 自動填寫（使用者沒有提到）
+    local_due：本地已解析出的截止日，優先於模型的結果
+    """
+    if local_due:
+        data["due"] = local_due
+    data["ai_filled"] = [field for field in ("estimated_time", "category", "due") if data.get(field) is None]
+    return data
 
 def parse_task_info_from_text(text: str) -> dict:
     """
@@ -49,17 +205,14 @@ def parse_task_info_from_text(text: str) -> dict:
     # 獲取今天的日期作為基準
     today = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
     today_str = today.strftime("%Y-%m-%d")
-    
-    prompt = f"""
-你是一個 LINE Bot，負責從使用者輸入的自然語言句子中抽取新增作業所需的資訊。
-
-今天的日期是：{today_str}
 
-請將以下資訊解析為 JSON 格式：
-- task：作業名稱（必填，從句子中抽取）
-- estimated_time：預估花費時間（單位：小時，數字格式，如果沒提到就設為 null）
-- category：任務類型（從句子推斷，如：閱讀、寫作、程式、計算、報告、實驗、練習、研究等，如果無法推斷就設為 null）
-- due：截止日期（格式為 YYYY-MM-DD，如果沒提到就設為 null）
+    # 截止日能在本地解析就直接告訴模型，不需要再讓模型推算日期
+    local_due, _ = parse_due_date(text, today.date())
+    if local_due:
+        due_rules = f"""- due：截止日期，已確定為 "{local_due}"，請直接填入
+"""
+    else:
+        due_rules = """- due：截止日期（格式為 YYYY-MM-DD，如果沒提到就設為 null）
 
 時間轉換規則：
 - "明天" = 今天日期+1天
@@ -68,7 +221,18 @@ def parse_task_info_from_text(text: str) -> dict:
 - "這週五"、"本週五" = 找到本週的週五
 - "X天後" = 今天日期+X天
 - "X月X日" = 今年的該日期（如果已過，則為明年）
+"""
+
+    prompt = f"""
+你是一個 LINE Bot，負責從使用者輸入的自然語言句子中抽取新增作業所需的資訊。
+
+今天的日期是：{today_str}
 
+請將以下資訊解析為 JSON 格式：
+- task：作業名稱（必填，從句子中抽取）
+- estimated_time：預估花費時間（單位：小時，數字格式，如果沒提到就設為 null）
+- category：任務類型（從句子推斷，如：閱讀、寫作、程式、計算、報告、實驗、練習、研究等，如果無法推斷就設為 null）
+{due_rules}
 範例輸入：「下周一要交作業系統，大概花三小時來寫作業」
 預期輸出：{{"task": "作業系統", "estimated_time": 3, "category": "寫作", "due": "2025-06-02"}}
 
@@ -78,61 +242,35 @@ def parse_task_info_from_text(text: str) -> dict:
 請回傳 JSON（確保是有效的 JSON 格式）：
 """
     
+    response = ""
     try:
-        response = call_gemini_schedule(prompt)
+        response = call_gemini_schedule(prompt, call_site="parse_task")
         # 嘗試直接解析
         data = json.loads(response)
+        return _mark_ai_filled(data, local_due)
         
-        # 標記哪些欄位是 AI 自動填寫的
-        ai_filled = []
-        if data.get("estimated_time") is None:
-            ai_filled.append("estimated_time")
-        if data.get("category") is None:
-            ai_filled.append("category")
-        if data.get("due") is None:
-            ai_filled.append("due")
-            
-        data["ai_filled"] = ai_filled
-        return data
-        
-    except Exception as e:
+    except Exception:
         # 嘗試從回應中提取 JSON
         match = re.search(r'\{.*\}', response, re.DOTALL)
         if match:
             try:
                 data = json.loads(match.group(0))
-                
-                # 標記 AI 填寫的欄位
-                ai_filled = []
-                if data.get("estimated_time") is None:
-                    ai_filled.append("estimated_time")
-                if data.get("category") is None:
-                    ai_filled.append("category")
-                if data.get("due") is None:
-                    ai_filled.append("due")
-                    
-                data["ai_filled"] = ai_filled
-                return data
+                return _mark_ai_filled(data, local_due)
             except:
                 pass
                 
         print(f"[錯誤] 解析 Gemini 回傳 JSON 失敗：{response}")
         return None
 
-def parse_complete_task_from_text(text: str, tasks: list) -> dict:
+def parse_complete_task_from_text(text: str, tasks: list, candidate_indices: list = None) -> dict:
     """
     從自然語言中解析要完成的作業
+    candidate_indices：只在這些作業之間選擇（本地比對平手時）
     """
     # 準備作業列表資訊
-    task_list = []
-    for i, task in enumerate(tasks):
-        if not task.get("done", False):
-            task_list.append({
-                "index": i,
-                "name": task.get("task", "未命名"),
-                "category": task.get("category", "未分類"),
-                "due": task.get("due", "未設定")
-            })
+    task_list = _pending_task_list(tasks)
+    if candidate_indices is not None:
+        task_list = [task for task in task_list if task["index"] in candidate_indices]
     
     prompt = f"""
 你是一個 LINE Bot，負責從使用者輸入的句子中判斷他想要完成哪個作業。
@@ -154,11 +292,12 @@ def parse_complete_task_from_text(text: str, tasks: list) -> dict:
 請回傳 JSON：
 """
     
+    response = ""
     try:
-        response = call_gemini_schedule(prompt)
+        response = call_gemini_schedule(prompt, call_site="parse_complete")
         data = json.loads(response)
         return data
-    except Exception as e:
+    except Exception:
         match = re.search(r'\{.*\}', response, re.DOTALL)
         if match:
             try:
@@ -167,4 +306,148 @@ def parse_complete_task_from_text(text: str, tasks: list) -> dict:
                 pass
                 
         print(f"[錯誤] 解析完成作業失敗：{response}")
-        return None
\ No newline at end of file
+        return None
+
+def _pending_task_list(tasks: list) -> list:
+    return [
+        {
+            "index": i,
+            "name": task.get("task", "未命名"),
+            "category": task.get("category", "未分類"),
+            "due": task.get("due", "未設定")
+        }
+        for i, task in enumerate(tasks)
+        if not task.get("done", False)
+    ]
+
+def _validate_add_fields(data, local_due: str = None) -> dict:
+    """檢查新增作業欄位，格式不符的欄位視為沒提到；沒有作業名稱則回傳 None"""
+    if not isinstance(data, dict):
+        return None
+    name = data.get("task")
+    if not isinstance(name, str) or not name.strip():
+        return None
+
+    estimated_time = data.get("estimated_time")
+    try:
+        estimated_time = float(estimated_time) if estimated_time is not None else None
+        if estimated_time is not None and not 0 < estimated_time <= 24:
+            estimated_time = None
+    except (TypeError, ValueError):
+        estimated_time = None
+
+    category = data.get("category")
+    if not isinstance(category, str) or not category.strip():
+        category = None
+
+    due = data.get("due")
+    try:
+        due = datetime.datetime.strptime(due, "%Y-%m-%d").strftime("%Y-%m-%d") if due else None
+    except (TypeError, ValueError):
+        due = None
+
+    return _mark_ai_filled({
+        "task": name.strip(),
+        "estimated_time": estimated_time,
+        "category": category,
+        "due": due
+    }, local_due)
+
+def _validate_complete_fields(data, tasks: list) -> dict:
+    """檢查完成作業欄位，索引必須指向未完成的作業"""
+    if not isinstance(data, dict):
+        return None
+    task_index = data.get("task_index")
+    if isinstance(task_index, bool) or not isinstance(task_index, (int, float)) or int(task_index) != task_index:
+        return None
+    task_index = int(task_index)
+    if not 0 <= task_index < len(tasks) or tasks[task_index].get("done", False):
+        return None
+    try:
+        confidence = min(max(float(data.get("confidence", 0)), 0.0), 1.0)
+    except (TypeError, ValueError):
+        confidence = 0.0
+    return {
+        "task_index": task_index,
+        "task_name": tasks[task_index].get("task", "未命名"),
+        "confidence": confidence,
+        "reason": str(data.get("reason") or "")
+    }
+
+def extract_intent_and_entities(text: str, tasks: list) -> dict:
+    """
+    以一次 Gemini 呼叫同時判斷意圖並抽取欄位
+    返回: {"intent": str, "add": dict 或 None, "complete": dict 或 None}
+    add 的格式與 parse_task_info_from_text 相同，complete 的格式與 parse_complete_task_from_text 相同；
+    欄位未通過檢查時為 None，呼叫端可再改用個別的解析函數
+    Gemini 呼叫失敗時拋出例外
+    """
+    today = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
+    today_str = today.strftime("%Y-%m-%d")
+    local_due, _ = parse_due_date(text, today.date())
+    if local_due:
+        due_rule = f"- due：截止日期，已確定為 \"{local_due}\"，請直接填入"
+    else:
+        due_rule = "- due：截止日期（YYYY-MM-DD，沒提到就設為 null；「明天」「下週一」「X天後」等請依今天日期換算）"
+
+    prompt = f"""
+你是一個 LINE Bot 的語意理解助手，請判斷使用者這句話想執行的功能，並抽取需要的資訊。
+
+今天的日期是：{today_str}
+
+可選的 intent：
+- add_task_natural：用自然語言描述要新增的作業（包含作業名稱，可能有時間、截止日）
+- complete_task_natural：用自然語言表示完成了某個作業
+- add_task：新增作業（一般指令）
+- view_tasks：查看作業
+- complete_task：完成作業（一般指令）
+- set_reminder：設定提醒時間
+- clear_completed：清除已完成作業
+- clear_expired：清除已截止作業
+- clear_tasks：清除作業（包含已完成或已過期）
+- show_schedule：查看今日排程
+- unknown：無法辨識的指令
+
+當 intent 是 add_task_natural 時，填寫 add：
+- task：作業名稱
+- estimated_time：預估花費時間（小時，數字，沒提到就設為 null）
+- category：任務類型（如：閱讀、寫作、程式、計算、報告、實驗、練習、研究等，無法推斷就設為 null）
+{due_rule}
+
+當 intent 是 complete_task_natural 時，從以下未完成作業中找出最符合的一個，填寫 complete：
+{json.dumps(_pending_task_list(tasks), ensure_ascii=False)}
+- task_index：作業的 index
+- confidence：信心度（0-1，找不到明確符合的作業就設為 0）
+- reason：選擇的原因
+
+其他情況 add 與 complete 都設為 null。
+
+使用者輸入：
+「{text}」
+
+只回傳一個 JSON，格式為：
+{{"intent": "...", "add": {{...}} 或 null, "complete": {{...}} 或 null}}
+"""
+
+    response = call_gemini_schedule(prompt, call_site="extract")
+    try:
+        data = json.loads(response)
+    except ValueError:
+        match = re.search(r'\{.*\}', response, re.DOTALL)
+        try:
+            data = json.loads(match.group(0)) if match else {}
+        except ValueError:
+            data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    intent = str(data.get("intent") or "").lower().strip()
+    if intent not in VALID_INTENTS:
+        print(f"[錯誤] 合併解析回傳無效的意圖：{response}")
+        intent = "unknown"
+
+    return {
+        "intent": intent,
+        "add": _validate_add_fields(data.get("add"), local_due) if intent == "add_task_natural" else None,
+        "complete": _validate_complete_fields(data.get("complete"), tasks) if intent == "complete_task_natural" else None
+    }
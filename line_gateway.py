@@ -0,0 +1,94 @@
+# ==================== LINE 訊息發送閘道 ====================
+# 所有 reply / push / multicast / profile 呼叫都經過這裡：
+# - 整個程序共用一個 ApiClient（urllib3 連線池，保持 keep-alive），不再每次回覆都重建 TLS 連線
+# - gunicorn fork 之後會在子程序重新建立連線池，不會共用父程序的 socket
+# - 每次呼叫都記錄耗時，超過 LINE_SLOW_CALL_MS 會印出警告
+
+import os
+import time
+import uuid
+import threading
+
+from linebot.v3.messaging import (
+    MessagingApi, ApiClient, Configuration,
+    ReplyMessageRequest, PushMessageRequest, MulticastRequest
+)
+
+LINE_HTTP_POOL_SIZE = int(os.getenv("LINE_HTTP_POOL_SIZE", "16"))
+LINE_SLOW_CALL_MS = float(os.getenv("LINE_SLOW_CALL_MS", "1000"))
+
+_client_lock = threading.Lock()
+_client_pid = None
+_api_client = None
+_messaging_api = None
+
+_call_stats = {}  # op -> {"calls", "errors", "total_ms", "max_ms"}
+_stats_lock = threading.Lock()
+
+def get_messaging_api():
+    """取得程序共用的 MessagingApi（fork 後自動重建）"""
+    global _client_pid, _api_client, _messaging_api
+    if _client_pid == os.getpid():
+        return _messaging_api
+    with _client_lock:
+        if _client_pid != os.getpid():
+            configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+            configuration.connection_pool_maxsize = LINE_HTTP_POOL_SIZE
+            _api_client = ApiClient(configuration)
+            _messaging_api = MessagingApi(_api_client)
+            _client_pid = os.getpid()
+        return _messaging_api
+
+def _timed(op, func):
+    started = time.perf_counter()
+    failed = False
+    try:
+        return func()
+    except Exception:
+        failed = True
+        raise
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with _stats_lock:
+            stats = _call_stats.setdefault(op, {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["calls"] += 1
+            stats["errors"] += 1 if failed else 0
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        if elapsed_ms >= LINE_SLOW_CALL_MS:
+            print(f"[line] {op} 耗時 {elapsed_ms:.0f}ms")
+
+def _as_list(messages):
+    return messages if isinstance(messages, list) else [messages]
+
+def reply(reply_token, messages):
+    """以 reply token 回覆訊息，messages 可為單一訊息或列表"""
+    request = ReplyMessageRequest(reply_token=reply_token, messages=_as_list(messages))
+    return _timed("reply", lambda: get_messaging_api().reply_message(request))
+
+def push(user_id, messages, retry_key=None):
+    """
+    主動推播給單一用戶，retry_key 會帶入 X-Line-Retry-Key
+    未提供時自動產生，讓每一次推播都帶有 retry key（重試時應沿用同一個）
+    """
+    retry_key = retry_key or str(uuid.uuid4())
+    request = PushMessageRequest(to=user_id, messages=_as_list(messages))
+    return _timed("push", lambda: get_messaging_api().push_message(request, x_line_retry_key=retry_key))
+
+def multicast(user_ids, messages, retry_key=None):
+    """推播相同訊息給多位用戶（一次最多 500 人），retry_key 規則與 push 相同"""
+    retry_key = retry_key or str(uuid.uuid4())
+    request = MulticastRequest(to=list(user_ids), messages=_as_list(messages))
+    return _timed("multicast", lambda: get_messaging_api().multicast(request, x_line_retry_key=retry_key))
+
+def get_profile(user_id):
+    return _timed("get_profile", lambda: get_messaging_api().get_profile(user_id))
+
+def get_gateway_stats():
+    """各類呼叫的次數、錯誤數與平均 / 最大耗時（毫秒）"""
+    with _stats_lock:
+        result = {}
+        for op, stats in _call_stats.items():
+            result[op] = dict(stats)
+            result[op]["avg_ms"] = round(stats["total_ms"] / stats["calls"], 1) if stats["calls"] else 0.0
+    return result
@@ -1,13 +1,11 @@
-import os
 import datetime
 import re
 
 from add_task_flow_manager import AddTaskFlowManager
 from complete_task_flow_manager import CompleteTaskFlowManager
 from firebase_utils import (
-    load_data, save_data, set_user_state, get_user_state,
-    clear_user_state, set_temp_task, get_temp_task, clear_temp_task,
-    get_task_history, update_task_history, add_task
+    load_data, get_user_state, clear_user_state, clear_temp_task,
+    ensure_remind_index
 )
 from postback_handler import (
     handle_add_task,
@@ -16,16 +14,21 @@ from postback_handler import (
     handle_set_remind_time,
     handle_clear_tasks
 )
-from intent_utils import classify_intent_by_gemini, parse_task_info_from_text
+from intent_utils import classify_and_extract, classify_intent_locally, parse_task_info_from_text, LOCAL_INTENT_THRESHOLD
 from flex_utils import make_optimized_schedule_card, extract_schedule_blocks
-from firebase_admin import db
 from gemini_client import call_gemini_schedule
-from scheduler import generate_optimized_schedule_prompt
+from scheduler import (
+    generate_optimized_schedule_prompt,
+    build_local_schedule,
+    describe_local_schedule,
+    generate_schedule_explanation_prompt,
+    SCHEDULE_MODE
+)
 from linebot.v3.webhook import MessageEvent
-from linebot.v3.messaging import MessagingApi, ReplyMessageRequest, ApiClient, Configuration
+from linebot.v3.webhooks import FollowEvent
 from linebot.v3.messaging.models import TextMessage, FlexMessage, FlexContainer
-
-configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+import line_gateway
+from profile_cache import invalidate_display_name
 
 # 更新訊息處理器中的狀態處理函數
 def handle_task_name_input(user_id: str, text: str, reply_token: str):
@@ -40,7 +43,70 @@ def handle_task_type_input(user_id: str, text: str, reply_token: str):
     """使用新的統一處理"""
     AddTaskFlowManager.handle_manual_type_input(user_id, text, reply_token)
 
+def handle_task_due_input(user_id: str, text: str, reply_token: str):
+    """以本地日期解析處理手動輸入的截止日"""
+    AddTaskFlowManager.handle_manual_due_input(user_id, text, reply_token)
+
+# 多輪流程中等待文字輸入的狀態 -> 處理函數
+FLOW_STATE_HANDLERS = {
+    "awaiting_task_name": handle_task_name_input,
+    "awaiting_task_time": handle_estimated_time_input,
+    "awaiting_task_type": handle_task_type_input,
+    "awaiting_task_due": handle_task_due_input,
+}
+
+# 使用者想中止目前流程時常用的說法
+FLOW_CANCEL_WORDS = {"取消", "算了", "不要了", "停止", "離開", "結束", "cancel"}
+
+def detect_flow_escape(text):
+    """
+    判斷流程中的輸入是否為「跳出流程」
+    返回: "cancel"（取消流程）、"command"（改執行其他指令）或 None（屬於流程輸入）
+    """
+    if text.lower() in FLOW_CANCEL_WORDS:
+        return "cancel"
+    # 本地規則能明確判斷的意圖（與快速路徑同一門檻）都視為跳出；
+    # 作業名稱、時間、日期等流程輸入不會命中任何規則
+    _, confidence = classify_intent_locally(text)
+    if confidence >= LOCAL_INTENT_THRESHOLD:
+        return "command"
+    return None
+
+def dispatch_flow_input(user_id, state, text, reply_token):
+    """
+    依照使用者目前的流程狀態直接處理輸入，不經過意圖判斷
+    返回: True 表示已處理
+    """
+    if state not in FLOW_STATE_HANDLERS and state != "awaiting_available_hours":
+        return False
+
+    escape = detect_flow_escape(text)
+    if escape == "cancel":
+        if state == "awaiting_available_hours":
+            clear_user_state(user_id)
+            line_gateway.reply(reply_token, [TextMessage(text="❌ 已取消排程設定")])
+        else:
+            AddTaskFlowManager.cancel_add_task(user_id, reply_token)
+        return True
+    if escape == "command":
+        # 跳出流程，改由一般指令處理
+        clear_user_state(user_id)
+        if state in FLOW_STATE_HANDLERS:
+            clear_temp_task(user_id)
+        return False
+
+    if state == "awaiting_available_hours":
+        handle_available_hours_input(user_id, text, reply_token)
+    else:
+        FLOW_STATE_HANDLERS[state](user_id, text, reply_token)
+    return True
+
 def register_message_handlers(handler):
+    @handler.add(FollowEvent)
+    def handle_follow(event):
+        # 加入或解除封鎖：名稱可能已變更，先前封鎖時的負向快取也不再適用
+        invalidate_display_name(event.source.user_id)
+
     @handler.add(MessageEvent)
     def handle_message(event):
 
@@ -50,8 +116,15 @@ def register_message_handlers(handler):
             return
 
         text = event.message.text.strip()
+        ensure_remind_index(user_id)
         state = get_user_state(user_id) 
 
+        # 1. 正在進行多輪流程時，先依狀態處理，略過意圖判斷
+        if state and text not in ("今日排程", "操作", "使用說明"):
+            if dispatch_flow_input(user_id, state, text, event.reply_token):
+                return
+
+        # 2. 固定指令
         if text == "今日排程":
             handle_show_schedule(user_id, event.reply_token)
             return
@@ -106,30 +179,28 @@ def register_message_handlers(handler):
                 }
             }
 
-            with ApiClient(configuration) as api_client:
-                messaging_api = MessagingApi(api_client)
-                messaging_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            FlexMessage(
-                                alt_text="操作",
-                                contents=FlexContainer.from_dict(bubble)
-                            )
-                        ]
+            line_gateway.reply(
+                event.reply_token,
+                [
+                    FlexMessage(
+                        alt_text="操作",
+                        contents=FlexContainer.from_dict(bubble)
                     )
-                )
+                ]
+            )
             return
         
         elif text == "使用說明":
             handle_user_guide(user_id, event.reply_token)
             return
 
-        intent = classify_intent_by_gemini(text)
+        # 3. 意圖判斷
+        intent, intent_path, extraction = classify_and_extract(text, load_data(user_id))
+        print(f"[intent] user={user_id}, intent={intent}, path={intent_path}")
         # 處理自然語言新增作業
         if intent == "add_task_natural":
-            # 解析作業資訊
-            task_info = parse_task_info_from_text(text)
+            # 解析作業資訊（合併解析已取得就不再呼叫 Gemini）
+            task_info = (extraction or {}).get("add") or parse_task_info_from_text(text)
             if task_info:
                 AddTaskFlowManager.handle_natural_language_add_task(user_id, text, event.reply_token, task_info)
             else:
@@ -139,7 +210,9 @@ def register_message_handlers(handler):
         
         # 處理自然語言完成作業
         elif intent == "complete_task_natural":
-            CompleteTaskFlowManager.handle_natural_language_complete_task(user_id, text, event.reply_token)
+            CompleteTaskFlowManager.handle_natural_language_complete_task(
+                user_id, text, event.reply_token, (extraction or {}).get("complete")
+            )
             return
         
                 # 如果沒有匹配到任何處理邏輯，可以給個預設回應
@@ -158,33 +231,17 @@ def register_message_handlers(handler):
         elif intent in ["clear_completed", "clear_expired", "clear_tasks"]:
             handle_clear_tasks(user_id, event.reply_token)
             return
-
-        # ============= 修復區域：處理用戶狀態 =============
-        # 如果用戶正在進行新增作業流程，優先處理狀態相關的輸入
-        if state == "awaiting_task_name":
-            handle_task_name_input(user_id, text, event.reply_token)
-            return
-        elif state == "awaiting_task_time":
-            handle_estimated_time_input(user_id, text, event.reply_token)
-            return
-        elif state == "awaiting_task_type":
-            handle_task_type_input(user_id, text, event.reply_token)
-            return
-        elif state == "awaiting_available_hours":
-            handle_available_hours_input(user_id, text, event.reply_token)
+        elif intent == "show_schedule":
+            handle_show_schedule(user_id, event.reply_token)
             return
-        # ===============================================
-
-        if not state and not intent:
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            TextMessage(text="😊 您好！我可以幫您管理作業。\n\n💡 您可以直接說：\n• 「下週一要交作業系統，大概花三小時」\n• 「我要完成作業系統」\n• 「查看作業」\n\n或輸入「操作」查看所有功能")
-                        ]
-                    )
-                )
+
+        if intent in (None, "unknown"):
+            line_gateway.reply(
+                event.reply_token,
+                [
+                    TextMessage(text="😊 您好！我可以幫您管理作業。\n\n💡 您可以直接說：\n• 「下週一要交作業系統，大概花三小時」\n• 「我要完成作業系統」\n• 「查看作業」\n\n或輸入「操作」查看所有功能")
+                ]
+            )
 
 def generate_schedule_for_user(user_id, available_hours):
     """根據使用者可用時間生成優化的排程"""
@@ -212,6 +269,10 @@ def generate_schedule_for_user(user_id, available_hours):
                 return 999
         
         pending_tasks.sort(key=task_priority)
+
+        # 本地排程引擎：不需等待 Gemini，毫秒內完成
+        if SCHEDULE_MODE in ("local", "hybrid"):
+            return generate_local_schedule_messages(pending_tasks, available_hours)
         
         # 獲取使用者習慣（可以從歷史資料分析）
         habits = analyze_user_habits(user_id)
@@ -273,6 +334,33 @@ def generate_schedule_for_user(user_id, available_hours):
         print(f"生成排程時發生錯誤：{str(e)}")
         return [TextMessage(text="抱歉，生成排程時發生錯誤，請稍後再試。")]
 
+def generate_local_schedule_messages(pending_tasks, available_hours):
+    """
+    使用本地排程引擎產生排程訊息
+    hybrid 模式下只請 Gemini 撰寫說明文字，失敗時改用本地說明
+    """
+    blocks, unscheduled = build_local_schedule(pending_tasks, available_hours)
+    total_hours = sum(int(block['duration'].replace('分鐘', '')) for block in blocks) / 60
+
+    summary = None
+    if SCHEDULE_MODE == "hybrid" and blocks:
+        try:
+            summary = call_gemini_schedule(
+                generate_schedule_explanation_prompt(blocks, unscheduled, available_hours)
+            )
+        except Exception as e:
+            print(f"[排程] Gemini 說明生成失敗，改用本地說明：{e}")
+
+    explanation = describe_local_schedule(blocks, unscheduled, available_hours, summary)
+    messages = [TextMessage(text=explanation)]
+    schedule_card = make_optimized_schedule_card(blocks, total_hours, available_hours, pending_tasks)
+    if schedule_card:
+        messages.append(FlexMessage(
+            alt_text="📅 今日最佳排程",
+            contents=FlexContainer.from_dict(schedule_card)
+        ))
+    return messages
+
 def adjust_schedule_to_fit(blocks, available_hours):
     """
     調整排程以符合可用時間限制
@@ -508,24 +596,12 @@ def handle_available_hours_input(user_id: str, text: str, reply_token: str):
         # 生成排程
         response = generate_schedule_for_user(user_id, hours)
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=response if isinstance(response, list) else [TextMessage(text=response)]
-                )
-            )
+        line_gateway.reply(reply_token, response if isinstance(response, list) else [TextMessage(text=response)])
     except ValueError:
         # 無法解析或超出範圍
         error_message = "❌ 請輸入有效的時間（0-24小時）\n\n支援格式：\n• 數字：4、4.5\n• 中文：四小時、三小時半\n• 混合：4小時、3.5小時"
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=error_message)]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text=error_message)])
 
 def handle_user_guide(user_id, reply_token):
     """顯示使用說明"""
@@ -743,13 +819,10 @@ def handle_user_guide(user_id, reply_token):
         }
     }
     
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[FlexMessage(
-                    alt_text="使用說明",
-                    contents=FlexContainer.from_dict(bubble)
-                )]
-            )
-        )
\ No newline at end of file
+    line_gateway.reply(
+        reply_token,
+        [FlexMessage(
+            alt_text="使用說明",
+            contents=FlexContainer.from_dict(bubble)
+        )]
+    )
\ No newline at end of file
@@ -1,10 +1,6 @@
 # line_utils.py
-import os
-from linebot.v3.messaging import MessagingApi, ApiClient, Configuration
+from profile_cache import get_display_name
 
-configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
-
-def get_line_display_name(user_id):
-    with ApiClient(configuration) as api_client:
-        profile = MessagingApi(api_client).get_profile(user_id)
-        return profile.display_name
+def get_line_display_name(user_id, user_data=None):
+    """取得 LINE 顯示名稱（經由 profile_cache 快取）"""
+    return get_display_name(user_id, user_data)
@@ -1,44 +1,38 @@
-import os
 import datetime
 import logging
 
 from add_task_flow_manager import AddTaskFlowManager
-from complete_task_flow_manager import (
-    CompleteTaskFlowManager,
-    handle_complete_task,
-    handle_confirm_complete,
-    handle_execute_complete,
-    handle_batch_complete_tasks,
-    handle_toggle_batch,
-    handle_execute_batch_complete,
-    handle_cancel_complete_task as handle_cancel_complete_task_new
-)
+from complete_task_flow_manager import CompleteTaskFlowManager
 
 from firebase_utils import (
-    load_data, save_data, set_user_state,
-    clear_user_state, set_temp_task, get_temp_task, clear_temp_task,
-    get_task_history,
-    update_task_history, add_task,
+    load_data, set_user_state,
+    clear_user_state, set_temp_task, clear_temp_task,
+    update_task_history, add_task, TaskExistsError,
     save_remind_time,
     get_remind_time,  
-    get_add_task_remind_time,  
     save_add_task_remind_time,  
     get_add_task_remind_enabled,  
-    save_add_task_remind_enabled  
+    save_add_task_remind_enabled,
+    get_settings,
+    ensure_remind_index,
+    task_key,
+    resolve_task_index,
+    mutate_tasks,
+    WriteBatch,
+    get_batch_clear_selection,
+    toggle_batch_clear_selection,
+    clear_batch_clear_selection
 )
-from firebase_admin import db
 from linebot.v3.webhooks import PostbackEvent
-from linebot.v3.messaging import MessagingApi, ReplyMessageRequest
 from linebot.v3.messaging.models import TextMessage, FlexMessage, FlexContainer
-from linebot.v3.messaging import ApiClient
-from linebot.v3.messaging import Configuration
+import line_gateway
+import flow_context
+from task_view import build_view_tasks_message
 
 
 # 設定 logger
 logger = logging.getLogger(__name__)
 
-configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
-
 def register_postback_handlers(handler):
     # 定義所有的處理器映射
     POSTBACK_HANDLERS = {
@@ -89,50 +83,41 @@ def register_postback_handlers(handler):
     @handler.add(PostbackEvent)
     def handle_postback(event):
         try:
-            data = event.postback.data
             user_id = event.source.user_id
             reply_token = event.reply_token
             
+            # 新增作業流程的按鈕可能帶有簽章過的流程內容（見 flow_context）
+            data, flow_temp_task = flow_context.unpack(event.postback.data, user_id)
             print(f"收到 postback 事件：{data}")
+            ensure_remind_index(user_id)
             
-            # 1. 先檢查是否為特殊處理
-            if data in SPECIAL_HANDLERS:
-                SPECIAL_HANDLERS[data](event, user_id, reply_token)
-                return
-            
-            # 2. 檢查是否為帶前綴的 postback
-            for prefix, handler_func in PREFIX_HANDLERS.items():
-                if data.startswith(prefix):
-                    handler_func(data, user_id, reply_token)
+            with flow_context.scope(flow_temp_task):
+                # 1. 先檢查是否為特殊處理
+                if data in SPECIAL_HANDLERS:
+                    SPECIAL_HANDLERS[data](event, user_id, reply_token)
                     return
-            
-            # 3. 檢查是否為固定的 postback
-            if data in POSTBACK_HANDLERS:
-                POSTBACK_HANDLERS[data](user_id, reply_token)
-                return
                 
-            # 4. 未知的 postback
-            print(f"警告：未知的 postback data: {data}")
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text="❌ 無法處理此操作")]
-                    )
-                )
+                # 2. 檢查是否為帶前綴的 postback
+                for prefix, handler_func in PREFIX_HANDLERS.items():
+                    if data.startswith(prefix):
+                        handler_func(data, user_id, reply_token)
+                        return
+                
+                # 3. 檢查是否為固定的 postback
+                if data in POSTBACK_HANDLERS:
+                    POSTBACK_HANDLERS[data](user_id, reply_token)
+                    return
+                    
+                # 4. 未知的 postback
+                print(f"警告：未知的 postback data: {data}")
+                line_gateway.reply(reply_token, [TextMessage(text="❌ 無法處理此操作")])
             
         except Exception as e:
             print(f"處理 postback 事件時發生錯誤：{str(e)}")
             import traceback
             traceback.print_exc()
             
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="❌ 發生錯誤，請稍後再試")]
-                    )
-                )
+            line_gateway.reply(event.reply_token, [TextMessage(text="❌ 發生錯誤，請稍後再試")])
 
 def handle_add_task(user_id, reply_token):
     """使用新的統一流程"""
@@ -153,11 +138,6 @@ def handle_select_type(data, user_id, reply_token):
     type_value = data.replace("select_type_", "")
     AddTaskFlowManager.handle_type_selection(user_id, type_value, reply_token)
 
-def handle_quick_due(data, user_id, reply_token):
-    """新增：處理快速截止日期選擇"""
-    due_date = data.replace("quick_due_", "")
-    AddTaskFlowManager.handle_due_date_selection(user_id, due_date, reply_token)
-
 def handle_no_due_date(user_id, reply_token):
     """更新不設定截止日期處理"""
     AddTaskFlowManager.handle_no_due_date(user_id, reply_token)
@@ -170,17 +150,7 @@ def handle_select_task_due(event, user_id):
     if date:
         AddTaskFlowManager.handle_due_date_selection(user_id, date, reply_token)
     else:
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 沒有取得日期，請重新選擇")]
-                )
-            )
-
-def handle_confirm_add_task(user_id, reply_token):
-    """更新確認新增處理"""
-    AddTaskFlowManager.confirm_add_task(user_id, reply_token)
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 沒有取得日期，請重新選擇")])
 
 def handle_quick_task(data, user_id, reply_token):
     """處理快速選擇作業名稱"""
@@ -195,9 +165,10 @@ def handle_history_task(data, user_id, reply_token):
 def handle_quick_due(data, user_id, reply_token):
     """處理快速選擇截止日期"""
     due_date = data.replace("quick_due_", "")
-    temp_task = get_temp_task(user_id)
+    temp_task = AddTaskFlowManager.load_temp_task(user_id)
     temp_task["due"] = due_date
     set_temp_task(user_id, temp_task)
+    clear_user_state(user_id)
     
     # 直接顯示確認畫面
     reply_bubble = {
@@ -281,13 +252,8 @@ def handle_quick_due(data, user_id, reply_token):
         }
     }
     
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[FlexMessage(alt_text="確認新增作業", contents=FlexContainer.from_dict(reply_bubble))]
-            )
-        )
+    flow_context.attach_to_bubble(reply_bubble, user_id, temp_task, ["confirm_add_task"])
+    line_gateway.reply(reply_token, [FlexMessage(alt_text="確認新增作業", contents=FlexContainer.from_dict(reply_bubble))])
 
 def handle_cancel_add_task(user_id, reply_token):
     """更新取消處理"""
@@ -296,38 +262,26 @@ def handle_cancel_add_task(user_id, reply_token):
 def handle_confirm_complete(data, user_id, reply_token):
     """處理確認完成單一作業"""
     try:
-        task_index = int(data.replace("confirm_complete_", ""))
-        CompleteTaskFlowManager.handle_confirm_complete(user_id, task_index, reply_token)
+        task_ref = data.replace("confirm_complete_", "")
+        CompleteTaskFlowManager.handle_confirm_complete(user_id, task_ref, reply_token)
     except ValueError:
         print(f"無效的作業索引：{data}")
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 無效的作業編號")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 無效的作業編號")])
 
 def handle_execute_complete(data, user_id, reply_token):
     """執行完成作業"""
     try:
-        task_index = int(data.replace("execute_complete_", ""))
-        CompleteTaskFlowManager.execute_complete_task(user_id, task_index, reply_token)
+        task_ref = data.replace("execute_complete_", "")
+        CompleteTaskFlowManager.execute_complete_task(user_id, task_ref, reply_token)
     except ValueError:
         print(f"無效的作業索引：{data}")
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 無效的作業編號")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 無效的作業編號")])
 
 def handle_toggle_batch(data, user_id, reply_token):
     """處理 toggle 選項，委託給流程管理器統一處理邏輯（切換選擇 + 更新畫面）"""
     try:
-        task_index = int(data.replace("toggle_batch_", ""))
-        CompleteTaskFlowManager.handle_toggle_batch_selection(user_id, task_index, reply_token)
+        task_ref = data.replace("toggle_batch_", "")
+        CompleteTaskFlowManager.handle_toggle_batch_selection(user_id, task_ref, reply_token)
     except Exception as e:
         print(f"批次選擇錯誤：{e}")
         CompleteTaskFlowManager._send_error(reply_token)
@@ -461,228 +415,24 @@ def handle_show_schedule(user_id, reply_token):
         }
     }
     
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[FlexMessage(
-                    alt_text="設定可用時間",
-                    contents=FlexContainer.from_dict(bubble)
-                )]
-            )
-        )
+    line_gateway.reply(
+        reply_token,
+        [FlexMessage(
+            alt_text="設定可用時間",
+            contents=FlexContainer.from_dict(bubble)
+        )]
+    )
         
 def handle_view_tasks(user_id, reply_token):
     """顯示作業列表為一頁式表格"""
     tasks = load_data(user_id)
     if not tasks:
         reply = "目前沒有任何作業。"
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-            )
+        line_gateway.reply(reply_token, [TextMessage(text=reply)])
         return
 
-    # 創建表格內容
-    table_contents = [
-        {"type": "text", "text": "📋 作業列表", "weight": "bold", "size": "xl", "color": "#1DB446"},
-        {"type": "separator", "margin": "md"}
-    ]
-    
-    # 統計資訊
-    total_tasks = len(tasks)
-    completed_tasks = len([t for t in tasks if t.get("done", False)])
-    pending_tasks = total_tasks - completed_tasks
-    
-    # 添加統計資訊
-    stats_box = {
-        "type": "box",
-        "layout": "horizontal",
-        "spacing": "md",
-        "margin": "md",
-        "contents": [
-            {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": str(total_tasks), "size": "xl", "weight": "bold", "align": "center"},
-                    {"type": "text", "text": "總計", "size": "sm", "color": "#666666", "align": "center"}
-                ],
-                "flex": 1
-            },
-            {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": str(pending_tasks), "size": "xl", "weight": "bold", "align": "center", "color": "#FF5551"},
-                    {"type": "text", "text": "待完成", "size": "sm", "color": "#666666", "align": "center"}
-                ],
-                "flex": 1
-            },
-            {
-                "type": "box",
-                "layout": "vertical",
-                "contents": [
-                    {"type": "text", "text": str(completed_tasks), "size": "xl", "weight": "bold", "align": "center", "color": "#1DB446"},
-                    {"type": "text", "text": "已完成", "size": "sm", "color": "#666666", "align": "center"}
-                ],
-                "flex": 1
-            }
-        ]
-    }
-    table_contents.append(stats_box)
-    table_contents.append({"type": "separator", "margin": "md"})
-    
-    # 添加表格標題行
-    header_box = {
-        "type": "box",
-        "layout": "horizontal",
-        "spacing": "sm",
-        "margin": "md",
-        "contents": [
-            {"type": "text", "text": "作業名稱", "size": "sm", "weight": "bold", "flex": 2},
-            {"type": "text", "text": "類型", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
-            {"type": "text", "text": "時間", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
-            {"type": "text", "text": "截止日", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
-            {"type": "text", "text": "狀態", "size": "sm", "weight": "bold", "flex": 1, "align": "center"}
-        ]
-    }
-    table_contents.append(header_box)
-    table_contents.append({"type": "separator", "margin": "sm"})
-    
-    # 添加每個作業的行
-    for i, task in enumerate(tasks):
-        # 處理作業狀態和顏色
-        is_done = task.get("done", False)
-        due_date = task.get("due", "未設定")
-        
-        # 判斷是否過期
-        is_expired = False
-        if due_date != "未設定" and not is_done:
-            try:
-                due_datetime = datetime.datetime.strptime(due_date, "%Y-%m-%d").date()
-                now_date = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).date()
-                is_expired = due_datetime < now_date
-            except:
-                pass
-        
-        # 設定狀態文字和顏色
-        if is_done:
-            status_text = "✅"
-            status_color = "#1DB446"
-        elif is_expired:
-            status_text = "⏰"
-            status_color = "#FF5551"
-        else:
-            status_text = "⏳"
-            status_color = "#FFAA00"
-        
-        # 處理截止日期顯示
-        due_display = due_date if due_date != "未設定" else "-"
-        if due_date != "未設定":
-            try:
-                due_datetime = datetime.datetime.strptime(due_date, "%Y-%m-%d")
-                due_display = due_datetime.strftime("%m/%d")
-            except:
-                due_display = "(未設定)"   # 解析失敗也給未設定
-        else:
-            due_display = "(未設定)"
-        
-        # 創建作業行
-        task_row = {
-            "type": "box",
-            "layout": "horizontal",
-            "spacing": "sm",
-            "margin": "sm",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": task.get("task", "未命名"),
-                    "size": "sm",
-                    "flex": 2,
-                    "wrap": True,
-                    "color": "#666666" if is_done else "#333333"
-                },
-                {
-                    "type": "text",
-                    "text": task.get("category", "-"),
-                    "size": "xs",
-                    "flex": 1,
-                    "align": "center",
-                    "color": "#888888"
-                },
-                {
-                    "type": "text",
-                    "text": f"{task.get('estimated_time', 0)}h",
-                    "size": "xs",
-                    "flex": 1,
-                    "align": "center",
-                    "color": "#888888"
-                },
-                {
-                    "type": "text",
-                    "text": due_display if due_date != "未設定" else "未設定",
-                    "size": "xs",
-                    "flex": 1,
-                    "align": "center",
-                    "color": "#FF5551" if is_expired else "#888888"
-                },
-                {
-                    "type": "text",
-                    "text": status_text,
-                    "size": "sm",
-                    "flex": 1,
-                    "align": "center",
-                    "color": status_color
-                }
-            ]
-        }
-        
-        table_contents.append(task_row)
-        # 添加分隔線（除了最後一個）
-        if i < len(tasks) - 1:
-            table_contents.append({"type": "separator", "margin": "sm", "color": "#EEEEEE"})
-    
-    # 創建完整的卡片
-    bubble = {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "spacing": "none",
-            "contents": table_contents
-        },
-        "footer": {
-            "type": "box",
-            "layout": "horizontal",
-            "spacing": "sm",
-            "contents": [
-                {
-                    "type": "button",
-                    "action": {"type": "postback", "label": "✅ 完成作業", "data": "complete_task"},
-                    "style": "primary",
-                    "flex": 1
-                },
-                {
-                    "type": "button",
-                    "action": {"type": "postback", "label": "➕ 新增作業", "data": "add_task"},
-                    "style": "secondary",
-                    "flex": 1
-                }
-            ]
-        }
-    }
-    
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[FlexMessage(
-                    alt_text="作業列表",
-                    contents=FlexContainer.from_dict(bubble)
-                )]
-            )
-        )
+    # 作業列表沒有變動時直接重用快取的卡片
+    line_gateway.reply(reply_token, [build_view_tasks_message(tasks, user_id)])
 
 def handle_select_remind_time(event, user_id, reply_token):
     try:
@@ -702,76 +452,64 @@ def handle_select_remind_time(event, user_id, reply_token):
         print(f"選擇提醒時間錯誤：{e}")
         reply = "❌ 設定提醒時間時發生錯誤"
 
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-        )
+    line_gateway.reply(reply_token, [TextMessage(text=reply)])
 def handle_cancel_set_remind(user_id, reply_token):
     reply = "❌ 已取消設定提醒時間"
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-        )
+    line_gateway.reply(reply_token, [TextMessage(text=reply)])
 
 def handle_clear_completed_all(user_id, reply_token):
-    tasks = load_data(user_id)
-    if not tasks:
-        reply = "✅ 目前沒有任何作業"
-    else:
-        filtered_tasks = [task for task in tasks if not task.get("done", False)]
-        if len(filtered_tasks) == len(tasks):
+    def remove_completed(tasks):
+        before = len(tasks)
+        tasks[:] = [task for task in tasks if not task.get("done", False)]
+        return before, before - len(tasks)
+
+    try:
+        total, cleared_count = mutate_tasks(user_id, remove_completed)
+        if not total:
+            reply = "✅ 目前沒有任何作業"
+        elif cleared_count == 0:
             reply = "✅ 沒有已完成的作業需要清除"
         else:
-            save_data(user_id, filtered_tasks)
-            reply = f"✅ 已清除 {len(tasks) - len(filtered_tasks)} 個已完成的作業"
+            reply = f"✅ 已清除 {cleared_count} 個已完成的作業"
+    except Exception as e:
+        print(f"一鍵清除已完成作業失敗：{str(e)}")
+        reply = "❌ 發生錯誤，請稍後再試"
 
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-        )
+    line_gateway.reply(reply_token, [TextMessage(text=reply)])
 
 def handle_clear_expired_all(user_id, reply_token):
-    try:
-        tasks = load_data(user_id)
-        if not tasks:
-            reply = "✅ 目前沒有任何作業"
-        else:
-            now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).date()
-            expired_count = 0
-            filtered_tasks = []
+    now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).date()
 
-            for task in tasks:
-                due = task.get("due", "未設定")
-                done = task.get("done", False)
-                if done or due == "未設定":
-                    filtered_tasks.append(task)
-                    continue
+    def is_expired(task):
+        due = task.get("due", "未設定")
+        if task.get("done", False) or due == "未設定":
+            return False
+        try:
+            return datetime.datetime.strptime(due, "%Y-%m-%d").date() < now
+        except:
+            return False
 
-                try:
-                    due_date = datetime.datetime.strptime(due, "%Y-%m-%d").date()
-                    if due_date >= now:
-                        filtered_tasks.append(task)
-                    else:
-                        expired_count += 1
-                except:
-                    filtered_tasks.append(task)
+    def remove_expired(tasks):
+        before = len(tasks)
+        tasks[:] = [task for task in tasks if not is_expired(task)]
+        return before, before - len(tasks)
 
-            if expired_count == 0:
-                reply = "✅ 沒有已截止的作業需要清除"
-            else:
-                save_data(user_id, filtered_tasks)
-                reply = f"✅ 已清除 {expired_count} 個已截止的作業"
+    try:
+        total, expired_count = mutate_tasks(user_id, remove_expired)
+        if not total:
+            reply = "✅ 目前沒有任何作業"
+        elif expired_count == 0:
+            reply = "✅ 沒有已截止的作業需要清除"
+        else:
+            reply = f"✅ 已清除 {expired_count} 個已截止的作業"
     except Exception as e:
         print(f"一鍵清除已截止作業失敗：{str(e)}")
         reply = "❌ 發生錯誤，請稍後再試"
 
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-        )
+    line_gateway.reply(reply_token, [TextMessage(text=reply)])
 
 def handle_confirm_add_task(user_id, reply_token):
-    temp_task = get_temp_task(user_id)
+    temp_task = AddTaskFlowManager.load_temp_task(user_id)
     if not temp_task:
         reply = "⚠️ 發生錯誤，請重新開始新增作業流程"
     else:
@@ -783,24 +521,30 @@ def handle_confirm_add_task(user_id, reply_token):
                 if isinstance(temp_task["estimated_time"], str):
                     temp_task["estimated_time"] = float(temp_task["estimated_time"])
 
-                update_task_history(user_id, temp_task["task"], temp_task["category"], temp_task["estimated_time"])
-                add_task(user_id, temp_task)
+                # 先新增作業（只在作業 ID 不存在時寫入），重送的確認按鈕不會再次新增
+                if not add_task(user_id, temp_task):
+                    raise Exception("新增作業失敗")
+
+                batch = WriteBatch()
+                update_task_history(user_id, temp_task["task"], temp_task["category"], temp_task["estimated_time"], batch=batch)
                 
                 # 記錄今天已新增作業
                 today = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).strftime("%Y-%m-%d")
-                db.reference(f"users/{user_id}/last_add_task_date").set(today)
+                batch.set(f"users/{user_id}/last_add_task_date", today)
                 
-                clear_temp_task(user_id)
-                clear_user_state(user_id)
+                clear_temp_task(user_id, batch=batch)
+                clear_user_state(user_id, batch=batch)
+                batch.commit()
                 reply = "✅ 作業已成功新增！"
+        except TaskExistsError:
+            clear_temp_task(user_id)
+            clear_user_state(user_id)
+            reply = "ℹ️ 這個作業已經新增過了"
         except Exception as e:
             print(f"新增作業失敗：{e}")
             reply = "❌ 發生錯誤，請稍後再試"
 
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-        )
+    line_gateway.reply(reply_token, [TextMessage(text=reply)])
 
 def handle_set_remind_time(user_id, reply_token):
     """顯示提醒設定選擇介面"""
@@ -915,31 +659,21 @@ def handle_set_remind_time(user_id, reply_token):
             }
         }
 
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[FlexMessage(
-                        alt_text="提醒設定",
-                        contents=FlexContainer.from_dict(bubble)
-                    )]
-                )
-            )
+        line_gateway.reply(
+            reply_token,
+            [FlexMessage(
+                alt_text="提醒設定",
+                contents=FlexContainer.from_dict(bubble)
+            )]
+        )
             
     except Exception as e:
         print(f"設定提醒時間功能錯誤：{e}")
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 提醒時間功能發生錯誤，請稍後再試")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 提醒時間功能發生錯誤，請稍後再試")])
 
 def handle_set_task_remind(user_id, reply_token):
     """設定未完成作業提醒時間"""
     try:
-        now_time = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).strftime("%H:%M")
         current_remind_time = get_remind_time(user_id)
         
         bubble = {
@@ -1013,24 +747,22 @@ def handle_set_task_remind(user_id, reply_token):
             }
         }
 
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[FlexMessage(
-                        alt_text="設定未完成作業提醒",
-                        contents=FlexContainer.from_dict(bubble)
-                    )]
-                )
-            )
+        line_gateway.reply(
+            reply_token,
+            [FlexMessage(
+                alt_text="設定未完成作業提醒",
+                contents=FlexContainer.from_dict(bubble)
+            )]
+        )
     except Exception as e:
         print(f"設定未完成作業提醒錯誤：{e}")
 
 def handle_set_add_task_remind(user_id, reply_token):
     """設定新增作業提醒"""
     try:
-        current_time = get_add_task_remind_time(user_id)
-        is_enabled = get_add_task_remind_enabled(user_id)
+        settings = get_settings(user_id)
+        current_time = settings["add_task_remind_time"]
+        is_enabled = settings["add_task_remind_enabled"]
         
         bubble = {
             "type": "bubble",
@@ -1145,16 +877,13 @@ def handle_set_add_task_remind(user_id, reply_token):
             }
         }
 
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[FlexMessage(
-                        alt_text="設定新增作業提醒",
-                        contents=FlexContainer.from_dict(bubble)
-                    )]
-                )
-            )
+        line_gateway.reply(
+            reply_token,
+            [FlexMessage(
+                alt_text="設定新增作業提醒",
+                contents=FlexContainer.from_dict(bubble)
+            )]
+        )
     except Exception as e:
         print(f"設定新增作業提醒錯誤：{e}")
 
@@ -1170,13 +899,7 @@ def handle_toggle_add_task_remind(user_id, reply_token):
         else:
             reply = "🔕 已停用新增作業提醒。"
         
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text=reply)]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text=reply)])
             
         # 重新顯示設定介面
         handle_set_add_task_remind(user_id, reply_token)
@@ -1202,10 +925,7 @@ def handle_select_add_task_remind_time(event, user_id, reply_token):
         print(f"選擇新增作業提醒時間錯誤：{e}")
         reply = "❌ 設定提醒時間時發生錯誤"
 
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-        )
+    line_gateway.reply(reply_token, [TextMessage(text=reply)])
 
 def handle_schedule_hours(data, user_id, reply_token):
     """處理快速選擇的時數"""
@@ -1218,25 +938,13 @@ def handle_schedule_hours(data, user_id, reply_token):
     from line_message_handler import generate_schedule_for_user
     response = generate_schedule_for_user(user_id, hours)
     
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=response if isinstance(response, list) else [TextMessage(text=response)]
-            )
-        )
+    line_gateway.reply(reply_token, response if isinstance(response, list) else [TextMessage(text=response)])
 
 def handle_cancel_schedule(user_id, reply_token):
     """取消排程設定"""
     clear_user_state(user_id)
     
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[TextMessage(text="❌ 已取消排程設定")]
-            )
-        )
+    line_gateway.reply(reply_token, [TextMessage(text="❌ 已取消排程設定")])
 
 def handle_clear_tasks(user_id, reply_token):
     """顯示清除作業的選項"""
@@ -1323,30 +1031,24 @@ def handle_clear_tasks(user_id, reply_token):
         }
     }
     
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[FlexMessage(
-                    alt_text="清除作業",
-                    contents=FlexContainer.from_dict(bubble)
-                )]
-            )
-        )
+    line_gateway.reply(
+        reply_token,
+        [FlexMessage(
+            alt_text="清除作業",
+            contents=FlexContainer.from_dict(bubble)
+        )]
+    )
 
 def handle_batch_clear_tasks(user_id, reply_token):
     """顯示批次清除作業的選擇介面"""
     tasks = load_data(user_id)
     if not tasks:
         reply = "目前沒有任何作業"
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-            )
+        line_gateway.reply(reply_token, [TextMessage(text=reply)])
         return
     
     # 獲取當前的選擇狀態
-    current_selection = db.reference(f"users/{user_id}/batch_clear_selection").get() or {}
+    current_selection = get_batch_clear_selection(user_id)
     
     # 過濾出已完成和已過期的作業
     clearable_tasks = []
@@ -1373,23 +1075,21 @@ def handle_batch_clear_tasks(user_id, reply_token):
         if is_clearable:
             clearable_tasks.append({
                 "index": i,
+                "key": task_key(task, i),
                 "task": task,
                 "reason": clear_reason
             })
     
     if not clearable_tasks:
         reply = "沒有可清除的作業（已完成或已過期）"
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-            )
+        line_gateway.reply(reply_token, [TextMessage(text=reply)])
         return
     
     # 建立選擇按鈕
     task_buttons = []
     for item in clearable_tasks[:10]:  # 最多顯示10個
         # 檢查是否已選中
-        is_selected = current_selection.get(str(item['index']), False)
+        is_selected = current_selection.get(item['key'], False)
         checkbox = "✅" if is_selected else "⬜️"
         
         # 根據選中狀態調整按鈕顏色
@@ -1405,7 +1105,7 @@ def handle_batch_clear_tasks(user_id, reply_token):
                     "action": {
                         "type": "postback",
                         "label": f"{checkbox} {item['task']['task'][:8]}... ({item['reason']})",
-                        "data": f"toggle_clear_{item['index']}"
+                        "data": f"toggle_clear_{item['key']}"
                     },
                     "style": "secondary",
                     "color": button_color,
@@ -1488,73 +1188,51 @@ def handle_batch_clear_tasks(user_id, reply_token):
         }
     }
     
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(
-                reply_token=reply_token,
-                messages=[FlexMessage(
-                    alt_text="批次清除作業",
-                    contents=FlexContainer.from_dict(bubble)
-                )]
-            )
-        )
+    line_gateway.reply(
+        reply_token,
+        [FlexMessage(
+            alt_text="批次清除作業",
+            contents=FlexContainer.from_dict(bubble)
+        )]
+    )
         
 def handle_toggle_clear(data, user_id, reply_token):
     """切換清除選擇狀態"""
     try:
-        task_index = int(data.replace("toggle_clear_", ""))
-        
-        # 獲取目前的選擇狀態
-        selection_ref = db.reference(f"users/{user_id}/batch_clear_selection/{task_index}")
-        current_state = selection_ref.get()
+        task_ref = data.replace("toggle_clear_", "")
         
-        # 切換狀態
-        selection_ref.set(not current_state if current_state else True)
+        # 切換選擇狀態
+        toggle_batch_clear_selection(user_id, task_ref)
         
         # 重新顯示選擇介面
         handle_batch_clear_tasks(user_id, reply_token)
         
     except Exception as e:
         print(f"切換清除選擇錯誤：{e}")
-        with ApiClient(configuration) as api_client:
-            MessagingApi(api_client).reply_message(
-                ReplyMessageRequest(
-                    reply_token=reply_token,
-                    messages=[TextMessage(text="❌ 發生錯誤，請重試")]
-                )
-            )
+        line_gateway.reply(reply_token, [TextMessage(text="❌ 發生錯誤，請重試")])
 
 def handle_execute_batch_clear(user_id, reply_token):
     """執行批次清除"""
     try:
         # 獲取選擇的作業
-        selection = db.reference(f"users/{user_id}/batch_clear_selection").get() or {}
-        selected_indices = [int(idx) for idx, is_selected in selection.items() if is_selected]
+        selection = get_batch_clear_selection(user_id)
+        selected_keys = [key for key, is_selected in selection.items() if is_selected]
         
-        if not selected_indices:
+        if not selected_keys:
             reply = "請至少選擇一個作業"
-            with ApiClient(configuration) as api_client:
-                MessagingApi(api_client).reply_message(
-                    ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-                )
+            line_gateway.reply(reply_token, [TextMessage(text=reply)])
             return
         
-        # 執行清除
-        tasks = load_data(user_id)
-        # 從大到小排序，避免刪除時索引錯位
-        selected_indices.sort(reverse=True)
+        # 執行清除（以作業 ID 找回目前的位置，其他操作造成的位移不影響）
+        def remove_selected(tasks):
+            selected_indices = {resolve_task_index(tasks, key) for key in selected_keys} - {None}
+            tasks[:] = [task for i, task in enumerate(tasks) if i not in selected_indices]
+            return len(selected_indices)
         
-        cleared_count = 0
-        for idx in selected_indices:
-            if 0 <= idx < len(tasks):
-                tasks.pop(idx)
-                cleared_count += 1
-        
-        # 保存更新後的作業列表
-        save_data(user_id, tasks)
+        cleared_count = mutate_tasks(user_id, remove_selected)
         
         # 清除選擇狀態
-        db.reference(f"users/{user_id}/batch_clear_selection").delete()
+        clear_batch_clear_selection(user_id)
         
         reply = f"✅ 已成功清除 {cleared_count} 個作業"
         
@@ -1562,18 +1240,12 @@ def handle_execute_batch_clear(user_id, reply_token):
         print(f"批次清除錯誤：{e}")
         reply = "❌ 清除過程中發生錯誤"
     
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-        )
+    line_gateway.reply(reply_token, [TextMessage(text=reply)])
 
 def handle_cancel_clear_tasks(user_id, reply_token):
     """取消清除作業"""
     # 清除批次選擇狀態
-    db.reference(f"users/{user_id}/batch_clear_selection").delete()
+    clear_batch_clear_selection(user_id)
     
     reply = "❌ 已取消清除作業"
-    with ApiClient(configuration) as api_client:
-        MessagingApi(api_client).reply_message(
-            ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=reply)])
-        )
\ No newline at end of file
+    line_gateway.reply(reply_token, [TextMessage(text=reply)])
\ No newline at end of file
@@ -0,0 +1,164 @@
+# ==================== LINE 顯示名稱快取 ====================
+# 顯示名稱很少變動，不需要每次發訊息都呼叫 profile API。
+# 查詢順序：程序內快取（LRU + TTL）→ users/{id}/profile → LINE profile API
+# 封鎖或已刪除好友的用戶（404 / 403）會做負向快取，避免每次提醒都重打 API；
+# 用戶重新加入好友（follow 事件）時清掉快取，下次重新查詢。
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.v3.messaging.exceptions import ApiException
+
+import line_gateway
+from firebase_utils import get_user_profile, save_user_profile, delete_user_profile
+
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", str(24 * 60 * 60)))
+PROFILE_NEGATIVE_TTL = float(os.getenv("PROFILE_NEGATIVE_TTL", str(6 * 60 * 60)))
+PROFILE_CACHE_MAX_USERS = int(os.getenv("PROFILE_CACHE_MAX_USERS", "5000"))
+PROFILE_PERSIST = os.getenv("PROFILE_PERSIST", "1") == "1"
+PROFILE_PREFETCH_CONCURRENCY = int(os.getenv("PROFILE_PREFETCH_CONCURRENCY", "8"))
+DEFAULT_DISPLAY_NAME = "同學"
+
+_profile_cache = OrderedDict()  # user_id -> (expires_at, display_name)；display_name 為 None 表示負向快取
+_profile_lock = threading.Lock()
+_profile_stats = {"hits": 0, "persisted_hits": 0, "negative_hits": 0, "misses": 0, "api_calls": 0,
+                  "api_failures": 0, "prefetched": 0, "invalidations": 0}
+
+def _count(kind, amount=1):
+    with _profile_lock:
+        _profile_stats[kind] += amount
+
+def _cache_lookup(user_id):
+    """回傳 (是否命中, display_name)"""
+    with _profile_lock:
+        entry = _profile_cache.get(user_id)
+        if not entry:
+            return False, None
+        if entry[0] <= time.time():
+            del _profile_cache[user_id]
+            return False, None
+        _profile_cache.move_to_end(user_id)
+        return True, entry[1]
+
+def _cache_store(user_id, display_name, expires_at):
+    with _profile_lock:
+        _profile_cache[user_id] = (expires_at, display_name)
+        _profile_cache.move_to_end(user_id)
+        while len(_profile_cache) > PROFILE_CACHE_MAX_USERS:
+            _profile_cache.popitem(last=False)
+
+def _load_persisted(user_id, profile=None):
+    """從 users/{id}/profile 取回仍在有效期內的名稱，回傳 (是否命中, display_name)"""
+    if not PROFILE_PERSIST:
+        return False, None
+    if profile is None:
+        try:
+            profile = get_user_profile(user_id)
+        except Exception as e:
+            print(f"[profile] 讀取 {user_id} 的個人資料快取失敗：{e}")
+            return False, None
+    if not isinstance(profile, dict):
+        return False, None
+
+    expires_at = profile.get("expires_at", 0)
+    if expires_at <= time.time():
+        return False, None
+    display_name = profile.get("display_name")
+    _cache_store(user_id, display_name, expires_at)
+    return True, display_name
+
+def _fetch_from_api(user_id):
+    """呼叫 LINE profile API 並寫入快取"""
+    _count("api_calls")
+    try:
+        display_name = line_gateway.get_profile(user_id).display_name
+        expires_at = time.time() + PROFILE_CACHE_TTL
+    except ApiException as e:
+        _count("api_failures")
+        if e.status not in (403, 404):
+            # 暫時性錯誤不快取，下次再試
+            print(f"[profile] 取得 {user_id} 的顯示名稱失敗：{e.status} {e.reason}")
+            return None
+        # 用戶封鎖或已不是好友
+        display_name = None
+        expires_at = time.time() + PROFILE_NEGATIVE_TTL
+    except Exception as e:
+        _count("api_failures")
+        print(f"[profile] 取得 {user_id} 的顯示名稱失敗：{e}")
+        return None
+
+    _cache_store(user_id, display_name, expires_at)
+    if PROFILE_PERSIST:
+        try:
+            save_user_profile(user_id, {"display_name": display_name, "expires_at": expires_at})
+        except Exception as e:
+            print(f"[profile] 儲存 {user_id} 的個人資料快取失敗：{e}")
+    return display_name
+
+def get_display_name(user_id, user_data=None, default=DEFAULT_DISPLAY_NAME):
+    """
+    取得用戶的 LINE 顯示名稱
+    user_data：已讀取的 users/{id} 資料（例如提醒掃描時），可省去一次 RTDB 讀取
+    查不到名稱（封鎖、API 失敗）時回傳 default
+    """
+    hit, display_name = _cache_lookup(user_id)
+    if hit:
+        _count("hits")
+        if display_name is None:
+            _count("negative_hits")
+        return display_name or default
+
+    profile = user_data.get("profile") if isinstance(user_data, dict) else None
+    if user_data is None or profile is not None:
+        hit, display_name = _load_persisted(user_id, profile)
+        if hit:
+            _count("persisted_hits")
+            if display_name is None:
+                _count("negative_hits")
+            return display_name or default
+
+    _count("misses")
+    return _fetch_from_api(user_id) or default
+
+def prefetch_display_names(user_ids, user_data_map=None, concurrency=PROFILE_PREFETCH_CONCURRENCY):
+    """
+    批次預先載入多位用戶的顯示名稱（提醒掃描前呼叫）
+    只有快取與持久化資料都沒有的用戶才會呼叫 API，並以有限的並行數執行
+    """
+    user_data_map = user_data_map or {}
+    missing = []
+    for user_id in user_ids:
+        if _cache_lookup(user_id)[0]:
+            continue
+        user_data = user_data_map.get(user_id)
+        profile = user_data.get("profile") if isinstance(user_data, dict) else None
+        if profile is not None and _load_persisted(user_id, profile)[0]:
+            continue
+        missing.append(user_id)
+
+    if missing:
+        _count("prefetched", len(missing))
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            list(executor.map(lambda uid: get_display_name(uid, user_data_map.get(uid)), missing))
+    print(f"[profile] 預先載入 {len(user_ids)} 位用戶的顯示名稱，其中 {len(missing)} 位需要查詢")
+    return len(missing)
+
+def invalidate_display_name(user_id):
+    """讓指定用戶的名稱快取（含持久化與負向快取）失效，收到 follow 事件時呼叫"""
+    with _profile_lock:
+        _profile_cache.pop(user_id, None)
+        _profile_stats["invalidations"] += 1
+    if PROFILE_PERSIST:
+        try:
+            delete_user_profile(user_id)
+        except Exception as e:
+            print(f"[profile] 清除 {user_id} 的個人資料快取失敗：{e}")
+
+def get_profile_cache_stats():
+    with _profile_lock:
+        stats = dict(_profile_stats)
+        stats["cached_users"] = len(_profile_cache)
+    return stats
@@ -0,0 +1,182 @@
+# ==================== 提醒推播發送階段 ====================
+# 內容相同的提醒（例如新增作業提醒卡片）合併為 multicast，每次最多 500 人；
+# 個人化的提醒則以有上限的執行緒池逐一 push。
+# 每個請求都帶固定的 X-Line-Retry-Key，重試時不會重複送達；提供 dedupe_key 時 retry key 由它推導，
+# 即使另一個程序（重疊的 cron）再送一次同樣的提醒，LINE 也只會送達一次
+# （dedupe_key 要能區分同一天內應該再送一次的提醒，例如含提醒時間）；
+# 遇到 429 會依 Retry-After 退避，並統計每次執行的吞吐量與失敗數。
+
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from linebot.v3.messaging.exceptions import ApiException
+
+import line_gateway
+
+MULTICAST_MAX_RECIPIENTS = 500
+REMIND_PUSH_CONCURRENCY = int(os.getenv("REMIND_PUSH_CONCURRENCY", "8"))
+REMIND_MAX_REQUESTS_PER_SEC = float(os.getenv("REMIND_MAX_REQUESTS_PER_SEC", "50"))
+REMIND_MAX_RETRIES = int(os.getenv("REMIND_MAX_RETRIES", "3"))
+
+
+class _RatePacer:
+    """簡單的請求節流：確保兩次請求間隔不小於 1 / rate 秒"""
+
+    def __init__(self, rate_per_sec):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait_for = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+    def backoff(self, seconds):
+        """收到 429 時，讓所有執行緒一起暫停"""
+        with self._lock:
+            self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+
+class ReminderDelivery:
+    """
+    收集一次 /remind 執行中要發送的提醒，最後以 flush() 一次送出（可以多次 flush，統計會累加）
+    add_* 可以從多個執行緒同時呼叫
+    on_success(user_id) 會在該用戶的訊息確定送出後呼叫（例如記錄今天已提醒），
+    on_failure(user_id) 則在放棄發送時呼叫（例如撤回發送登記）
+    """
+
+    def __init__(self, concurrency=REMIND_PUSH_CONCURRENCY,
+                 max_requests_per_sec=REMIND_MAX_REQUESTS_PER_SEC):
+        self.concurrency = max(1, concurrency)
+        self.pacer = _RatePacer(max_requests_per_sec)
+        self._groups = {}  # group_key -> {"messages", "dedupe_key", "recipients": [(user_id, on_success, on_failure)]}
+        self._personal = []  # (user_id, messages, on_success, on_failure, dedupe_key)
+        self._lock = threading.Lock()
+        self.stats = {"recipients": 0, "api_calls": 0, "multicast_calls": 0,
+                      "push_calls": 0, "retries": 0, "failures": 0, "elapsed": 0.0}
+
+    # ---------- 收集 ----------
+    def add_broadcast(self, group_key, user_id, messages, on_success=None, on_failure=None, dedupe_key=None):
+        """加入內容相同的提醒，group_key 相同者必須有完全相同的 messages 與 dedupe_key"""
+        with self._lock:
+            group = self._groups.setdefault(
+                group_key, {"messages": messages, "dedupe_key": dedupe_key, "recipients": []}
+            )
+            group["recipients"].append((user_id, on_success, on_failure))
+
+    def add_personal(self, user_id, messages, on_success=None, on_failure=None, dedupe_key=None):
+        """加入個人化的提醒"""
+        with self._lock:
+            self._personal.append((user_id, messages, on_success, on_failure, dedupe_key))
+
+    # ---------- 發送 ----------
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _send_with_retry(self, send_func, label, dedupe_key=None):
+        """以同一個 retry key 重試，回傳是否成功"""
+        retry_key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"homework-linebot/{dedupe_key}")) if dedupe_key else str(uuid.uuid4())
+        for attempt in range(REMIND_MAX_RETRIES + 1):
+            self.pacer.wait()
+            self._count("api_calls")
+            try:
+                send_func(retry_key)
+                return True
+            except ApiException as e:
+                # 409：相同 retry key 的請求先前已被接受
+                if e.status == 409:
+                    return True
+                if e.status == 429 or (e.status and e.status >= 500):
+                    retry_after = 1.0
+                    if e.headers and e.headers.get("Retry-After"):
+                        try:
+                            retry_after = float(e.headers.get("Retry-After"))
+                        except ValueError:
+                            pass
+                    self.pacer.backoff(retry_after * (attempt + 1))
+                    self._count("retries")
+                    continue
+                print(f"[remind][delivery] {label} 發送失敗：{e.status} {e.reason}")
+                return False
+            except Exception as e:
+                print(f"[remind][delivery] {label} 發送失敗：{e}")
+                return False
+        print(f"[remind][delivery] {label} 重試 {REMIND_MAX_RETRIES} 次仍失敗")
+        return False
+
+    def _deliver_multicast(self, group_key, messages, recipients, dedupe_key=None):
+        user_ids = [user_id for user_id, _, _ in recipients]
+
+        def send(retry_key):
+            line_gateway.multicast(user_ids, messages, retry_key=retry_key)
+
+        if dedupe_key:
+            dedupe_key = f"{dedupe_key}/{','.join(sorted(user_ids))}"
+        self._count("multicast_calls")
+        if self._send_with_retry(send, f"multicast[{group_key}] x{len(user_ids)}", dedupe_key):
+            self._count("recipients", len(user_ids))
+            for user_id, on_success, _ in recipients:
+                if on_success:
+                    on_success(user_id)
+        else:
+            self._count("failures", len(user_ids))
+            for user_id, _, on_failure in recipients:
+                if on_failure:
+                    on_failure(user_id)
+
+    def _deliver_personal(self, user_id, messages, on_success, on_failure=None, dedupe_key=None):
+        def send(retry_key):
+            line_gateway.push(user_id, messages, retry_key=retry_key)
+
+        self._count("push_calls")
+        if self._send_with_retry(send, f"push[{user_id}]", dedupe_key):
+            self._count("recipients")
+            if on_success:
+                on_success(user_id)
+        else:
+            self._count("failures")
+            if on_failure:
+                on_failure(user_id)
+
+    def flush(self):
+        """送出所有收集到的提醒，回傳本次統計"""
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = []
+            for group_key, group in self._groups.items():
+                recipients = group["recipients"]
+                for i in range(0, len(recipients), MULTICAST_MAX_RECIPIENTS):
+                    futures.append(executor.submit(
+                        self._deliver_multicast, group_key, group["messages"],
+                        recipients[i:i + MULTICAST_MAX_RECIPIENTS], group["dedupe_key"]
+                    ))
+            for personal in self._personal:
+                futures.append(executor.submit(self._deliver_personal, *personal))
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"[remind][delivery] 發送工作錯誤：{e}")
+                    self._count("failures")
+
+        self._groups = {}
+        self._personal = []
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.stats["elapsed"] += elapsed
+            stats = dict(self.stats)
+        stats["throughput_per_sec"] = round(stats["recipients"] / stats["elapsed"], 2) if stats["elapsed"] else 0.0
+        print(f"[remind][delivery] 送達 {stats['recipients']} 人，API 呼叫 {stats['api_calls']} 次"
+              f"（multicast {stats['multicast_calls']}、push {stats['push_calls']}、重試 {stats['retries']}），"
+              f"失敗 {stats['failures']}，耗時 {elapsed:.2f}s，{stats['throughput_per_sec']} 人/秒")
+        return stats
@@ -0,0 +1,304 @@
+# ==================== 提醒檢查 ====================
+# /remind 掃描（app.py）與提醒排程器（remind_scheduler.py）共用的提醒流程：
+# 讀取到期用戶的資料、檢查今天是否需要提醒、在發送帳本登記後排入 ReminderDelivery。
+# 排程器只需要這個模組，不會載入 Flask app 與 webhook 處理器。
+
+import os
+import uuid
+import threading
+
+from firebase_utils import (
+    settings_from_user_data,
+    get_user_data,
+    mark_reminded,
+    claim_reminder,
+    release_reminder,
+    tasks_from_user_data
+)
+from linebot.v3.messaging.models import FlexMessage, FlexContainer, TextMessage
+from profile_cache import get_display_name, prefetch_display_names
+from task_view import build_view_tasks_message
+
+REMIND_SWEEP_CONCURRENCY = int(os.getenv("REMIND_SWEEP_CONCURRENCY", "8"))  # 讀取與檢查用戶的執行緒數
+
+def time_should_remind(remind_time, now):
+    """判斷提醒時間是否應該觸發（只要現在 >= 設定時間）"""
+    try:
+        # 解析提醒時間
+        remind_hour, remind_minute = map(int, remind_time.split(':'))
+        
+        # 獲取當前時間的小時和分鐘
+        current_hour = now.hour
+        current_minute = now.minute
+        
+        # 比較時間
+        if current_hour > remind_hour:
+            return True
+        elif current_hour == remind_hour and current_minute >= remind_minute:
+            return True
+        else:
+            return False
+            
+    except Exception as e:
+        print(f"【DEBUG】解析提醒時間錯誤：{remind_time}, {e}")
+        return False
+
+def build_add_task_reminder_message(added_today, display_name=None):
+    """
+    建立新增作業提醒卡片
+    未提供 display_name 時不顯示名稱，讓所有用戶的內容相同、可以合併 multicast
+    """
+    # 根據今天是否已新增作業，顯示不同內容
+    if added_today:
+        # 今天已經有新增作業
+        main_text = "你今天已經有新增作業囉 🎉"
+        sub_text = "如果還有新的作業，記得馬上補上來，才不會漏掉！"
+        button_text = "➕ 繼續新增作業"
+    else:
+        # 今天尚未新增作業
+        main_text = "今天還沒有新增作業喔！"
+        sub_text = "記得把今天的作業記錄下來，這樣才不會忘記 😊"
+        button_text = "➕ 立即新增作業"
+
+    greeting = f"Hi {display_name}! 👋" if display_name else "Hi! 👋"
+
+    bubble = {
+        "type": "bubble",
+        "size": "kilo",
+        "header": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": "📝 作業提醒",
+                    "color": "#FFFFFF",
+                    "size": "lg",
+                    "weight": "bold"
+                }
+            ],
+            "backgroundColor": "#4A90E2",
+            "paddingAll": "15px"
+        },
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "md",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": greeting,
+                    "size": "md",
+                    "weight": "bold"
+                },
+                {
+                    "type": "text",
+                    "text": main_text,
+                    "size": "sm",
+                    "color": "#666666",
+                    "wrap": True
+                },
+                {
+                    "type": "text",
+                    "text": sub_text,
+                    "size": "sm",
+                    "color": "#666666",
+                    "wrap": True,
+                    "margin": "sm"
+                }
+            ]
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "sm",
+            "contents": [
+                {
+                    "type": "button",
+                    "action": {
+                        "type": "postback",
+                        "label": button_text,
+                        "data": "add_task"
+                    },
+                    "style": "primary",
+                    "color": "#4A90E2"
+                },
+                {
+                    "type": "button",
+                    "action": {
+                        "type": "postback",
+                        "label": "⏰ 調整提醒設定",
+                        "data": "set_remind_time"
+                    },
+                    "style": "secondary"
+                }
+            ]
+        }
+    }
+
+    return FlexMessage(
+        alt_text=main_text,
+        contents=FlexContainer.from_dict(bubble)
+    )
+
+class RemindRetries:
+    """
+    收集一次掃描中需要之後重試的提醒（寫入 firebase_utils 的重試清單）
+    可以從檢查與發送的多個執行緒同時加入
+    """
+
+    def __init__(self):
+        self._entries = {}  # user_id -> set(kind)
+        self._lock = threading.Lock()
+
+    def add(self, user_id, kinds):
+        with self._lock:
+            self._entries.setdefault(user_id, set()).update(kinds)
+
+    def pop_all(self):
+        """取出目前收集到的項目，返回: {user_id: [kind, ...]}"""
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        return {user_id: sorted(kinds) for user_id, kinds in entries.items()}
+
+def process_user_reminders(user_id, user_data, now, delivery, kinds=("add_task", "task"), sweep_id=None, retries=None):
+    """
+    檢查單一用戶的提醒，需要發送的訊息交給 delivery 統一發送
+    user_data 為 users/{user_id} 的資料，設定值直接從中讀取（未設定則使用預設值），
+    不再逐項呼叫 get_* 讀取資料庫
+    排入發送前先在當日帳本登記（claim_reminder），重疊的掃描不會重複發送
+    提供 retries（RemindRetries）時，發送失敗或登記被其他掃描持有的提醒會記入，之後再重試
+    """
+    sweep_id = sweep_id or uuid.uuid4().hex
+    current_time_str = now.strftime("%H:%M")
+    today_str = now.strftime("%Y-%m-%d")
+    settings = settings_from_user_data(user_data)
+
+    def on_failure(kind):
+        def callback(uid):
+            release_reminder(uid, kind, today_str, sweep_id)
+            if retries is not None:
+                retries.add(uid, [kind])
+        return callback
+
+    def claim(kind):
+        claimed = claim_reminder(user_id, kind, today_str, sweep_id)
+        if claimed is None and retries is not None:
+            # 另一個掃描正在發送，它若中斷，登記過期後由重試清單接手
+            retries.add(user_id, [kind])
+        return claimed
+
+    # ========== 檢查新增作業提醒 ==========
+    if "add_task" in kinds:
+        add_task_remind_enabled = settings["add_task_remind_enabled"]
+        add_task_remind_time = settings["add_task_remind_time"]
+        last_add_task_remind_date = user_data.get("last_add_task_remind_date", "")
+
+        print(f"[remind][add_task] user={user_id}, enabled={add_task_remind_enabled}, "
+              f"remind_time={add_task_remind_time}, now={current_time_str}, "
+              f"last_remind={last_add_task_remind_date}, today={today_str}")
+
+        # 檢查是否應該發送新增作業提醒
+        if add_task_remind_enabled and time_should_remind(add_task_remind_time, now):
+            # 確保今天還沒提醒過
+            if last_add_task_remind_date != today_str:
+                if claim("add_task"):
+                    # 內容相同的提醒合併為 multicast，送達後記錄今天已提醒
+                    # dedupe_key 含提醒時間：時間改到今天稍後重新發送時換一個 retry key，不會被 LINE 當成重送
+                    added_today = user_data.get("last_add_task_date", "") == today_str
+                    delivery.add_broadcast(
+                        f"add_task:{added_today}:{add_task_remind_time}",
+                        user_id,
+                        [build_add_task_reminder_message(added_today)],
+                        on_success=lambda uid: mark_reminded(uid, "add_task", today_str),
+                        on_failure=on_failure("add_task"),
+                        dedupe_key=f"remind/add_task/{added_today}/{today_str}/{add_task_remind_time}"
+                    )
+                    print(f"[remind][add_task] 已排入新增作業提醒給 {user_id}")
+                else:
+                    print(f"[remind][add_task] {user_id} 今天的提醒已由其他掃描處理，跳過")
+
+    # ========== 檢查未完成作業提醒 ==========
+    if "task" in kinds:
+        task_remind_enabled = settings["task_remind_enabled"]
+        remind_time = settings["remind_time"]
+        last_task_remind_date = user_data.get("last_task_remind_date", "")
+        tasks = tasks_from_user_data(user_data)
+
+        print(f"[remind][task] user={user_id}, enabled={task_remind_enabled}, "
+              f"remind_time={remind_time}, now={current_time_str}, "
+              f"last_remind={last_task_remind_date}, today={today_str}")
+
+        # 檢查是否應該發送未完成作業提醒
+        if task_remind_enabled and time_should_remind(remind_time, now):
+            # 確保今天還沒提醒過
+            if last_task_remind_date != today_str:
+                # 檢查是否有未完成作業
+                has_incomplete_task = False
+                for task in tasks:
+                    if not task.get("done", False):
+                        has_incomplete_task = True
+                        break
+
+                if has_incomplete_task and not claim("task"):
+                    print(f"[remind][task] {user_id} 今天的提醒已由其他掃描處理，跳過")
+                elif has_incomplete_task:
+                    display_name = get_display_name(user_id, user_data)
+
+                    # 文字提醒與作業列表合併為一次 push，送達後記錄今天已提醒（dedupe_key 同樣含提醒時間）
+                    messages = [TextMessage(
+                        text=f"⏰ {display_name}，您還有尚未完成的作業喔！來看看吧 👇"
+                    )]
+                    task_message = build_view_tasks_message(tasks, user_id)
+                    if task_message:
+                        messages.append(task_message)
+                    delivery.add_personal(
+                        user_id,
+                        messages,
+                        on_success=lambda uid: mark_reminded(uid, "task", today_str),
+                        on_failure=on_failure("task"),
+                        dedupe_key=f"remind/task/{user_id}/{today_str}/{remind_time}"
+                    )
+                    print(f"[remind][task] 已排入未完成作業提醒給 {user_id}")
+                else:
+                    print(f"[remind][task] {user_id} 沒有未完成的作業，跳過提醒")
+
+def process_due_users(user_ids, due_users, users, now, delivery, executor, sweep_id, retries=None):
+    """
+    讀取並檢查一批到期用戶的提醒，要發送的訊息排入 delivery（由呼叫端 flush）
+    users 為已讀取的用戶資料（沒有的才逐一讀取），讀取或處理失敗的用戶記入 retries
+    返回: (處理的用戶數, 錯誤數)
+    """
+    def load(user_id):
+        try:
+            return user_id, users[user_id] if user_id in users else get_user_data(user_id)
+        except Exception as e:
+            print(f"[remind] 讀取用戶 {user_id} 時發生錯誤：{e}")
+            return user_id, None
+
+    chunk_data = dict(executor.map(load, user_ids))
+    errors = sum(1 for user_data in chunk_data.values() if user_data is None)
+
+    # 個人化提醒需要顯示名稱，先批次載入，避免逐一呼叫 profile API
+    prefetch_display_names(
+        [user_id for user_id in user_ids if "task" in due_users[user_id] and chunk_data.get(user_id)],
+        chunk_data
+    )
+
+    def process(user_id):
+        user_data = chunk_data.get(user_id)
+        if not isinstance(user_data, dict):
+            if user_data is None and retries is not None:
+                retries.add(user_id, due_users[user_id])
+            return False
+        try:
+            process_user_reminders(user_id, user_data, now, delivery, due_users[user_id], sweep_id, retries)
+            return True
+        except Exception as e:
+            print(f"[remind] 處理用戶 {user_id} 時發生錯誤：{e}")
+            if retries is not None:
+                retries.add(user_id, due_users[user_id])
+            return None
+
+    results = list(executor.map(process, user_ids))
+    return results.count(True), errors + results.count(None)
@@ -0,0 +1,221 @@
+# ==================== 提醒排程器 ====================
+# 獨立的 worker 程序（Procfile 的 worker: python remind_scheduler.py），取代外部服務定時呼叫 /remind：
+# - 啟動時讀取 remind_index，為每位用戶的每種提醒算出下一次觸發時間，放入 min-heap
+# - 設定變動（save_remind_time / save_add_task_remind_time / 開關）會寫入 remind_changes，
+#   排程器監聽 remind_changes，有新的變動就立即醒來處理（幾秒內生效）；儲存後端不支援監聽時
+#   （SQLite）改為每 REMIND_SCHEDULER_POLL 秒讀取一次。變動之後已經到期的設定會立即補發；
+#   舊的 heap 項目不刪除，觸發時比對目前設定即可略過（lazy deletion），每次事件 O(log n)
+# - 平常只睡到 heap 最前面的觸發時間或下一次檢查變動，兩者之間不讀取任何資料
+# 發送沿用 /remind 的流程（remind_runner.process_due_users + ReminderDelivery + 發送帳本），
+# 與 /remind 同時執行也不會重複推播。以租約保證同時只有一個排程器在執行，其餘待命。
+
+import os
+import time
+import uuid
+import heapq
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_utils import (
+    REMIND_KINDS,
+    REMIND_LEASE_TTL,
+    is_remind_index_ready,
+    rebuild_remind_index,
+    get_remind_index,
+    pop_remind_changes,
+    watch_remind_changes,
+    get_remind_scheduler_cursor,
+    save_remind_scheduler_cursor,
+    acquire_sweep_lease,
+    release_sweep_lease,
+    get_remind_retries,
+    save_remind_retries,
+)
+from remind_delivery import ReminderDelivery
+from remind_runner import process_due_users, RemindRetries, REMIND_SWEEP_CONCURRENCY
+
+REMIND_SCHEDULER_POLL = float(os.getenv("REMIND_SCHEDULER_POLL", "60"))  # 沒有收到通知時檢查設定變動的間隔（秒）
+REMIND_RETRY_DELAY = float(os.getenv("REMIND_RETRY_DELAY", "60"))  # 發送失敗後多久重試（秒）
+SCHEDULER_LEASE_NAME = "scheduler"
+TZ = datetime.timezone(datetime.timedelta(hours=8))
+
+
+def next_fire_at(remind_time, now):
+    """remind_time（HH:MM）下一次觸發的時間；今天已經過了就是明天"""
+    hour, minute = map(int, remind_time.split(":"))
+    fire_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if fire_at <= now:
+        fire_at += datetime.timedelta(days=1)
+    return fire_at
+
+
+class RemindScheduler:
+    def __init__(self):
+        self.owner = uuid.uuid4().hex
+        self._heap = []  # (觸發時間 timestamp, user_id, kind)
+        self._current = {}  # (user_id, kind) -> (remind_time, 觸發時間 timestamp)
+        self._retry_at = None  # 下一次處理重試清單的時間 timestamp
+        self._stop = threading.Event()
+        self._wake = threading.Event()  # remind_changes 有新的變動，或要求停止
+        self.stats = {"fired": 0, "stale": 0, "changes": 0, "users": 0, "retried": 0}
+
+    # ---------- heap ----------
+    def schedule(self, user_id, kind, remind_time, now, catch_up_after=None):
+        """
+        排入下一次觸發；catch_up_after 不為 None 時，
+        今天 (catch_up_after, now] 之間已經錯過的提醒立即觸發
+        """
+        try:
+            fire_at = next_fire_at(remind_time, now)
+        except (ValueError, AttributeError):
+            print(f"[scheduler] 略過格式錯誤的提醒時間：{user_id} {kind} {remind_time}")
+            return
+        if catch_up_after is not None and catch_up_after < remind_time <= now.strftime("%H:%M"):
+            fire_at = now
+        timestamp = fire_at.timestamp()
+        self._current[(user_id, kind)] = (remind_time, timestamp)
+        heapq.heappush(self._heap, (timestamp, user_id, kind))
+
+    def unschedule(self, user_id, kind):
+        self._current.pop((user_id, kind), None)
+
+    def load(self, now):
+        """從提醒索引建立 heap；上次觸發到現在之間錯過的提醒立即補發"""
+        if not is_remind_index_ready():
+            rebuild_remind_index()
+        # 先清掉舊的變動紀錄，索引本身已經是最新狀態
+        pop_remind_changes()
+
+        cursor = get_remind_scheduler_cursor()
+        catch_up_after = cursor.get("time", "") if cursor.get("date") == now.strftime("%Y-%m-%d") else ""
+        self._heap = []
+        self._current = {}
+        for kind in REMIND_KINDS:
+            for remind_time, users in get_remind_index(kind).items():
+                for user_id in (users or {}):
+                    self.schedule(user_id, kind, remind_time, now, catch_up_after)
+        self.stats["users"] = len({user_id for user_id, _ in self._current})
+        # 上一個排程器留下的重試清單立即處理
+        self._retry_at = now.timestamp()
+        print(f"[scheduler] 已排入 {len(self._current)} 個提醒（{self.stats['users']} 位用戶）")
+
+    def apply_changes(self, now):
+        for change in pop_remind_changes():
+            user_id, kind = change.get("user_id"), change.get("kind")
+            if kind not in REMIND_KINDS or not user_id:
+                continue
+            if change.get("time"):
+                # 變動之後到現在之間已經到期的提醒（例如把提醒改到下一分鐘）立即補發
+                changed_at = datetime.datetime.fromtimestamp(change.get("at", now.timestamp()), TZ)
+                self.schedule(user_id, kind, change["time"], now, changed_at.strftime("%H:%M"))
+            else:
+                self.unschedule(user_id, kind)
+            self.stats["changes"] += 1
+
+    def pop_due(self, now):
+        """
+        取出已到期的提醒，並排入隔天的同一時間
+        返回: {user_id: [kind, ...]}
+        """
+        due_users = {}
+        timestamp = now.timestamp()
+        while self._heap and self._heap[0][0] <= timestamp:
+            fire_at, user_id, kind = heapq.heappop(self._heap)
+            current = self._current.get((user_id, kind))
+            if not current or current[1] != fire_at:
+                self.stats["stale"] += 1  # 設定已變更或停用
+                continue
+            due_users.setdefault(user_id, []).append(kind)
+            self.schedule(user_id, kind, current[0], now)
+        return due_users
+
+    # ---------- 觸發 ----------
+    def fire(self, due_users, now, retry_users=()):
+        """
+        讀取到期用戶的資料並發送提醒（檢查與發送帳本與 /remind 相同）
+        失敗的提醒記入重試清單，REMIND_RETRY_DELAY 秒後再處理
+        """
+        sweep_id = uuid.uuid4().hex
+        today_str = now.strftime("%Y-%m-%d")
+        delivery = ReminderDelivery()
+        retries = RemindRetries()
+        with ThreadPoolExecutor(max_workers=max(1, REMIND_SWEEP_CONCURRENCY)) as executor:
+            process_due_users(list(due_users), due_users, {}, now, delivery, executor, sweep_id, retries)
+        stats = delivery.flush()
+        failed = retries.pop_all()
+        save_remind_retries(today_str, retry_users, failed)
+        if failed:
+            self._retry_at = now.timestamp() + REMIND_RETRY_DELAY
+        self.stats["fired"] += len(due_users)
+        save_remind_scheduler_cursor(today_str, now.strftime("%H:%M"))
+        print(f"[scheduler] {now.strftime('%H:%M:%S')} 觸發 {len(due_users)} 位用戶，送達 {stats['recipients']}，"
+              f"待重試 {len(failed)}")
+
+    def pop_retries(self, now):
+        """到了重試時間時讀取重試清單，返回: {user_id: [kind, ...]}"""
+        if self._retry_at is None or self._retry_at > now.timestamp():
+            return {}
+        self._retry_at = None
+        retry_users = {user_id: kinds for user_id, kinds in get_remind_retries(now.strftime("%Y-%m-%d")).items() if kinds}
+        self.stats["retried"] += len(retry_users)
+        return retry_users
+
+    def run_once(self, now=None):
+        """處理設定變動與到期的提醒，返回下一次需要醒來的秒數"""
+        now = now or datetime.datetime.now(TZ)
+        self.apply_changes(now)
+        due_users = self.pop_due(now)
+        retry_users = self.pop_retries(now)
+        for user_id, kinds in retry_users.items():
+            due = due_users.setdefault(user_id, [])
+            due.extend(kind for kind in kinds if kind not in due)
+        if due_users:
+            self.fire(due_users, now, retry_users)
+        # 租約要在過期前延長，最久睡到租約時間的一半
+        wait = min(REMIND_SCHEDULER_POLL, REMIND_LEASE_TTL / 2)
+        if self._heap:
+            wait = min(wait, self._heap[0][0] - time.time())
+        if self._retry_at is not None:
+            wait = min(wait, self._retry_at - time.time())
+        return max(0.0, wait)
+
+    def _watch_changes(self):
+        try:
+            return watch_remind_changes(self._wake.set)
+        except Exception as e:
+            print(f"[scheduler] 無法監聽提醒設定變動：{e}，改為每 {REMIND_SCHEDULER_POLL:g} 秒讀取")
+            return None
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            # 只有取得租約的排程器執行，其他的待命（部署切換時新舊程序短暫重疊）
+            if not acquire_sweep_lease(SCHEDULER_LEASE_NAME, self.owner):
+                self._stop.wait(REMIND_SCHEDULER_POLL)
+                continue
+            watcher = None
+            try:
+                # 先開始監聽再載入，載入期間寫入的變動也會喚醒下一輪
+                watcher = self._watch_changes()
+                self.load(datetime.datetime.now(TZ))
+                while not self._stop.is_set():
+                    self._wake.wait(self.run_once())
+                    self._wake.clear()
+                    if not acquire_sweep_lease(SCHEDULER_LEASE_NAME, self.owner):
+                        print("[scheduler] 租約已被其他排程器接手，轉為待命")
+                        break
+            except Exception as e:
+                print(f"[scheduler] 執行錯誤：{e}，重新載入")
+                self._stop.wait(REMIND_SCHEDULER_POLL)
+            finally:
+                if watcher is not None:
+                    watcher.close()
+        release_sweep_lease(SCHEDULER_LEASE_NAME, self.owner)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+
+if __name__ == "__main__":
+    RemindScheduler().run_forever()
@@ -1,19 +1,7 @@
 import os
 import datetime
 
-from firebase_admin import db
 from line_utils import get_line_display_name
-from firebase_utils import (
-    get_all_user_ids,
-    get_remind_time,  # 未完成作業
-    get_add_task_remind_time,  # 新增作業
-    get_task_remind_enabled,
-    get_add_task_remind_enabled,
-)
-from linebot.v3.messaging import MessagingApi, Configuration, TextMessage
-from linebot.v3.messaging import ApiClient
-
-configuration = Configuration(access_token=os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
 
 def get_rounded_start_time(minutes_ahead=30):
     """
@@ -156,4 +144,252 @@ def format_urgent_tasks(tasks):
         est = task.get("estimated_time", 0)
         urgent_list.append(f"🚨 {name} - 截止：{due} - 需時：{est}小時")
     
-    return "\n".join(urgent_list)
\ No newline at end of file
+    return "\n".join(urgent_list)
+
+# ==================== 本地排程引擎 ====================
+# 不呼叫 Gemini，直接依截止日（Earliest Deadline First）排出時間區塊，
+# 並套用與 prompt 相同的休息／用餐規則。時間不足時以背包法挑選要安排的任務。
+
+SCHEDULE_MODE = os.getenv("SCHEDULE_MODE", "gemini")  # gemini / local / hybrid
+
+MEAL_WINDOWS = [
+    ("午餐", 12 * 60, 13 * 60),
+    ("晚餐", 18 * 60, 19 * 60),
+]
+MIN_PARTIAL_MINUTES = 30  # 剩餘時間少於此值就不再部分安排任務
+
+def _task_minutes(task):
+    """任務需求時間（分鐘），未提供時以 1 小時計"""
+    try:
+        minutes = int(round(float(task.get("estimated_time") or 0) * 60))
+    except (TypeError, ValueError):
+        minutes = 0
+    return minutes if minutes > 0 else 60
+
+def _days_until_due(task, today):
+    due = task.get("due", "未設定")
+    if due == "未設定":
+        return 999
+    try:
+        return (datetime.datetime.strptime(due, "%Y-%m-%d").date() - today).days
+    except:
+        return 999
+
+def _format_minutes(total_minutes):
+    return f"{(total_minutes // 60) % 24:02d}:{total_minutes % 60:02d}"
+
+def _break_policy(work_minutes, budget_minutes):
+    """
+    依工作量決定休息規則，回傳 (間隔分鐘, 休息分鐘, 最多休息次數, 用餐分鐘)
+    與 generate_optimized_schedule_prompt 中的排程原則一致
+    """
+    if work_minutes > budget_minutes:
+        # 時間極度緊張：最多兩次 5 分鐘休息
+        return 120, 5, 2, 15
+    if work_minutes >= 4 * 60:
+        # 時間緊張：每 2 小時休息 10 分鐘
+        return 120, 10, None, 20
+    # 時間充裕：每 90 分鐘休息 15 分鐘
+    return 90, 15, None, 30
+
+def _knapsack(candidates, values, slots, unit):
+    """0/1 背包：在 slots 個時間單位內挑出總價值最大的任務，返回選中的任務"""
+    weights = [-(-_task_minutes(t) // unit) for t in candidates]
+    best = [0.0] * (slots + 1)
+    keep = [[False] * (slots + 1) for _ in candidates]
+    for i, (w, v) in enumerate(zip(weights, values)):
+        for c in range(slots, w - 1, -1):
+            if best[c - w] + v > best[c]:
+                best[c] = best[c - w] + v
+                keep[i][c] = True
+    chosen = []
+    c = slots
+    for i in range(len(candidates) - 1, -1, -1):
+        if keep[i][c]:
+            chosen.append(candidates[i])
+            c -= weights[i]
+    return chosen
+
+def _select_tasks(tasks, capacity, today):
+    """
+    在容量內挑選要安排的任務
+    2 天內截止的任務必定優先，其餘有截止日的任務以 0/1 背包（15 分鐘為單位）
+    最大化「時間 × 急迫權重」；未設定截止日的任務排在所有有截止日的任務之後，
+    只用剩下的容量挑選（以時間為價值）；剩餘容量足夠時，部分安排最優先的未選任務
+    返回: (選中的任務, 未選中的任務, 部分安排的任務, 部分安排的分鐘數)，
+    任務皆維持原本的優先順序
+    """
+    urgent = [t for t in tasks if _days_until_due(t, today) <= 2]
+    dated = [t for t in tasks if 2 < _days_until_due(t, today) < 999]
+    undated = [t for t in tasks if _days_until_due(t, today) >= 999]
+
+    selected_ids = set()
+    partial, partial_minutes = None, 0
+    remaining = capacity
+    for task in urgent:
+        if _task_minutes(task) <= remaining:
+            selected_ids.add(id(task))
+            remaining -= _task_minutes(task)
+        elif partial is None and remaining >= MIN_PARTIAL_MINUTES:
+            # 緊急任務放不下時，先用剩餘時間做一部分
+            partial, partial_minutes = task, remaining
+            remaining = 0
+
+    unit = 15
+    for candidates, weight in (
+        (dated, lambda t: 1.0 + 10.0 / (1 + _days_until_due(t, today))),
+        (undated, lambda t: 1.0),
+    ):
+        slots = remaining // unit
+        if not candidates or slots <= 0:
+            continue
+        for task in _knapsack(candidates, [_task_minutes(t) * weight(t) for t in candidates], slots, unit):
+            selected_ids.add(id(task))
+            remaining -= _task_minutes(task)
+
+    if partial is None and remaining >= MIN_PARTIAL_MINUTES:
+        # 部分安排同樣先考慮有截止日的任務
+        for task in urgent + dated + undated:
+            if id(task) not in selected_ids:
+                partial, partial_minutes = task, remaining
+                break
+
+    selected = [t for t in tasks if id(t) in selected_ids or t is partial]
+    dropped = [t for t in tasks if id(t) not in selected_ids and t is not partial]
+    return selected, dropped, partial, partial_minutes
+
+def build_local_schedule(tasks, available_hours, start_str=None, now=None):
+    """
+    本地產生排程區塊（格式與 flex_utils.extract_schedule_blocks 相同）
+    tasks 需已依優先順序排序
+    返回: (blocks, unscheduled_tasks)
+    """
+    now = now or datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8)))
+    today = now.date()
+    start_str = start_str or get_rounded_start_time()
+    start_hour, start_minute = map(int, start_str.split(':'))
+    start = start_hour * 60 + start_minute
+    budget = int(round(available_hours * 60))
+    end = start + budget
+
+    work_minutes = sum(_task_minutes(t) for t in tasks)
+    interval, break_len, max_breaks, meal_len = _break_policy(work_minutes, budget)
+
+    # 預估休息與用餐佔用的時間，剩下的才是可安排的作業時間
+    pending_meals = []
+    for name, meal_start, meal_end in MEAL_WINDOWS:
+        for day_offset in (0, 24 * 60):
+            if start < meal_end + day_offset and meal_start + day_offset < end:
+                pending_meals.append((name, meal_start + day_offset))
+    pending_meals.sort(key=lambda m: m[1])
+    estimated_breaks = budget // (interval + break_len)
+    if max_breaks is not None:
+        estimated_breaks = min(estimated_breaks, max_breaks)
+    capacity = budget - estimated_breaks * break_len - len(pending_meals) * meal_len
+
+    selected, dropped, partial, partial_minutes = _select_tasks(tasks, max(capacity, 0), today)
+
+    queue = [[t, _task_minutes(t) if t is not partial else partial_minutes] for t in selected]
+    blocks = []
+    cursor = start
+    since_break = 0
+    breaks_taken = 0
+
+    def add_block(name, minutes, category, emoji):
+        nonlocal cursor
+        if blocks and blocks[-1]['task'] == name and blocks[-1]['end'] == _format_minutes(cursor):
+            merged = int(blocks[-1]['duration'].replace('分鐘', '')) + minutes
+            blocks[-1]['duration'] = f"{merged}分鐘"
+            blocks[-1]['end'] = _format_minutes(cursor + minutes)
+        else:
+            blocks.append({
+                'start': _format_minutes(cursor),
+                'end': _format_minutes(cursor + minutes),
+                'task': name,
+                'duration': f"{minutes}分鐘",
+                'category': category,
+                'emoji': emoji
+            })
+        cursor += minutes
+
+    while queue and cursor < end:
+        # 用餐時間到了就先用餐
+        if pending_meals and cursor >= pending_meals[0][1]:
+            meal_name, _ = pending_meals.pop(0)
+            minutes = min(meal_len, end - cursor)
+            add_block(meal_name, minutes, "用餐", "🥪")
+            since_break = 0
+            continue
+
+        task, remaining = queue[0]
+        chunk = min(remaining, end - cursor)
+        if max_breaks is None or breaks_taken < max_breaks:
+            chunk = min(chunk, interval - since_break)
+        if pending_meals:
+            chunk = min(chunk, pending_meals[0][1] - cursor)
+        chunk = max(chunk, 1)
+
+        days = _days_until_due(task, today)
+        name = task.get("task", "未命名") + ("（部分）" if task is partial else "")
+        add_block(name, chunk, "緊急" if days <= 2 else task.get("category", "未分類"), "📖")
+        since_break += chunk
+        queue[0][1] -= chunk
+        if queue[0][1] <= 0:
+            queue.pop(0)
+
+        # 工作達到間隔時間且還有作業要做，插入休息
+        needs_break = since_break >= interval and (max_breaks is None or breaks_taken < max_breaks)
+        if needs_break and sum(q[1] for q in queue) >= 15 and cursor + break_len < end:
+            add_block("短暫休息", break_len, "休息", "☕")
+            since_break = 0
+            breaks_taken += 1
+
+    # 只部分安排或因時間不足沒排完的任務，也列入未完成
+    unfinished_ids = {id(t) for t in dropped} | {id(t) for t, _ in queue}
+    if partial is not None:
+        unfinished_ids.add(id(partial))
+    unscheduled = [t for t in tasks if id(t) in unfinished_ids]
+    return blocks, unscheduled
+
+def describe_local_schedule(blocks, unscheduled, available_hours, summary=None):
+    """
+    產生本地排程的說明文字（格式與 Gemini 回覆的說明段落相同）
+    summary：自訂的策略說明（例如 Gemini 撰寫的文字），未提供時使用預設說明
+    """
+    work_minutes = sum(int(b['duration'].replace('分鐘', '')) for b in blocks if b['category'] not in ("休息", "用餐"))
+    rest_minutes = sum(int(b['duration'].replace('分鐘', '')) for b in blocks if b['category'] in ("休息", "用餐"))
+
+    lines = ["📝 排程說明："]
+    if summary:
+        lines.append(summary)
+    elif unscheduled:
+        lines.append("今天的時間不足以完成所有作業，已優先安排即將截止的項目。")
+    else:
+        lines.append("依截止日期由近到遠安排作業，並穿插休息時間。")
+    lines.append("")
+    lines.append("💡 時間分配：")
+    lines.append(f"- 作業時間：{work_minutes / 60:.1f} 小時")
+    lines.append(f"- 休息時間：{rest_minutes / 60:.1f} 小時")
+    lines.append(f"- 總計：{(work_minutes + rest_minutes) / 60:.1f} 小時（可用 {available_hours} 小時）")
+    lines.append("")
+    lines.append("⚠️ 未能安排的任務：")
+    if unscheduled:
+        for task in unscheduled:
+            lines.append(f"- {task.get('task', '未命名')}（截止：{task.get('due', '未設定')}）")
+    else:
+        lines.append("無")
+    return "\n".join(lines)
+
+def generate_schedule_explanation_prompt(blocks, unscheduled, available_hours):
+    """請 Gemini 只撰寫排程說明（排程本身已由本地引擎產生）"""
+    schedule_lines = [f"{b['start']} ~ {b['end']}｜{b['task']}（{b['duration']}）" for b in blocks]
+    unscheduled_names = "、".join(t.get("task", "未命名") for t in unscheduled) or "無"
+    return f"""
+以下是已經排好的今日學習排程（可用時間 {available_hours} 小時），請不要修改排程內容。
+請用 2-4 句繁體中文說明今天的安排策略與注意事項，只回傳說明文字。
+
+排程：
+{chr(10).join(schedule_lines)}
+
+今天無法安排的任務：{unscheduled_names}
+"""
@@ -0,0 +1,167 @@
+# ==================== 對話 Session ====================
+# 多步驟流程的暫存資料（state、temp_task、批次選擇）合併成一個 session 物件，
+# 存在 users/{id}/session，整包讀寫：
+# 1. 程序層（LRU + TTL，預設停用）：同一個 worker 處理下一步時不需要讀取儲存後端。
+#    沒有跨 worker 的失效機制，只適合單一 worker 的部署（SESSION_CACHE_TTL > 0 時啟用）
+# 2. 共用層（選填，SESSION_SHARED_DB）：同一台機器上多個 worker 共用的 SQLite，
+#    設定後讀取改以共用層為準，避免 worker 之間看到過期的 session
+# 在請求範圍內（begin_request / end_request 之間）的修改先累積，請求結束時才寫回一次；
+# 請求範圍外（排程、提醒等）則立即寫回。
+
+import os
+import copy
+import time
+import threading
+from collections import OrderedDict
+
+from storage import get_storage, SQLiteStorage
+
+# 多個 worker / 實例時，下一則訊息可能落在另一個 worker，程序層的 session 會是過期的，預設不快取
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "0"))
+SESSION_CACHE_MAX_USERS = int(os.getenv("SESSION_CACHE_MAX_USERS", "1000"))
+SESSION_SHARED_DB = os.getenv("SESSION_SHARED_DB", "")
+
+_sessions = OrderedDict()  # user_id -> (expires_at, session)
+_lock = threading.Lock()
+_request = threading.local()
+_stats = {"memory_hits": 0, "shared_hits": 0, "loads": 0, "flushes": 0, "deferred_writes": 0}
+_shared = None
+_shared_lock = threading.Lock()
+
+def _count(kind, amount=1):
+    with _lock:
+        _stats[kind] += amount
+
+def _path(user_id):
+    return f"users/{user_id}/session"
+
+def _get_shared():
+    global _shared
+    if not SESSION_SHARED_DB:
+        return None
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = SQLiteStorage(SESSION_SHARED_DB)
+    return _shared
+
+def _remember(user_id, session):
+    if SESSION_CACHE_TTL <= 0:
+        return
+    with _lock:
+        _sessions[user_id] = (time.monotonic() + SESSION_CACHE_TTL, copy.deepcopy(session))
+        _sessions.move_to_end(user_id)
+        while len(_sessions) > SESSION_CACHE_MAX_USERS:
+            _sessions.popitem(last=False)
+
+def invalidate_session(user_id):
+    with _lock:
+        _sessions.pop(user_id, None)
+
+def _load(user_id, batch=None):
+    # 同一批次內先前的修改尚未寫入，以批次中的 session 為準
+    if batch is not None and _path(user_id) in batch.updates:
+        return copy.deepcopy(batch.updates[_path(user_id)] or {})
+
+    dirty = getattr(_request, "dirty", None)
+    if dirty is not None and user_id in dirty:
+        return copy.deepcopy(dirty[user_id])
+
+    shared = _get_shared()
+    if shared is None and SESSION_CACHE_TTL > 0:
+        with _lock:
+            entry = _sessions.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                _sessions.move_to_end(user_id)
+                session = copy.deepcopy(entry[1])
+            else:
+                if entry:
+                    del _sessions[user_id]
+                session = None
+        if session is not None:
+            _count("memory_hits")
+            return session
+
+    if shared is not None:
+        session = shared.get(_path(user_id))
+        if session is not None:
+            _count("shared_hits")
+            return session
+
+    _count("loads")
+    session = get_storage().get(_path(user_id)) or {}
+    _remember(user_id, session)
+    if shared is not None and session:
+        shared.set(_path(user_id), session)
+    return session
+
+def _write(user_id, session):
+    storage = get_storage()
+    if session:
+        storage.set(_path(user_id), session)
+    else:
+        storage.delete(_path(user_id))
+    _count("flushes")
+
+def get_session_value(user_id, field, default=None):
+    value = _load(user_id).get(field)
+    return default if value is None else value
+
+def get_session_values(user_id, *fields):
+    """一次讀取多個欄位，返回 tuple（不存在的欄位為 None）"""
+    session = _load(user_id)
+    return tuple(session.get(field) for field in fields)
+
+def set_session_values(user_id, batch=None, **values):
+    """
+    修改 session 欄位（值為 None 表示刪除該欄位）
+    傳入 batch 時整個 session 併入批次寫入（同一批次的多次修改會累加）；
+    請求範圍內延後到請求結束；否則立即寫回
+    """
+    session = _load(user_id, batch)
+    for field, value in values.items():
+        if value is None:
+            session.pop(field, None)
+        else:
+            session[field] = value
+
+    _remember(user_id, session)
+    shared = _get_shared()
+    if shared is not None:
+        if session:
+            shared.set(_path(user_id), session)
+        else:
+            shared.delete(_path(user_id))
+
+    dirty = getattr(_request, "dirty", None)
+    if batch is not None:
+        if dirty is not None:
+            dirty.pop(user_id, None)
+        batch.set(_path(user_id), copy.deepcopy(session) or None)
+        batch.after_commit(None, on_failure=lambda: invalidate_session(user_id))
+    elif dirty is not None:
+        dirty[user_id] = copy.deepcopy(session)
+        _count("deferred_writes")
+    else:
+        _write(user_id, session)
+
+def begin_request():
+    _request.dirty = {}
+
+def end_request():
+    """請求結束時寫回有變動的 session，每位用戶一次寫入"""
+    dirty = getattr(_request, "dirty", None) or {}
+    _request.dirty = None
+    for user_id, session in dirty.items():
+        try:
+            _write(user_id, session)
+        except Exception as e:
+            # 寫回失敗時程序層的資料與遠端不一致，讓下一次重新讀取
+            invalidate_session(user_id)
+            print(f"[session] 寫回用戶 {user_id} 的 session 失敗：{e}")
+
+def get_session_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats["cached_users"] = len(_sessions)
+    return stats
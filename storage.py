@@ -0,0 +1,302 @@
+# ==================== 儲存後端 ====================
+# firebase_utils 的所有讀寫都經過這裡的介面，以 RTDB 的路徑語意操作（get / set / update / delete）。
+# STORAGE_BACKEND 選擇實作：
+# - firebase（預設）：Firebase Realtime Database
+# - sqlite：本機 SQLite（WAL 模式），適合單機部署與可重現的效能測試，不需要 Firebase 專案
+# SQLite 以「葉節點完整路徑 → JSON 值」一列儲存，路徑為主鍵（WITHOUT ROWID 叢集索引），
+# 讀取某個節點即是一次主鍵範圍掃描。
+
+import os
+import json
+import atexit
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firebase")  # firebase / sqlite
+SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "homework_bot.db")
+
+
+class StorageBackend:
+    """儲存介面；path 為相對於根節點的路徑（如 users/{id}/tasks），空字串代表根節點"""
+
+    def get(self, path, shallow=False):
+        """讀取節點；shallow=True 時只回傳一層子節點（物件以 True 表示，純值直接回傳）"""
+        raise NotImplementedError
+
+    def get_with_etag(self, path):
+        """返回: (值, etag)"""
+        raise NotImplementedError
+
+    def set_if_unchanged(self, path, etag, value):
+        """etag 相符時寫入；返回: (是否成功, 目前的值, 目前的 etag)"""
+        raise NotImplementedError
+
+    def get_key_range(self, path, start_at=None, end_at=None):
+        """依 key 排序讀取子節點，只回傳 start_at <= key <= end_at 的部分"""
+        raise NotImplementedError
+
+    def set(self, path, value):
+        raise NotImplementedError
+
+    def update(self, path, values):
+        """多路徑更新：values 的 key 為相對於 path 的子路徑，值為 None 表示刪除，全部成功或全部失敗"""
+        raise NotImplementedError
+
+    def delete(self, path):
+        raise NotImplementedError
+
+    def listen(self, path, callback):
+        """
+        監聽 path 底下的變動，callback(相對路徑, 新的值) 在背景執行緒呼叫（值為 None 表示刪除）
+        返回: 有 close() 的物件；不支援監聽時返回 None，呼叫端改為定期讀取
+        """
+        return None
+
+
+class FirebaseStorage(StorageBackend):
+    """Firebase Realtime Database"""
+
+    def __init__(self):
+        import firebase_admin
+        from firebase_admin import credentials, db
+
+        cred_json = os.getenv("GOOGLE_CREDENTIALS")
+        if not cred_json:
+            raise Exception("GOOGLE_CREDENTIALS 環境變數未設定")
+
+        cred_dict = json.loads(cred_json)
+        cred_dict["private_key"] = cred_dict["private_key"].replace("\\n", "\n")
+
+        with tempfile.NamedTemporaryFile(mode="w+", delete=False, suffix=".json") as temp:
+            self._temp_file_path = temp.name
+            json.dump(cred_dict, temp)
+            temp.flush()
+            cred = credentials.Certificate(temp.name)
+            firebase_admin.initialize_app(cred, {
+                'databaseURL': os.getenv("FIREBASE_DB_URL")
+            })
+        atexit.register(self._cleanup_temp_file)
+        self._db = db
+
+    def _cleanup_temp_file(self):
+        if self._temp_file_path and os.path.exists(self._temp_file_path):
+            try:
+                os.unlink(self._temp_file_path)
+                print(f"已清理暫存檔案：{self._temp_file_path}")
+            except Exception as e:
+                print(f"清理暫存檔案失敗：{e}")
+
+    def _ref(self, path):
+        return self._db.reference(path or "/")
+
+    def get(self, path, shallow=False):
+        return self._ref(path).get(shallow=shallow)
+
+    def get_with_etag(self, path):
+        return self._ref(path).get(etag=True)
+
+    def set_if_unchanged(self, path, etag, value):
+        return self._ref(path).set_if_unchanged(etag, value)
+
+    def get_key_range(self, path, start_at=None, end_at=None):
+        query = self._ref(path).order_by_key()
+        if start_at:
+            query = query.start_at(start_at)
+        if end_at:
+            query = query.end_at(end_at)
+        return query.get() or {}
+
+    def listen(self, path, callback):
+        # RTDB 的串流連線（SSE），由 SDK 的背景執行緒接收事件
+        return self._ref(path).listen(lambda event: callback(event.path, event.data))
+
+    def set(self, path, value):
+        self._ref(path).set(value)
+
+    def update(self, path, values):
+        self._ref(path).update(values)
+
+    def delete(self, path):
+        self._ref(path).delete()
+
+
+def _join(path, key):
+    return f"{path}/{key}" if path else key
+
+def _etag(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def _flatten(path, value, rows):
+    """把 JSON 值攤平成 (葉節點路徑, JSON) 列；空的 dict / list 與 None 不儲存（與 RTDB 相同）"""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            _flatten(_join(path, str(key)), child, rows)
+    elif isinstance(value, (list, tuple)):
+        for index, child in enumerate(value):
+            _flatten(_join(path, str(index)), child, rows)
+    elif value is not None:
+        rows.append((path, json.dumps(value, ensure_ascii=False)))
+
+def _as_list(node):
+    """子節點 key 全是連續性足夠的數字時，與 RTDB 一樣回傳列表"""
+    if not node or not all(key.isdigit() for key in node):
+        return node
+    max_index = max(int(key) for key in node)
+    if max_index + 1 > 2 * len(node):
+        return node
+    return [node.get(str(i)) for i in range(max_index + 1)]
+
+def _finalize(node):
+    if not isinstance(node, dict):
+        return node
+    return _as_list({key: _finalize(child) for key, child in node.items()})
+
+
+class SQLiteStorage(StorageBackend):
+    """本機 SQLite（WAL 模式）；同一程序內以鎖序列化，跨程序由 SQLite 的交易保證一致"""
+
+    def __init__(self, db_path=SQLITE_DB_PATH):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS nodes (path TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID"
+        )
+        self._lock = threading.Lock()
+
+    # ---- 底層操作（呼叫端須持有鎖）----
+
+    def _rows(self, path):
+        if not path:
+            return self._conn.execute("SELECT path, value FROM nodes").fetchall()
+        # 子節點路徑介於 "path/" 與 "path0" 之間（"0" 是 "/" 的下一個字元）
+        return self._conn.execute(
+            "SELECT path, value FROM nodes WHERE path = ? OR (path > ? AND path < ?)",
+            (path, path + "/", path + "0")
+        ).fetchall()
+
+    def _read(self, path):
+        rows = self._rows(path)
+        if not rows:
+            return None
+        prefix_len = len(path) + 1 if path else 0
+        root = {}
+        for row_path, value in rows:
+            if row_path == path:
+                return json.loads(value)
+            parts = row_path[prefix_len:].split("/")
+            node = root
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = json.loads(value)
+        return _finalize(root)
+
+    def _delete(self, path):
+        if not path:
+            self._conn.execute("DELETE FROM nodes")
+            return
+        self._conn.execute(
+            "DELETE FROM nodes WHERE path = ? OR (path > ? AND path < ?)",
+            (path, path + "/", path + "0")
+        )
+
+    def _write(self, path, value):
+        self._delete(path)
+        # 上層原本是葉節點（純值）時，寫入子節點會取代它
+        parts = path.split("/")
+        ancestors = ["/".join(parts[:i]) for i in range(1, len(parts))]
+        if ancestors:
+            self._conn.executemany("DELETE FROM nodes WHERE path = ?", [(a,) for a in ancestors])
+        rows = []
+        _flatten(path, value, rows)
+        if rows:
+            self._conn.executemany("INSERT INTO nodes (path, value) VALUES (?, ?)", rows)
+
+    def _transaction(self, action):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = action()
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    # ---- 介面 ----
+
+    def get(self, path, shallow=False):
+        path = path.strip("/")
+        with self._lock:
+            value = self._read(path)
+        if shallow and isinstance(value, list):
+            value = {str(i): child for i, child in enumerate(value) if child is not None}
+        if shallow and isinstance(value, dict):
+            # 與 RTDB 相同：子節點為純值時回傳值本身，否則回傳 True
+            return {key: True if isinstance(child, (dict, list)) else child for key, child in value.items()}
+        return value
+
+    def get_with_etag(self, path):
+        value = self.get(path)
+        return value, _etag(value)
+
+    def set_if_unchanged(self, path, etag, value):
+        path = path.strip("/")
+
+        def action():
+            current = self._read(path)
+            if _etag(current) != etag:
+                return False, current, _etag(current)
+            self._write(path, value)
+            written = self._read(path)
+            return True, written, _etag(written)
+
+        return self._transaction(action)
+
+    def get_key_range(self, path, start_at=None, end_at=None):
+        node = self.get(path)
+        if isinstance(node, list):
+            node = {str(i): child for i, child in enumerate(node) if child is not None}
+        return {
+            key: node[key] for key in sorted(node or {})
+            if (start_at is None or key >= start_at) and (end_at is None or key <= end_at)
+        }
+
+    def set(self, path, value):
+        path = path.strip("/")
+        self._transaction(lambda: self._write(path, value))
+
+    def update(self, path, values):
+        path = path.strip("/")
+
+        def action():
+            for key, value in values.items():
+                self._write(_join(path, key.strip("/")), value)
+
+        self._transaction(action)
+
+    def delete(self, path):
+        path = path.strip("/")
+        self._transaction(lambda: self._delete(path))
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def get_storage():
+    """依 STORAGE_BACKEND 建立（並重用）儲存後端"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "sqlite":
+                    _storage = SQLiteStorage()
+                    print(f"[storage] 使用 SQLite：{SQLITE_DB_PATH}")
+                elif STORAGE_BACKEND == "firebase":
+                    _storage = FirebaseStorage()
+                else:
+                    raise ValueError(f"不支援的 STORAGE_BACKEND：{STORAGE_BACKEND}")
+    return _storage
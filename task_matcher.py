@@ -0,0 +1,174 @@
+# ==================== 本地作業比對 ====================
+# 自然語言完成作業時，先在本地比對使用者說的是哪一個未完成作業：
+# - 字元 bigram 的 Dice 相似度 + 最長共同子字串
+# - 句子中提到的分類、截止日（如「明天要交的」）作為加分
+# 分數即信心度（0-1），與流程原本的 0.5 門檻相同；
+# 前兩名太接近時標記為 ambiguous，交由 Gemini 在候選之間判斷。
+
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+
+from date_utils import parse_due_date
+
+MATCH_TIE_MARGIN = 0.1  # 第一名與第二名差距小於此值視為平手
+MATCH_MIN_SCORE = 0.5
+_INDEX_CACHE_MAX_USERS = 500
+
+_PUNCT_PATTERN = re.compile(r"[\s，。！？、,.!?~～「」『』\"'：:；;（）()]+")
+_FILLER_PATTERN = re.compile(
+    r"(我已經|我|已經|剛剛|剛|終於|把|將|完成了|完成|寫完了|寫完|做完了|做完|交了|交完了|交完|"
+    r"弄好了|弄好|搞定了|搞定|結束了|好了|了|的|啦|囉|喔|哦|耶|呢)"
+)
+
+def _normalize(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _PUNCT_PATTERN.sub("", text)
+
+def _bigrams(text):
+    if len(text) < 2:
+        return Counter([text]) if text else Counter()
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+def _dice(a, b):
+    total = sum(a.values()) + sum(b.values())
+    if not total:
+        return 0.0
+    return 2 * sum((a & b).values()) / total
+
+def _longest_common_substring(a, b):
+    if not a or not b:
+        return 0
+    best = 0
+    previous = [0] * (len(b) + 1)
+    for ch_a in a:
+        current = [0] * (len(b) + 1)
+        for j, ch_b in enumerate(b, 1):
+            if ch_a == ch_b:
+                current[j] = previous[j - 1] + 1
+                best = max(best, current[j])
+        previous = current
+    return best
+
+
+class TaskIndex:
+    """單一用戶未完成作業的 bigram 反向索引"""
+
+    def __init__(self, tasks):
+        self.entries = {}  # task_index -> (正規化名稱, bigrams, 分類)
+        self.postings = {}  # bigram / 單字 -> {task_index}
+        for i, task in enumerate(tasks):
+            if task.get("done", False):
+                continue
+            name = _normalize(task.get("task", ""))
+            if not name:
+                continue
+            grams = _bigrams(name)
+            self.entries[i] = (name, grams, _normalize(task.get("category", "")))
+            for key in set(grams) | set(name):
+                self.postings.setdefault(key, set()).add(i)
+
+    def candidates(self, query):
+        found = set()
+        for key in set(_bigrams(query)) | set(query):
+            found |= self.postings.get(key, set())
+        return found
+
+
+_index_cache = OrderedDict()  # user_id -> (簽章, TaskIndex)
+_index_lock = threading.Lock()
+
+def _task_signature(tasks):
+    return tuple(
+        (task.get("task"), task.get("done", False), task.get("category"), task.get("due"))
+        for task in tasks
+    )
+
+def get_task_index(user_id, tasks):
+    """取得用戶的作業索引，作業列表沒變時直接重用"""
+    if user_id is None:
+        return TaskIndex(tasks)
+    signature = _task_signature(tasks)
+    with _index_lock:
+        cached = _index_cache.get(user_id)
+        if cached and cached[0] == signature:
+            _index_cache.move_to_end(user_id)
+            return cached[1]
+    index = TaskIndex(tasks)
+    with _index_lock:
+        _index_cache[user_id] = (signature, index)
+        _index_cache.move_to_end(user_id)
+        while len(_index_cache) > _INDEX_CACHE_MAX_USERS:
+            _index_cache.popitem(last=False)
+    return index
+
+def _score(query, name, grams, category, due, query_due):
+    """回傳 (分數, 原因)"""
+    if name in query:
+        score, reason = 1.0, "句子中包含完整作業名稱"
+    else:
+        lcs = _longest_common_substring(query, name)
+        dice = _dice(_bigrams(query), grams)
+        score = 0.6 * (lcs / len(name)) + 0.4 * dice
+        if len(query) >= 2 and query in name:
+            # 只說了名稱的一部分（如「作業系統」→「作業系統期中報告」）
+            score = max(score, 0.7 + 0.3 * len(query) / len(name))
+        reason = f"名稱相似度 {score:.2f}"
+
+    hints = []
+    if category and category not in ("未分類",) and category in query and category not in name:
+        score += 0.1
+        hints.append("分類相符")
+    if query_due and due == query_due:
+        score += 0.15
+        hints.append("截止日相符")
+    if hints:
+        reason += "，" + "、".join(hints)
+    return min(score, 1.0), reason
+
+def match_task(text, tasks, user_id=None):
+    """
+    在未完成作業中找出使用者指的是哪一個
+    返回格式與 parse_complete_task_from_text 相同（task_index / task_name / confidence / reason），
+    另外加上 ambiguous（前兩名分數太接近）與 candidates（平手的作業索引）；沒有任何候選時回傳 None
+    """
+    raw = _normalize(text)
+    query = _FILLER_PATTERN.sub("", raw) or raw
+    if not query:
+        return None
+
+    index = get_task_index(user_id, tasks)
+    query_due, _ = parse_due_date(text)
+
+    scored = []
+    for i in index.candidates(query):
+        name, grams, category = index.entries[i]
+        score, reason = _score(query, name, grams, category, tasks[i].get("due"), query_due)
+        scored.append((score, i, reason))
+    # 只有截止日提示時（如「明天要交的那個」），依截止日找
+    if query_due:
+        for i in index.entries:
+            if tasks[i].get("due") == query_due and i not in {s[1] for s in scored}:
+                scored.append((0.55, i, "截止日相符"))
+    if not scored:
+        return None
+
+    # 句子同時包含「作業系統」與「作業系統期中報告」時，較短的名稱只是較長名稱的一部分
+    contained = [index.entries[i][0] for _, i, _ in scored if index.entries[i][0] in query]
+    scored = [
+        item for item in scored
+        if not any(index.entries[item[1]][0] in other and index.entries[item[1]][0] != other for other in contained)
+    ]
+
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    top_score, top_index, reason = scored[0]
+    tied = [i for score, i, _ in scored if score >= MATCH_MIN_SCORE and top_score - score < MATCH_TIE_MARGIN]
+    return {
+        "task_index": top_index,
+        "task_name": tasks[top_index].get("task", "未命名"),
+        "confidence": round(top_score, 3),
+        "reason": reason,
+        "ambiguous": len(tied) > 1,
+        "candidates": tied
+    }
@@ -0,0 +1,190 @@
+# ==================== 作業列表卡片 ====================
+# 「查看作業」與未完成作業提醒共用同一張作業列表卡片。
+# 每位用戶快取最後一次產生的卡片 JSON，鍵為作業列表內容與日期（過期標記依日期而變）的雜湊：
+# 作業沒有變動時，每天的提醒與重複查看都直接重用序列化好的 JSON，不再重建整個表格；
+# 送出時也直接使用這份 JSON，不經過 SDK 模型的逐層解析與轉換（一張 20 列的表格約省下 25ms）。
+
+import os
+import json
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+
+from pydantic.v1 import PrivateAttr
+from linebot.v3.messaging.models import FlexMessage, FlexContainer
+
+VIEW_CACHE_MAX_USERS = int(os.getenv("VIEW_CACHE_MAX_USERS", "1000"))
+
+_view_cache = OrderedDict()  # user_id -> (雜湊, 卡片 JSON)
+_view_lock = threading.Lock()
+_view_stats = {"hits": 0, "renders": 0}
+
+class PrerenderedFlexContainer(FlexContainer):
+    """已序列化的 Flex 卡片，to_dict() 直接回傳快取的 JSON"""
+    _rendered = PrivateAttr()
+
+    def __init__(self, rendered):
+        super().__init__(type=json.loads(rendered)["type"])
+        self._rendered = rendered
+
+    def to_dict(self):
+        return json.loads(self._rendered)
+
+
+def _today():
+    return datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=8))).date()
+
+def _task_row(task, now_date):
+    is_done = task.get("done", False)
+    due_date = task.get("due", "未設定")
+
+    # 判斷是否過期
+    is_expired = False
+    if due_date != "未設定" and not is_done:
+        try:
+            is_expired = datetime.datetime.strptime(due_date, "%Y-%m-%d").date() < now_date
+        except:
+            pass
+
+    if is_done:
+        status_text, status_color = "✅", "#1DB446"
+    elif is_expired:
+        status_text, status_color = "⏰", "#FF5551"
+    else:
+        status_text, status_color = "⏳", "#FFAA00"
+
+    if due_date == "未設定":
+        due_display = "未設定"
+    else:
+        try:
+            due_display = datetime.datetime.strptime(due_date, "%Y-%m-%d").strftime("%m/%d")
+        except:
+            due_display = "(未設定)"
+
+    return {
+        "type": "box",
+        "layout": "horizontal",
+        "spacing": "sm",
+        "margin": "sm",
+        "contents": [
+            {"type": "text", "text": task.get("task", "未命名"), "size": "sm", "flex": 2, "wrap": True, "color": "#666666" if is_done else "#333333"},
+            {"type": "text", "text": task.get("category", "-"), "size": "xs", "flex": 1, "align": "center", "color": "#888888"},
+            {"type": "text", "text": f"{task.get('estimated_time', 0)}h", "size": "xs", "flex": 1, "align": "center", "color": "#888888"},
+            {"type": "text", "text": due_display, "size": "xs", "flex": 1, "align": "center", "color": "#FF5551" if is_expired else "#888888"},
+            {"type": "text", "text": status_text, "size": "sm", "flex": 1, "align": "center", "color": status_color}
+        ]
+    }
+
+def _stat_box(value, label, color=None):
+    number = {"type": "text", "text": str(value), "size": "xl", "weight": "bold", "align": "center"}
+    if color:
+        number["color"] = color
+    return {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [number, {"type": "text", "text": label, "size": "sm", "color": "#666666", "align": "center"}],
+        "flex": 1
+    }
+
+def build_task_table_bubble(tasks, now_date=None):
+    """建立一頁式作業列表表格（bubble dict）"""
+    now_date = now_date or _today()
+    completed_tasks = len([t for t in tasks if t.get("done", False)])
+
+    table_contents = [
+        {"type": "text", "text": "📋 作業列表", "weight": "bold", "size": "xl", "color": "#1DB446"},
+        {"type": "separator", "margin": "md"},
+        {
+            "type": "box",
+            "layout": "horizontal",
+            "spacing": "md",
+            "margin": "md",
+            "contents": [
+                _stat_box(len(tasks), "總計"),
+                _stat_box(len(tasks) - completed_tasks, "待完成", "#FF5551"),
+                _stat_box(completed_tasks, "已完成", "#1DB446")
+            ]
+        },
+        {"type": "separator", "margin": "md"},
+        {
+            "type": "box",
+            "layout": "horizontal",
+            "spacing": "sm",
+            "margin": "md",
+            "contents": [
+                {"type": "text", "text": "作業名稱", "size": "sm", "weight": "bold", "flex": 2},
+                {"type": "text", "text": "類型", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
+                {"type": "text", "text": "時間", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
+                {"type": "text", "text": "截止日", "size": "sm", "weight": "bold", "flex": 1, "align": "center"},
+                {"type": "text", "text": "狀態", "size": "sm", "weight": "bold", "flex": 1, "align": "center"}
+            ]
+        },
+        {"type": "separator", "margin": "sm"}
+    ]
+
+    for i, task in enumerate(tasks):
+        table_contents.append(_task_row(task, now_date))
+        # 添加分隔線（除了最後一個）
+        if i < len(tasks) - 1:
+            table_contents.append({"type": "separator", "margin": "sm", "color": "#EEEEEE"})
+
+    return {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "none",
+            "contents": table_contents
+        },
+        "footer": {
+            "type": "box",
+            "layout": "horizontal",
+            "spacing": "sm",
+            "contents": [
+                {"type": "button", "action": {"type": "postback", "label": "✅ 完成作業", "data": "complete_task"}, "style": "primary", "flex": 1},
+                {"type": "button", "action": {"type": "postback", "label": "➕ 新增作業", "data": "add_task"}, "style": "secondary", "flex": 1}
+            ]
+        }
+    }
+
+def _tasks_digest(tasks, now_date):
+    payload = json.dumps([now_date.isoformat(), tasks], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def render_task_table(user_id, tasks):
+    """返回作業列表卡片的 JSON 字串；作業與日期都沒變時直接使用快取"""
+    now_date = _today()
+    digest = _tasks_digest(tasks, now_date)
+    if user_id is not None:
+        with _view_lock:
+            cached = _view_cache.get(user_id)
+            if cached and cached[0] == digest:
+                _view_cache.move_to_end(user_id)
+                _view_stats["hits"] += 1
+                return cached[1]
+
+    rendered = json.dumps(build_task_table_bubble(tasks, now_date), ensure_ascii=False)
+    with _view_lock:
+        _view_stats["renders"] += 1
+        if user_id is not None and VIEW_CACHE_MAX_USERS > 0:
+            _view_cache[user_id] = (digest, rendered)
+            _view_cache.move_to_end(user_id)
+            while len(_view_cache) > VIEW_CACHE_MAX_USERS:
+                _view_cache.popitem(last=False)
+    return rendered
+
+def build_view_tasks_message(tasks, user_id=None):
+    """建立作業列表 Flex Message，沒有作業時回傳 None；提供 user_id 時使用卡片快取"""
+    if not tasks:
+        return None
+    return FlexMessage(
+        alt_text="作業列表",
+        contents=PrerenderedFlexContainer(render_task_table(user_id, tasks))
+    )
+
+def get_view_cache_stats():
+    with _view_lock:
+        stats = dict(_view_stats)
+        stats["cached_users"] = len(_view_cache)
+    return stats
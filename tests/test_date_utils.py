@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+from date_utils import parse_due_date, parse_chinese_number
+
+WEDNESDAY = datetime.date(2026, 1, 28)
+DECEMBER = datetime.date(2026, 12, 20)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("明天", "2026-01-29"),
+    ("後天", "2026-01-30"),
+    ("大後天", "2026-01-31"),
+    ("3天後", "2026-01-31"),
+    ("兩週後", "2026-02-11"),
+    ("六月十日", "2026-06-10"),
+    ("十二月三十一日", "2026-12-31"),
+    ("6/10", "2026-06-10"),
+])
+def test_relative_and_month_day(text, expected):
+    assert parse_due_date(text, WEDNESDAY)[0] == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("這週五", "2026-01-30"),
+    ("下週一", "2026-02-02"),
+    ("下下週二", "2026-02-10"),
+    ("下禮拜天", "2026-02-08"),
+    # 沒有前綴時是最近的那一天（含今天）
+    ("週三", "2026-01-28"),
+    ("週一", "2026-02-02"),
+    ("星期日", "2026-02-01"),
+])
+def test_relative_weekdays(text, expected):
+    assert parse_due_date(text, WEDNESDAY)[0] == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("下個月5號", "2027-01-05"),
+    ("1/5", "2027-01-05"),  # 今年已經過了，算明年
+    ("12/25", "2026-12-25"),
+    ("下週五", "2026-12-25"),
+    ("2週後", "2027-01-03"),
+])
+def test_month_and_year_rollover(text, expected):
+    assert parse_due_date(text, DECEMBER)[0] == expected
+
+
+@pytest.mark.parametrize("text, today", [
+    ("2/30", datetime.date(2026, 3, 1)),
+    ("下個月31號", datetime.date(2026, 1, 15)),
+    ("我要睡覺", WEDNESDAY),
+])
+def test_invalid_or_missing_dates(text, today):
+    assert parse_due_date(text, today) == (None, None)
+
+
+def test_matched_fragment_is_returned():
+    assert parse_due_date("下週一要交作業系統", WEDNESDAY) == ("2026-02-02", "下週一")
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("十二", 12), ("二十", 20), ("兩", 2), ("十", 10), ("7", 7), ("十十", None), ("abc", None),
+])
+def test_parse_chinese_number(text, expected):
+    assert parse_chinese_number(text) == expected
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+import flow_context
+from flow_context import pack, unpack, attach_to_bubble, POSTBACK_DATA_LIMIT
+
+TEMP_TASK = {"id": "t1", "task": "英文報告", "estimated_time": 2.0, "category": "報告", "due": "2030-01-15"}
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(flow_context, "POSTBACK_FLOW_CONTEXT", True)
+    monkeypatch.setattr(flow_context, "FLOW_CONTEXT_SECRET", "secret")
+
+
+def test_round_trip():
+    data = pack("confirm_add_task", "U1", TEMP_TASK)
+    assert data.startswith("confirm_add_task|ctx|") and len(data) <= POSTBACK_DATA_LIMIT
+    assert unpack(data, "U1") == ("confirm_add_task", TEMP_TASK)
+
+
+def test_data_without_context_is_unchanged():
+    assert unpack("confirm_add_task", "U1") == ("confirm_add_task", None)
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda data: data.replace("英文報告", "數學報告"),  # 改內容
+    lambda data: data.replace("confirm_add_task", "cancel_add_task", 1),  # 改按鈕
+    lambda data: data[:-1],  # 截斷
+])
+def test_tampered_context_is_rejected(tamper):
+    before = flow_context.get_flow_context_stats()["rejected"]
+    base, temp_task = unpack(tamper(pack("confirm_add_task", "U1", TEMP_TASK)), "U1")
+    assert temp_task is None
+    assert flow_context.get_flow_context_stats()["rejected"] == before + 1
+
+
+def test_signature_is_bound_to_user():
+    assert unpack(pack("confirm_add_task", "U1", TEMP_TASK), "U2") == ("confirm_add_task", None)
+
+
+def test_expired_context_is_rejected(monkeypatch):
+    data = pack("confirm_add_task", "U1", TEMP_TASK)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + flow_context.FLOW_CONTEXT_MAX_AGE + 120)
+    assert unpack(data, "U1") == ("confirm_add_task", None)
+
+
+def test_context_over_postback_limit_is_not_attached():
+    before = flow_context.get_flow_context_stats()["too_long"]
+    long_task = dict(TEMP_TASK, task="很長的作業名稱" * 40)
+    assert pack("confirm_add_task", "U1", long_task) == "confirm_add_task"
+    assert flow_context.get_flow_context_stats()["too_long"] == before + 1
+
+
+def test_disabled_without_secret(monkeypatch):
+    monkeypatch.setattr(flow_context, "FLOW_CONTEXT_SECRET", "")
+    assert pack("confirm_add_task", "U1", TEMP_TASK) == "confirm_add_task"
+
+
+def test_attach_only_to_target_buttons():
+    bubble = {"footer": {"contents": [
+        {"type": "button", "action": {"type": "postback", "data": "confirm_add_task"}},
+        {"type": "button", "action": {"type": "postback", "data": "quick_due_2030-01-15"}},
+        {"type": "button", "action": {"type": "postback", "data": "cancel_add_task"}},
+    ]}}
+    attach_to_bubble(bubble, "U1", TEMP_TASK, ["confirm_add_task", "quick_due_"])
+    confirm, quick_due, cancel = (button["action"]["data"] for button in bubble["footer"]["contents"])
+    assert unpack(confirm, "U1")[1] == TEMP_TASK
+    assert unpack(quick_due, "U1") == ("quick_due_2030-01-15", TEMP_TASK)
+    assert cancel == "cancel_add_task"
@@ -0,0 +1,59 @@
+import os
+import time
+import tempfile
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(), "flow_dispatch.db"))
+
+import firebase_utils
+import line_gateway
+import session_store
+from add_task_flow_manager import AddTaskFlowManager
+from firebase_utils import get_temp_task, get_user_state, set_temp_task, set_user_state
+from line_message_handler import dispatch_flow_input
+
+USER_ID = "F0"
+
+
+@pytest.fixture
+def replies(monkeypatch):
+    sent = []
+    monkeypatch.setattr(line_gateway, "reply", lambda reply_token, messages: sent.append(messages))
+    session_store.invalidate_session(USER_ID)
+    set_user_state(USER_ID, "awaiting_task_due")
+    set_temp_task(USER_ID, {"id": "t1", "task": "hw", "estimated_time": 2.0, "category": "報告"})
+    return sent
+
+
+@pytest.mark.parametrize("pick_due", [
+    lambda: AddTaskFlowManager.handle_due_date_selection(USER_ID, "2030-01-15", "token"),
+    lambda: AddTaskFlowManager.handle_no_due_date(USER_ID, "token"),
+])
+def test_free_text_after_due_date_is_not_flow_input(replies, pick_due):
+    pick_due()
+    assert get_user_state(USER_ID) is None
+    due = get_temp_task(USER_ID)["due"]
+
+    # 確認卡片出現後輸入的文字交給一般指令處理，不再改動暫存作業的截止日
+    assert not dispatch_flow_input(USER_ID, get_user_state(USER_ID), "我今天有什麼作業", "token")
+    assert get_temp_task(USER_ID)["due"] == due
+    assert len(replies) == 1
+
+
+def test_forgotten_flow_state_expires(replies, monkeypatch):
+    assert get_user_state(USER_ID) == "awaiting_task_due"
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + firebase_utils.FLOW_STATE_TTL + 1)
+    assert get_user_state(USER_ID) is None
+
+
+@pytest.mark.parametrize("text", ["完成數學作業", "明天要交英文報告", "查看作業"])
+def test_clear_local_intent_escapes_flow(replies, text):
+    assert not dispatch_flow_input(USER_ID, "awaiting_task_due", text, "token")
+    assert get_user_state(USER_ID) is None
+    assert replies == []
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+from intent_utils import classify_intent_locally, LOCAL_INTENT_THRESHOLD
+
+
+def _fast_path_intent(text):
+    intent, confidence = classify_intent_locally(text)
+    return intent if confidence >= LOCAL_INTENT_THRESHOLD else None
+
+
+@pytest.mark.parametrize("text", [
+    "查看這週的作業",
+    "今天的作業",
+    "我今天有什麼作業",
+    "明天有考試嗎",
+    "這週作業有哪些",
+    "今天要做什麼",
+])
+def test_questions_are_not_add_task(text):
+    assert _fast_path_intent(text) != "add_task_natural"
+
+
+@pytest.mark.parametrize("text", ["取消提醒", "關閉提醒"])
+def test_cancel_reminder_is_not_set_reminder(text):
+    assert _fast_path_intent(text) != "set_reminder"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("下週一要交作業系統，大概要寫三小時", "add_task_natural"),
+    ("明天要交英文報告", "add_task_natural"),
+    ("查看作業", "view_tasks"),
+    ("設定提醒", "set_reminder"),
+    ("新增作業", "add_task"),
+])
+def test_commands_still_use_fast_path(text, expected):
+    assert _fast_path_intent(text) == expected
@@ -0,0 +1,72 @@
+import os
+import json
+import hmac
+import base64
+import hashlib
+import tempfile
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(), "profile_cache.db"))
+
+from linebot.v3.webhook import WebhookHandler
+from linebot.v3.messaging.exceptions import ApiException
+
+import line_gateway
+import profile_cache
+from line_message_handler import register_message_handlers
+
+USER_ID = "P0"
+
+
+class Profile:
+    display_name = "小明"
+
+
+@pytest.fixture
+def profile_api(monkeypatch):
+    state = {"blocked": True}
+
+    def get_profile(user_id):
+        if state["blocked"]:
+            raise ApiException(status=404, reason="Not Found")
+        return Profile()
+
+    monkeypatch.setattr(line_gateway, "get_profile", get_profile)
+    profile_cache.invalidate_display_name(USER_ID)
+    return state
+
+
+def _follow_body():
+    return json.dumps({"destination": "d", "events": [{
+        "type": "follow", "mode": "active", "timestamp": 0, "replyToken": "token",
+        "webhookEventId": "f1", "deliveryContext": {"isRedelivery": False}, "follow": {"isUnblocked": True},
+        "source": {"type": "user", "userId": USER_ID},
+    }]})
+
+
+def test_negative_hit_is_counted(profile_api):
+    before = profile_cache.get_profile_cache_stats()
+    assert profile_cache.get_display_name(USER_ID) == profile_cache.DEFAULT_DISPLAY_NAME
+    assert profile_cache.get_display_name(USER_ID) == profile_cache.DEFAULT_DISPLAY_NAME
+    after = profile_cache.get_profile_cache_stats()
+    assert after["misses"] - before["misses"] == 1
+    assert after["negative_hits"] - before["negative_hits"] == 1
+
+
+def test_follow_event_clears_negative_cache(profile_api):
+    assert profile_cache.get_display_name(USER_ID) == profile_cache.DEFAULT_DISPLAY_NAME
+
+    # 用戶解除封鎖：follow 事件清掉負向快取（含持久化的資料），下次重新查詢
+    profile_api["blocked"] = False
+    handler = WebhookHandler("secret")
+    register_message_handlers(handler)
+    body = _follow_body()
+    signature = base64.b64encode(hmac.new(b"secret", body.encode("utf-8"), hashlib.sha256).digest()).decode("utf-8")
+    handler.handle(body, signature)
+
+    assert profile_cache.get_display_name(USER_ID) == "小明"
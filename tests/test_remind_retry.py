@@ -0,0 +1,107 @@
+import os
+import datetime
+import tempfile
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(), "remind_retry.db"))
+
+import firebase_utils
+import line_gateway
+import remind_delivery
+import remind_runner
+from remind_scheduler import RemindScheduler
+
+TZ = datetime.timezone(datetime.timedelta(hours=8))
+USERS = [f"R{i}" for i in range(4)]
+
+
+@pytest.fixture
+def line(monkeypatch):
+    """模擬 LINE API：failing 中的用戶所在的 multicast / push 會失敗"""
+    sent = {"failing": set(), "delivered": []}
+
+    def multicast(user_ids, messages, retry_key=None):
+        if sent["failing"] & set(user_ids):
+            raise RuntimeError("multicast failed")
+        sent["delivered"].extend(user_ids)
+
+    def push(user_id, messages, retry_key=None):
+        if user_id in sent["failing"]:
+            raise RuntimeError("push failed")
+        sent["delivered"].append(user_id)
+
+    monkeypatch.setattr(line_gateway, "multicast", multicast)
+    monkeypatch.setattr(line_gateway, "push", push)
+    monkeypatch.setattr(remind_runner, "prefetch_display_names", lambda *args, **kwargs: 0)
+    monkeypatch.setattr(remind_delivery, "MULTICAST_MAX_RECIPIENTS", 2)
+    firebase_utils.storage.delete("remind_meta/remind_retry")
+    for user_id in USERS:
+        firebase_utils.storage.set(f"users/{user_id}", {
+            "settings": {"add_task_remind_time": "00:00", "task_remind_enabled": False}
+        })
+    return sent
+
+
+def test_partially_failed_multicast_is_retried(line):
+    now = datetime.datetime.now(TZ)
+    today = now.strftime("%Y-%m-%d")
+    due_users = {user_id: ["add_task"] for user_id in USERS}
+
+    # 4 位用戶分成兩批 multicast（分批順序不固定），含 R1 的那一批失敗
+    line["failing"] = {"R1"}
+    RemindScheduler().fire(due_users, now)
+    failed = sorted(set(USERS) - set(line["delivered"]))
+    assert len(line["delivered"]) == 2 and "R1" in failed
+    assert firebase_utils.get_remind_retries(today) == {user_id: ["add_task"] for user_id in failed}
+
+    # 下一次處理只重試失敗的那一批，成功後從重試清單移除
+    line["failing"] = set()
+    line["delivered"] = []
+    scheduler = RemindScheduler()
+    scheduler._retry_at = now.timestamp()
+    scheduler.run_once(now)
+    assert sorted(line["delivered"]) == failed
+    assert firebase_utils.get_remind_retries(today) == {}
+
+
+def test_failed_push_stays_on_retry_list(line, monkeypatch):
+    now = datetime.datetime.now(TZ)
+    today = now.strftime("%Y-%m-%d")
+    monkeypatch.setattr(remind_runner, "get_display_name", lambda user_id, user_data=None: user_id)
+    firebase_utils.storage.update("users/R0", {
+        "tasks": {"t1": {"task": "hw", "done": False}},
+        "settings/task_remind_enabled": True,
+        "settings/remind_time": "00:00",
+    })
+
+    # 重試時仍然失敗，保留在重試清單
+    line["failing"] = {"R0"}
+    RemindScheduler().fire({"R0": ["task"]}, now)
+    RemindScheduler().fire({"R0": ["task"]}, now, retry_users=["R0"])
+    assert line["delivered"] == []
+    assert firebase_utils.get_remind_retries(today) == {"R0": ["task"]}
+
+
+def test_reminder_moved_later_today_gets_new_retry_key(monkeypatch):
+    now = datetime.datetime.now(TZ).replace(hour=12, minute=0)
+    keys = []
+    monkeypatch.setattr(line_gateway, "push", lambda user_id, messages, retry_key=None: keys.append(retry_key))
+    monkeypatch.setattr(remind_runner, "get_display_name", lambda user_id, user_data=None: user_id)
+    firebase_utils.storage.set("users/R9", {
+        "tasks": {"t1": {"task": "hw", "done": False}},
+        "settings": {"remind_time": "00:00", "task_remind_enabled": True, "add_task_remind_enabled": False},
+    })
+
+    # 今天已提醒過，時間改到稍後後重新發送，retry key 必須不同，否則 LINE 回 409 而不會送達
+    for remind_time in ("08:00", "12:00"):
+        firebase_utils.storage.update("users/R9", {"settings/remind_time": remind_time, "remind_ledger": None,
+                                                   "last_task_remind_date": None})
+        delivery = remind_delivery.ReminderDelivery()
+        remind_runner.process_user_reminders("R9", firebase_utils.storage.get("users/R9"), now, delivery, kinds=("task",))
+        delivery.flush()
+    assert len(keys) == 2 and keys[0] != keys[1]
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import threading
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(), "remind_scheduler.db"))
+
+import remind_scheduler
+from remind_scheduler import RemindScheduler
+
+
+class Watcher:
+    def __init__(self, callback):
+        self.callback = callback
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_change_notification_wakes_scheduler(monkeypatch):
+    watchers = []
+    runs = threading.Semaphore(0)
+
+    def watch(callback):
+        watchers.append(Watcher(callback))
+        return watchers[-1]
+
+    monkeypatch.setattr(remind_scheduler, "watch_remind_changes", watch)
+    monkeypatch.setattr(remind_scheduler, "acquire_sweep_lease", lambda name, owner: True)
+    monkeypatch.setattr(remind_scheduler, "release_sweep_lease", lambda name, owner: None)
+    monkeypatch.setattr(RemindScheduler, "load", lambda self, now: None)
+    # 沒有通知時要睡一小時
+    monkeypatch.setattr(RemindScheduler, "run_once", lambda self, now=None: runs.release() or 3600)
+
+    scheduler = RemindScheduler()
+    thread = threading.Thread(target=scheduler.run_forever, daemon=True)
+    thread.start()
+    assert runs.acquire(timeout=5)
+
+    # remind_changes 寫入新的變動時立即處理，不等到下一次定期讀取
+    watchers[0].callback()
+    assert runs.acquire(timeout=5)
+
+    scheduler.stop()
+    thread.join(timeout=5)
+    assert not thread.is_alive() and watchers[0].closed
@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(), "session_store.db"))
+
+import firebase_utils
+import session_store
+from firebase_utils import WriteBatch, clear_temp_task, clear_user_state
+
+USER_ID = "S0"
+
+
+@pytest.fixture
+def session():
+    firebase_utils.storage.set(f"users/{USER_ID}/session", {
+        "state": "awaiting_task_type",
+        "temp_task": {"task": "hw"},
+    })
+    session_store.invalidate_session(USER_ID)
+    yield
+    session_store.invalidate_session(USER_ID)
+
+
+def _stored_session():
+    return firebase_utils.storage.get(f"users/{USER_ID}/session")
+
+
+def test_batched_edits_build_on_each_other(session):
+    batch = WriteBatch()
+    clear_temp_task(USER_ID, batch=batch)
+    clear_user_state(USER_ID, batch=batch)
+    batch.commit()
+    assert _stored_session() is None
+
+
+def test_batched_edits_in_request_scope(session):
+    session_store.begin_request()
+    try:
+        firebase_utils.set_temp_task(USER_ID, {"task": "hw2"})
+        batch = WriteBatch()
+        clear_user_state(USER_ID, batch=batch)
+        clear_temp_task(USER_ID, batch=batch)
+        batch.commit()
+    finally:
+        session_store.end_request()
+    assert _stored_session() is None
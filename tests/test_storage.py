@@ -0,0 +1,111 @@
+import os
+import tempfile
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(), "storage.db"))
+
+import firebase_utils
+from storage import SQLiteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return SQLiteStorage(str(tmp_path / "nodes.db"))
+
+
+def test_nested_set_get_and_shallow(storage):
+    storage.set("users/U1", {"tasks": {"a": {"task": "hw"}}, "last_add_task_date": "2030-01-01"})
+    assert storage.get("users/U1/tasks/a/task") == "hw"
+    assert storage.get("users/U1", shallow=True) == {"tasks": True, "last_add_task_date": "2030-01-01"}
+    assert storage.get("users/U2") is None
+
+
+def test_multi_path_update_sets_and_deletes(storage):
+    storage.set("users/U1", {"a": 1, "b": {"c": 2}})
+    storage.update("users/U1", {"a": None, "b/c": 3, "d/e": 4})
+    assert storage.get("users/U1") == {"b": {"c": 3}, "d": {"e": 4}}
+
+
+def test_writing_below_a_leaf_replaces_it(storage):
+    storage.set("users/U1/state", "awaiting_task_name")
+    storage.set("users/U1/state/nested", 1)
+    assert storage.get("users/U1") == {"state": {"nested": 1}}
+
+
+def test_numeric_keys_read_back_as_list(storage):
+    storage.set("users/U1/tasks", [{"task": "a"}, {"task": "b"}])
+    assert storage.get("users/U1/tasks") == [{"task": "a"}, {"task": "b"}]
+
+
+def test_sibling_prefix_is_not_read(storage):
+    storage.set("users/U1", {"x": 1})
+    storage.set("users/U10", {"y": 2})
+    assert storage.get("users/U1") == {"x": 1}
+
+
+def test_key_range(storage):
+    storage.set("changes", {"001_a": 1, "002_b": 2, "003_c": 3})
+    assert list(storage.get_key_range("changes", end_at="002_b")) == ["001_a", "002_b"]
+    assert list(storage.get_key_range("changes", start_at="002")) == ["002_b", "003_c"]
+    assert storage.get_key_range("missing") == {}
+
+
+def test_set_if_unchanged_detects_conflicts(storage):
+    storage.set("users/U1/tasks", {"a": {"done": False}})
+    value, etag = storage.get_with_etag("users/U1/tasks")
+
+    # 另一個 worker 在讀取後寫入
+    storage.set("users/U1/tasks/b", {"done": False})
+    ok, current, current_etag = storage.set_if_unchanged("users/U1/tasks", etag, {"a": {"done": True}})
+    assert not ok
+    assert current == {"a": {"done": False}, "b": {"done": False}}
+
+    ok, written, _ = storage.set_if_unchanged("users/U1/tasks", current_etag, {"a": {"done": True}})
+    assert ok and written == {"a": {"done": True}}
+
+
+def test_set_if_unchanged_on_missing_node_is_create_only(storage):
+    _, etag = storage.get_with_etag("users/U1/tasks/t1")
+    assert storage.set_if_unchanged("users/U1/tasks/t1", etag, {"task": "a"})[0]
+    assert not storage.set_if_unchanged("users/U1/tasks/t1", etag, {"task": "b"})[0]
+    assert storage.get("users/U1/tasks/t1") == {"task": "a"}
+
+
+def test_mutate_tasks_retries_after_conflict():
+    user_id = "ST0"
+    firebase_utils.storage.delete(f"users/{user_id}")
+    firebase_utils.invalidate_task_cache(user_id)
+    firebase_utils.save_data(user_id, [{"task": "a", "done": False}])
+    calls = []
+
+    def mutator(tasks):
+        calls.append(len(tasks))
+        if len(calls) == 1:
+            # 第一次執行期間另一個請求新增了作業
+            firebase_utils.storage.set(f"users/{user_id}/tasks/{firebase_utils.new_task_id()}", {"task": "b", "done": False})
+        for task in tasks:
+            task["done"] = True
+        return len(tasks)
+
+    assert firebase_utils.mutate_tasks(user_id, mutator) == 2
+    assert calls == [1, 2]
+    assert all(task["done"] for task in firebase_utils.load_data(user_id))
+
+
+def test_mutate_tasks_gives_up_after_max_retries():
+    user_id = "ST1"
+    firebase_utils.storage.delete(f"users/{user_id}")
+    firebase_utils.invalidate_task_cache(user_id)
+    firebase_utils.save_data(user_id, [{"task": "a", "done": False}])
+
+    def always_conflicting(tasks):
+        firebase_utils.storage.set(f"users/{user_id}/tasks/{firebase_utils.new_task_id()}", {"task": "x"})
+        tasks.append({"task": "c"})
+
+    with pytest.raises(firebase_utils.TaskConflictError):
+        firebase_utils.mutate_tasks(user_id, always_conflicting, max_retries=2)
@@ -0,0 +1,103 @@
+import os
+import tempfile
+from collections import Counter
+
+import pytest
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "test")
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "test")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(), "round_trips.db"))
+
+import firebase_utils
+import line_gateway
+import session_store
+from add_task_flow_manager import AddTaskFlowManager
+
+USER_ID = "B0"
+STORAGE_METHODS = {"get", "get_with_etag", "set_if_unchanged", "get_key_range", "set", "update", "delete"}
+
+
+class CountingStorage:
+    """包住實際的儲存後端，記錄每個方法被呼叫的次數（每次呼叫即一次往返）"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name not in STORAGE_METHODS:
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    counting = CountingStorage(firebase_utils.storage)
+    monkeypatch.setattr(firebase_utils, "storage", counting)
+    monkeypatch.setattr(session_store, "get_storage", lambda: counting)
+    monkeypatch.setattr(line_gateway, "reply", lambda reply_token, messages: None)
+    counting.inner.delete(f"users/{USER_ID}")
+    session_store.invalidate_session(USER_ID)
+    firebase_utils.invalidate_task_cache(USER_ID)
+    return counting
+
+
+def _seed_tasks(count):
+    tasks = [{"task": f"hw{i}", "estimated_time": 1.0, "category": "報告", "due": "未設定", "done": False}
+             for i in range(count)]
+    firebase_utils.save_data(USER_ID, tasks)
+    return firebase_utils.load_data(USER_ID)
+
+
+@pytest.mark.parametrize("count", [2, 6])
+def test_batch_complete_round_trips_do_not_grow_with_selection(storage, count):
+    tasks = _seed_tasks(count)
+
+    # 逐一完成：每個作業一次交易（讀 + 條件寫入）
+    storage.calls.clear()
+    for task in tasks[:count // 2]:
+        firebase_utils.mutate_task(USER_ID, task["id"], lambda t: t.update(done=True))
+    one_by_one = storage.total()
+
+    # 批次完成其餘作業：整個作業列表一次交易，再清除批次選擇
+    storage.calls.clear()
+    ok, completed = firebase_utils.batch_complete_tasks(USER_ID, list(range(count // 2, count)))
+    assert ok and completed == count - count // 2
+    assert storage.calls["get_with_etag"] == 1 and storage.calls["set_if_unchanged"] == 1
+    assert storage.total() <= 4
+    if count > 2:
+        assert storage.total() < one_by_one
+
+
+def test_confirm_add_task_commits_follow_up_writes_once(storage):
+    temp_task = {"id": firebase_utils.new_task_id(), "task": "hw", "estimated_time": 2.0,
+                 "category": "報告", "due": "未設定"}
+
+    # 不使用批次：歷史記錄、新增日期與兩個 session 欄位各自寫入
+    firebase_utils.set_temp_task(USER_ID, temp_task)
+    firebase_utils.set_user_state(USER_ID, "awaiting_task_due")
+    storage.calls.clear()
+    firebase_utils.update_task_history(USER_ID, temp_task["task"], temp_task["category"], temp_task["estimated_time"])
+    storage.set(f"users/{USER_ID}/last_add_task_date", "2030-01-01")
+    firebase_utils.clear_temp_task(USER_ID)
+    firebase_utils.clear_user_state(USER_ID)
+    unbatched_writes = storage.calls["set"] + storage.calls["update"] + storage.calls["delete"]
+
+    # 確認新增：作業本身是條件寫入，其餘寫入合併成一次 update
+    firebase_utils.set_temp_task(USER_ID, dict(temp_task, id=firebase_utils.new_task_id()))
+    storage.calls.clear()
+    AddTaskFlowManager.confirm_add_task(USER_ID, "token")
+    assert storage.calls["set_if_unchanged"] == 1
+    assert storage.calls["update"] == 1
+    assert storage.calls["set"] + storage.calls["delete"] == 0
+    assert storage.calls["update"] < unbatched_writes
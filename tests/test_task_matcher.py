@@ -0,0 +1,54 @@
+import datetime
+
+from date_utils import _today
+from task_matcher import match_task
+
+TASKS = [
+    {"task": "英文報告"},
+    {"task": "英文作業"},
+    {"task": "作業系統"},
+    {"task": "作業系統期中報告"},
+    {"task": "數學習題", "done": True},
+]
+
+
+def test_full_name_wins():
+    result = match_task("作業系統寫完了", TASKS)
+    assert result["task_index"] == 2 and result["confidence"] == 1.0
+    assert not result["ambiguous"]
+
+
+def test_longer_name_in_sentence_drops_contained_shorter_name():
+    result = match_task("作業系統期中報告寫完了", TASKS)
+    assert result["task_index"] == 3 and result["candidates"] == [3]
+
+
+def test_dice_lcs_tie_is_ambiguous_and_breaks_by_position():
+    result = match_task("英文寫完了", TASKS)
+    assert result["ambiguous"]
+    assert result["candidates"] == [0, 1]
+    # 同分時取列表中較前面的作業
+    assert result["task_index"] == 0
+
+
+def test_due_date_hint_breaks_tie():
+    tomorrow = (_today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    tasks = [{"task": "化學實驗", "due": "2099-01-01"}, {"task": "物理實驗", "due": tomorrow}]
+    assert match_task("實驗做完了", tasks)["ambiguous"]
+
+    result = match_task("明天的實驗做完了", tasks)
+    assert result["task_index"] == 1 and not result["ambiguous"]
+    assert "截止日相符" in result["reason"]
+
+
+def test_only_due_date_hint():
+    tomorrow = (_today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    tasks = [{"task": "化學實驗", "due": tomorrow}, {"task": "物理實驗", "due": "2099-01-01"}]
+    result = match_task("明天要交的那個寫完了", tasks)
+    assert result["task_index"] == 0 and result["reason"] == "截止日相符"
+
+
+def test_completed_and_unrelated_tasks_are_not_matched():
+    assert match_task("數學習題寫完了", TASKS) is None
+    assert match_task("歷史", TASKS) is None
+
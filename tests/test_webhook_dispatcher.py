@@ -0,0 +1,54 @@
+import os
+import json
+import queue
+import tempfile
+import threading
+
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+os.environ.setdefault("SQLITE_DB_PATH", os.path.join(tempfile.mkdtemp(), "webhook_dispatcher.db"))
+
+from webhook_dispatcher import WebhookDispatcher
+
+
+class FullAfterQueue:
+    """每個分片最多放 capacity 個事件，worker 不取出（模擬處理不過來）"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = {}
+
+    def put(self, shard, item, timeout):
+        if len(self.items.setdefault(shard, [])) >= self.capacity:
+            raise queue.Full
+        self.items[shard].append(json.loads(item)["events"][0]["webhookEventId"])
+
+    def get(self, shard):
+        threading.Event().wait()
+
+    def task_done(self, shard):
+        pass
+
+    def qsize(self, shard):
+        return len(self.items.get(shard, []))
+
+
+def _body(*event_ids):
+    return json.dumps({"destination": "d", "events": [
+        {"webhookEventId": event_id, "source": {"userId": "U1"}} for event_id in event_ids
+    ]})
+
+
+def test_full_queue_rejects_without_reordering():
+    backend = FullAfterQueue(capacity=1)
+    dispatcher = WebhookDispatcher(lambda body, signature: None, "secret", workers=1, queue_backend=backend)
+
+    # e2 排不進去時不在請求中插隊處理，e3 也不排入，讓 LINE 重送
+    assert dispatcher.submit(_body("e1", "e2", "e3")) is False
+    assert backend.items[0] == ["e1"]
+
+    # 重送時略過已經排入的 e1，其餘依原本順序排入
+    backend.capacity = 10
+    assert dispatcher.submit(_body("e1", "e2", "e3")) is True
+    assert backend.items[0] == ["e1", "e2", "e3"]
+    assert dispatcher.get_stats()["redelivered"] == 1
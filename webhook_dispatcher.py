@@ -0,0 +1,173 @@
+# ==================== 非同步 Webhook 事件分派器 ====================
+# /callback 驗證簽章後把事件丟進有界佇列並立即回 200，
+# 再由背景 worker 執行原本的 handler。
+# 同一個 user_id 的事件一定落在同一個 worker，確保處理順序不變。
+# 佇列滿時不在請求中插隊處理（會跑在同一用戶已排隊的事件前面），而是回 503 讓 LINE 重送；
+# 已經排入的事件以 webhookEventId 記住，重送時略過，不會重複處理。
+
+import os
+import json
+import hmac
+import base64
+import hashlib
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+
+from firebase_utils import begin_request_cache, end_request_cache
+
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync")  # sync / async
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))  # 每個 worker 的佇列長度
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))
+ACCEPTED_EVENT_IDS_MAX = 10000  # 記住最近排入的 webhookEventId 數量
+
+
+class InProcessEventQueue:
+    """預設的佇列後端：每個分片一條 queue.Queue"""
+
+    def __init__(self, shards, maxsize):
+        self._queues = [queue.Queue(maxsize=maxsize) for _ in range(shards)]
+
+    def put(self, shard, item, timeout):
+        """放入事件，佇列滿時最多等待 timeout 秒，失敗拋出 queue.Full"""
+        self._queues[shard].put(item, timeout=timeout)
+
+    def get(self, shard):
+        return self._queues[shard].get()
+
+    def task_done(self, shard):
+        self._queues[shard].task_done()
+
+    def qsize(self, shard):
+        return self._queues[shard].qsize()
+
+
+class WebhookDispatcher:
+    """
+    背景事件分派器
+    handle_func(body, signature)：原本同步處理 webhook 的函數（通常是 handler.handle）
+    queue_backend：需實作 put/get/task_done/qsize，預設為程序內佇列
+    """
+
+    def __init__(self, handle_func, channel_secret, workers=WEBHOOK_WORKERS,
+                 queue_size=WEBHOOK_QUEUE_SIZE, queue_backend=None):
+        self.handle_func = handle_func
+        self.channel_secret = channel_secret or ""
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self._queue_backend = queue_backend
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._accepted = OrderedDict()  # 最近排入的 webhookEventId
+        self.stats = {"enqueued": 0, "processed": 0, "failed": 0, "rejected": 0, "redelivered": 0}
+
+    # ---------- 啟動 ----------
+    def _ensure_started(self):
+        """延遲啟動 worker，並在 gunicorn fork 之後重新建立執行緒"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = self._queue_backend or InProcessEventQueue(self.workers, self.queue_size)
+            self._threads = []
+            for shard in range(self.workers):
+                t = threading.Thread(target=self._worker_loop, args=(shard,),
+                                     name=f"webhook-worker-{shard}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+            print(f"[webhook] 已啟動 {self.workers} 個背景 worker（pid={self._pid}）")
+
+    # ---------- 簽章 ----------
+    def verify_signature(self, body, signature):
+        digest = hmac.new(self.channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+        expected = base64.b64encode(digest).decode("utf-8")
+        return hmac.compare_digest(expected, signature or "")
+
+    def _sign(self, body):
+        digest = hmac.new(self.channel_secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+        return base64.b64encode(digest).decode("utf-8")
+
+    # ---------- 分派 ----------
+    def _shard_for(self, event):
+        source = event.get("source") or {}
+        key = source.get("userId") or source.get("groupId") or source.get("roomId") or ""
+        return zlib.crc32(key.encode("utf-8")) % self.workers
+
+    def _is_accepted(self, event_id):
+        with self._lock:
+            return event_id in self._accepted
+
+    def _mark_accepted(self, event_id):
+        with self._lock:
+            self.stats["enqueued"] += 1
+            if event_id:
+                self._accepted[event_id] = True
+                while len(self._accepted) > ACCEPTED_EVENT_IDS_MAX:
+                    self._accepted.popitem(last=False)
+
+    def submit(self, body):
+        """
+        將已驗證的 webhook body 拆成單一事件放入佇列
+        佇列滿時等待 WEBHOOK_ENQUEUE_TIMEOUT 秒（backpressure）；仍然滿時，
+        該分片之後的事件也不再排入（保持同一用戶的順序），由呼叫端回 503 讓 LINE 重送
+        返回: True 全部排入；False 有事件沒有排入
+        """
+        self._ensure_started()
+        payload = json.loads(body)
+        destination = payload.get("destination")
+        full_shards = set()
+
+        for event in payload.get("events", []):
+            event_id = event.get("webhookEventId")
+            if event_id and self._is_accepted(event_id):
+                # LINE 重送的 body 中已經排入過的事件
+                with self._lock:
+                    self.stats["redelivered"] += 1
+                continue
+            shard = self._shard_for(event)
+            if shard in full_shards:
+                continue
+            single_body = json.dumps({"destination": destination, "events": [event]}, ensure_ascii=False)
+            try:
+                self._queue.put(shard, single_body, timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+                self._mark_accepted(event_id)
+            except queue.Full:
+                print(f"[webhook] worker {shard} 佇列已滿，等待 LINE 重送")
+                full_shards.add(shard)
+                with self._lock:
+                    self.stats["rejected"] += 1
+        return not full_shards
+
+    def _process(self, single_body):
+        begin_request_cache()
+        try:
+            self.handle_func(single_body, self._sign(single_body))
+            with self._lock:
+                self.stats["processed"] += 1
+        except Exception as e:
+            with self._lock:
+                self.stats["failed"] += 1
+            print(f"[webhook] 處理事件失敗：{e}")
+        finally:
+            end_request_cache()
+
+    def _worker_loop(self, shard):
+        while True:
+            single_body = self._queue.get(shard)
+            try:
+                self._process(single_body)
+            finally:
+                self._queue.task_done(shard)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        if self._queue is not None and self._pid == os.getpid():
+            stats["queued"] = sum(self._queue.qsize(s) for s in range(self.workers))
+        return stats